@@ -5,6 +5,10 @@ from brat_annotation import BratAnnotation
 from utils import get_span, get_spans
 from attribution import Attribution
 from attribution_html_serializer import AttributionHtmlSerializer, Styler
+import string_table
+import doc_cache
+import token_alignment
+import parc_xml_writer
 import parc_dataset
 import new_reader
 import align_attributions
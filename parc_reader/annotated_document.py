@@ -1,5 +1,9 @@
+import copy
 import re
+from bisect import bisect_right
+from collections import defaultdict
 import parc_reader
+from parc_reader.token_alignment import MAX_EDITS
 import t4k
 
 
@@ -21,10 +25,14 @@ class AnnotatedDocument(object):
 
         # We should guarantee that tokens have an absolute id
         self.doc_id = doc_id
+        self.journal = parc_reader.spans.EditJournal()
         self.annotations = annotations or {}
         self.tokens = parc_reader.token_list.TokenList(tokens or [])
 
+        # The absolute index of each sentence's first token, in order, so that
+        # the sentence containing a token can be found by binary search.
         self.sentences = []
+        self.sentence_starts = []
         if sentences is not None:
             for sentence in sentences:
                 self.add_sentence(sentence)
@@ -49,6 +57,7 @@ class AnnotatedDocument(object):
         sentence_id = len(self.sentences)
         sentence['id'] = sentence_id
         self.sentences.append(sentence)
+        self.sentence_starts.append(sentence['token_span'][0][1])
 
         # Add sentence-relative ids to the tokens for this sentence
         self.write_relative_token_ids_in_sentence(sentence_id)
@@ -88,14 +97,20 @@ class AnnotatedDocument(object):
 
 
     def get_tokens_abs(self, span):
+        """
+        Returns a TokenView of the tokens in the absolute `span`.  The tokens
+        aren't copied, so this costs as much as the number of ranges in the
+        span, not the number of tokens.
+        """
         span = self.span_or_token_span(span)
-        selected = parc_reader.token_list.TokenList()
-        for _, start, end in span:
-            selected.extend(self.tokens[start:end])
-        return selected
+        return parc_reader.token_list.TokenView(
+            self.tokens, [(start, end) for _, start, end in span])
 
 
     def get_tokens(self, span):
+        """
+        Returns a TokenView of the tokens in the sentence-relative `span`.
+        """
 
         # We can only do this if the document has sentences defined
         if self.sentences is None:
@@ -103,10 +118,11 @@ class AnnotatedDocument(object):
                 'This annotated document has no sentence information')
 
         span = self.span_or_token_span(span)
-        selected = parc_reader.token_list.TokenList()
+        ranges = []
         for sentence_id, start, stop in span:
-            selected.extend(self.get_sentence_tokens(sentence_id)[start:stop])
-        return selected
+            ranges.extend(
+                self.get_sentence_tokens(sentence_id)[start:stop].ranges)
+        return parc_reader.token_list.TokenView(self.tokens, ranges)
 
 
     def span_or_token_span(self, span):
@@ -117,6 +133,28 @@ class AnnotatedDocument(object):
             return span
 
 
+    def refresh_sentence_starts(self):
+        """
+        Rebuild the index of sentence starts.  Needed whenever sentence
+        boundaries move.
+        """
+        self.sentence_starts = [
+            sentence['token_span'][0][1] for sentence in self.sentences]
+
+
+    def find_sentence(self, abs_index):
+        """
+        Returns the id of the sentence containing the token at `abs_index`,
+        or None if no sentence contains it.
+        """
+        sentence_id = bisect_right(self.sentence_starts, abs_index) - 1
+        if sentence_id < 0:
+            return None
+        if abs_index >= self.sentences[sentence_id]['token_span'][0][2]:
+            return None
+        return sentence_id
+
+
     def relativize(self, token_ranges):
         new_token_ranges = []
 
@@ -126,34 +164,93 @@ class AnnotatedDocument(object):
             if dummy_sentence_id is not None:
                 ValueError('Cannot relativize token range: already relative.')
 
-            successfully_relativized_range = False
+            new_token_ranges.extend(self.relativize_range(
+                token_range, self.find_sentence(start)))
 
-            for sentence_id, sentence in enumerate(self.sentences):
+        return new_token_ranges
 
-                _, sent_start, sent_end = sentence['token_span'][0]
 
-                if start >= sent_start and start < sent_end:
-                    if end <= sent_end:
-                        new_token_ranges.append((
-                            sentence_id,
-                            start - sent_start,
-                            end - sent_start
-                        ))
-                        successfully_relativized_range = True
-                    else:
-                        new_token_ranges.extend(self.relativize([
-                            (None, start, sent_end), (None, sent_end, end)
-                        ]))
-                        successfully_relativized_range = True
+    def relativize_many(self, token_range_lists):
+        """
+        Relativize several lists of token ranges at once.  Rather than
+        searching for each range's sentence, all of the ranges are sorted by
+        their start, and resolved during a single pass through the sentences.
+        Returns a list of relativized token ranges for each list given.
+        """
+        # (A TokenSpan's length is its number of tokens, not ranges.)
+        token_range_lists = [
+            list(token_ranges) for token_ranges in token_range_lists]
+        range_starts = sorted(
+            (token_range[1], list_idx, range_idx)
+            for list_idx, token_ranges in enumerate(token_range_lists)
+            for range_idx, token_range in enumerate(token_ranges)
+        )
+
+        relativized = [
+            [None] * len(token_ranges) for token_ranges in token_range_lists]
+        sentence_id = 0
+        for start, list_idx, range_idx in range_starts:
+
+            # Advance to the sentence containing this range's start.
+            while (
+                sentence_id < len(self.sentences) and
+                self.sentences[sentence_id]['token_span'][0][2] <= start
+            ):
+                sentence_id += 1
+
+            token_range = token_range_lists[list_idx][range_idx]
+            if sentence_id == len(self.sentences):
+                raise ValueError('Could not relativize %s' % str(token_range))
+            relativized[list_idx][range_idx] = self.relativize_range(
+                token_range, sentence_id)
+
+        return [
+            [new_range for new_ranges in ranges for new_range in new_ranges]
+            for ranges in relativized
+        ]
 
-                if sent_start >= end:
-                    break
 
-            if not successfully_relativized_range:
+    def relativize_spans(self, token_spans):
+        """
+        Convert several absolute TokenSpans to sentence-relative addressing,
+        using `relativize_many`.
+        """
+        for token_span in token_spans:
+            if not token_span.absolute:
                 raise ValueError(
-                    'Could not relativize %s' % str(token_range))
+                    'Cannot relativize TokenSpan: already relative.')
+        new_spans = self.relativize_many(token_spans)
+        for token_span, new_span in zip(token_spans, new_spans):
+            token_span.absolute = False
+            token_span.replace_with(new_span)
+
+
+    def relativize_range(self, token_range, sentence_id):
+        """
+        Relativize `token_range`, given the id of the sentence in which it
+        starts.  Ranges that cross into later sentences are split at the
+        sentence boundaries.
+        """
+        dummy_sentence_id, start, end = token_range
+        if sentence_id is None or start < self.sentence_starts[sentence_id]:
+            raise ValueError('Could not relativize %s' % str(token_range))
 
-        return new_token_ranges
+        new_token_ranges = []
+        while True:
+            _, sent_start, sent_end = self.sentences[sentence_id][
+                'token_span'][0]
+            if end <= sent_end:
+                new_token_ranges.append(
+                    (sentence_id, start - sent_start, end - sent_start))
+                return new_token_ranges
+
+            new_token_ranges.append(
+                (sentence_id, start - sent_start, sent_end - sent_start))
+            start = sent_end
+            sentence_id += 1
+            if sentence_id == len(self.sentences):
+                raise ValueError(
+                    'Could not relativize %s' % str(token_range))
 
 
     def absolutize(self, token_ranges):
@@ -165,144 +262,156 @@ class AnnotatedDocument(object):
             if not isinstance(sentence_id, int):
                 ValueError('Cannot relativize token range: already relative.')
 
-            sentence = self.sentences[sentence_id]
-            _, sent_start, sent_end = sentence['token_span'][0]
+            sent_start = self.sentence_starts[sentence_id]
             new_token_ranges.append((
                 None, start + sent_start, end + sent_start))
 
         return new_token_ranges
 
 
+    def absolutize_many(self, token_range_lists):
+        """
+        Absolutize several lists of token ranges.
+        """
+        return [
+            self.absolutize(token_ranges) for token_ranges in token_range_lists
+        ]
+
+
     def merge_tokens(
         self,
         other,
         copy_token_fields,
         copy_annotations,
-        verbose=False
+        verbose=False,
+        max_edits=MAX_EDITS
     ):
-
-        # TODO: For every token mismatch, we need to update the local
-        # annotation spans or the remote ones.  We need to maintain the
-        # distinction between local and remote annotations, so we should delay
-        # copying over the annotations until after token-wise mergin is
-        # finished.
-
-        # Copy over annotations
-        for annotation in copy_annotations:
-            self.annotations[annotation] = other.annotations[annotation]
-
-        self_token_pointer = 0
-        for other_token_pointer, other_token in enumerate(other.tokens):
-
-            try:
-                self_token = self.tokens[self_token_pointer]
-            except IndexError:
-                if other_token['text'] == '.':
-
-                    # TODO delete token in other
-                    continue
-
-                raise
-
-            self_text, other_text = self_token['text'], other_token['text']
-            print self_text, other_text
-
-            # Skip the stray apostraphe in doc 63.
-            if self.doc_id == 63:
-                if self_token['abs_id'] == 291:
-
-                    # TODO delete token in other
-                    continue
-
-            force_same_token = False
-            if self.doc_id == 2201:
-                if self_token['abs_id'] == 890:
-                    other_text = self_text
-                    force_same_token = True
-
-            # If they are the same token, merge the annotations
-            if is_same_token(self_text, other_text) or force_same_token:
-                self_token.update(t4k.select(other_token, copy_token_fields))
-
-            # If the new token is a subset of the existing token, split
-            # the existing token
-            elif startswith(self_text, other_text):
-                prefix, postfix = match_split(self_text, other_text)
-                print (
-                    '\t\tdoc #%d, token %d, splitting "%s" into "%s" and "%s"'
-                    % (
-                        self.doc_id, self_token['abs_id'], self_text,
-                        prefix, postfix
+        """
+        Copy `copy_token_fields` from the tokens of `other` onto the tokens
+        they align to in this document, and copy over the annotations named
+        in `copy_annotations`.  Where `other` has split one of this document's
+        tokens, it gets split here too.  Returns the TokenAlignment from the
+        tokens of `other` to those of this document (after splitting).
+
+        Raises a ValueError if the texts of the documents differ by more than
+        `max_edits` characters (None lifts the limit).
+        """
+
+        alignment = parc_reader.token_alignment.align_tokens(
+            other.tokens, self.tokens, max_edits)
+
+        # Token splits are queued, and applied together at the end.  Keep
+        # track of how the groups of aligned tokens will be addressed then.
+        edits = self.batch_token_edits()
+        merged_groups = []
+        self_pointer = 0
+        for other_range, self_range in alignment.groups:
+            other_tokens = other.tokens[other_range[0]:other_range[1]]
+            self_tokens = self.tokens[self_range[0]:self_range[1]]
+
+            # SPLITTING LOCAL TOKEN
+            if len(self_tokens) == 1 and len(other_tokens) > 1:
+                other_texts = [token['text'] for token in other_tokens]
+                if verbose:
+                    print (
+                        '\t\tdoc #%s, token %d, splitting "%s" into "%s"'
+                        % (
+                            self.doc_id, self_range[0],
+                            self_tokens[0]['text'], '", "'.join(other_texts)
+                        )
                     )
-                )
-
-                # SPLITTING LOCAL TOKEN
-                self_token, remainder = self.split_token(self_token, other_text)
-                self_token.update(t4k.select(other_token, copy_token_fields))
-
-            elif self_text == other.tokens[other_token_pointer+1]['text']:
-                raise ValueError(self.doc_id, self_token_pointer, self_text)
-                continue
+                self_tokens = edits.split_token_into(
+                    self_range[0], other_texts)
+                for offset in range(len(self_tokens)):
+                    merged_groups.append((
+                        (other_range[0] + offset, other_range[0] + offset + 1),
+                        (self_pointer + offset, self_pointer + offset + 1)
+                    ))
 
             else:
-                raise ValueError(
-                    '\t\tdoc #%d, token %d, expecting "%s" got "%s"'
-                    % (self.doc_id,self_token['abs_id'],self_text,other_text)
+                if verbose and len(self_tokens) != len(other_tokens):
+                    print (
+                        '\t\tdoc #%s, token %d, aligning "%s" to "%s"'
+                        % (
+                            self.doc_id, self_range[0],
+                            ' '.join([token['text'] for token in self_tokens]),
+                            ' '.join([token['text'] for token in other_tokens])
+                        )
+                    )
+                merged_groups.append((
+                    other_range,
+                    (self_pointer, self_pointer + len(self_tokens))
+                ))
+
+            # Copy fields between aligned tokens.  If there are more local
+            # tokens than tokens in `other`, the extra ones take the fields of
+            # the last token in `other`.
+            if len(other_tokens) > 0:
+                for index, self_token in enumerate(self_tokens):
+                    other_token = other_tokens[min(index, len(other_tokens)-1)]
+                    self_token.update(
+                        t4k.select(other_token, copy_token_fields))
+
+            self_pointer += len(self_tokens)
+
+        edits.apply()
+        alignment = parc_reader.token_alignment.TokenAlignment(merged_groups)
+
+        # Copy over annotations, now that the tokens are merged, projecting
+        # their spans from the tokens of `other` onto the local ones.  The
+        # copies shouldn't follow the journal of `other`.
+        for annotation_type in copy_annotations:
+            annotations = copy.deepcopy(
+                other.annotations[annotation_type], {id(other.journal): None})
+            for annotation in annotations.values():
+                annotation.map_token_spans(
+                    lambda token_span: self.project_token_span(
+                        token_span, other, alignment)
                 )
+                annotation.follow_journal(self.journal)
+            self.annotations[annotation_type] = annotations
 
-            self_token_pointer += 1
-
+        return alignment
 
-    def split_token(self, token, partial_text):
-        prefix, postfix = match_split(token['text'], partial_text)
-        token['text'] = partial_text
-        remainder_token = dict(token, text=postfix)
-        self.insert_token_after(token['abs_id'], remainder_token)
-        return token, remainder_token
 
+    def project_token_span(self, token_span, source_doc, alignment):
+        """
+        Returns the TokenSpan covering the tokens in this document that
+        `alignment` aligns to the tokens of `source_doc` in `token_span`.  It
+        is absolute or sentence-relative, as `token_span` is.
+        """
+        if token_span.absolute:
+            return alignment.project_span(token_span)
+        projected = alignment.project_span(source_doc.absolutize(token_span))
+        return parc_reader.spans.TokenSpan(
+            self.relativize(projected), absolute=False)
 
-    def delete_token(self, abs_index, token):
-        deleted_token = self.tokens.pop(abs_index)
-        self.write_token_ids()
 
-        # 1) Remove the token from the token list
-        # 2) Adjust the token's own abs and rel id
-        # 3) Adjust the span limits for sentences
-        # 4) Adjust the span limits for annotations
+    def batch_token_edits(self):
+        """
+        Returns a TokenEdits object, which queues token insertions and
+        deletions for this document until they are applied together.
+        """
+        return TokenEdits(self)
 
-        insertion_point = [
-            abs_index,
-            token.get('sentence_id', None),
-            token.get('id', None)
-        ]
 
-        # Possibly adjust sentences
-        if self.sentences:
-            for sentence in self.sentences:
-                sentence.accomodate_inserted_token(*insertion_point)
+    def split_token(self, token, partial_text):
+        edits = self.batch_token_edits()
+        token, remainder_token = edits.split_token(token, partial_text)
+        edits.apply()
+        return token, remainder_token
 
-        # Adjust annotations
-        for annotation_type in self.annotations:
-            for annotation in self.annotations[annotation_type].values():
-                annotation.accomodate_inserted_token(*insertion_point)
 
+    def delete_token(self, abs_index, token=None):
+        edits = self.batch_token_edits()
+        edits.delete_token(abs_index)
+        edits.apply()
 
 
     def insert_token_after(self, token, abs_index):
-
-        # Adjust the sentence boundaries
-        for sentence in self.sentences:
-            sentence.accomodate_inserted_token(abs_index)
-
-        # Adjust the annotations
-        for annotation_type in self.annotations:
-            for annotation in self.annotations[annotation_type].values():
-                annotation.accomodate_inserted_token(abs_index)
-        
-        # Insert the new token in the global tokens list, and rewrite tokens'
-        # own addresses
-        self.tokens.insert(index, token)
-        self.write_token_ids()
+        edits = self.batch_token_edits()
+        edits.insert_token_after(token, abs_index)
+        edits.apply()
 
 
     def write_relative_token_ids_in_sentence(self, sentence_id):
@@ -319,6 +428,178 @@ class AnnotatedDocument(object):
 
 
 
+class TokenEdits(object):
+    """
+    Queues insertions and deletions of tokens in an AnnotatedDocument, so that
+    they can be applied in one pass.  Token positions always refer to the
+    document as it was before any of the queued edits.  Can be used as a
+    context manager, in which case the edits are applied on leaving the
+    block.
+
+    Applying the edits renumbers tokens once, and records a table of where
+    each old token boundary moves to in the document's EditJournal, which
+    sentence and annotation spans use to shift themselves.
+    An inserted token joins the spans that contain the token it follows,
+    (or, when inserted at the very start, the spans that start there).  A
+    deleted token is dropped from the spans that contained it.
+    """
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.insertions = defaultdict(list)
+        self.deletions = set()
+        self.new_positions = None
+        self.sentence_starts = None
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.apply()
+
+
+    def insert_token_after(self, token, abs_index):
+        """
+        Queue inserting `token` after the token at `abs_index`.  Use -1 to
+        insert at the start.  Tokens inserted after the same token keep the
+        order they were queued in.
+        """
+        self.insertions[abs_index].append(token)
+
+
+    def delete_token(self, abs_index):
+        self.deletions.add(abs_index)
+
+
+    def split_token(self, token, partial_text):
+        """
+        Shorten `token` to `partial_text`, and queue inserting a token holding
+        the rest of its text after it.  A queued remainder can itself be split.
+        """
+        prefix, postfix = match_split(token['text'], partial_text)
+        token['text'] = partial_text
+        remainder_token = token.copy()
+        remainder_token['text'] = postfix
+        self.insert_token_after(remainder_token, token['abs_id'])
+        return token, remainder_token
+
+
+    def split_token_into(self, abs_index, texts):
+        """
+        Split the token at `abs_index` into tokens having `texts`, queueing the
+        insertion of all but the first after it.  Returns the resulting
+        tokens.
+        """
+        token = self.doc.tokens[abs_index]
+        token['text'] = texts[0]
+        tokens = [token]
+        for text in texts[1:]:
+            remainder_token = token.copy()
+            remainder_token['text'] = text
+            self.insert_token_after(remainder_token, abs_index)
+            tokens.append(remainder_token)
+        return tokens
+
+
+    def get_new_positions(self):
+        """
+        Work out where the boundary before each old token (and the end of the
+        document) ends up once the edits are applied.
+        """
+        num_tokens = len(self.doc.tokens)
+        new_positions = [len(self.insertions.get(-1, ()))]
+        for abs_index in range(num_tokens):
+            new_positions.append(
+                new_positions[-1]
+                + int(abs_index not in self.deletions)
+                + len(self.insertions.get(abs_index, ()))
+            )
+
+        # Spans starting at the start of the document take on tokens inserted
+        # at the start.
+        new_positions[0] = 0
+        return new_positions
+
+
+    def shift_range(self, token_range):
+        """
+        Returns where `token_range` ends up once the edits are applied, or
+        None if all of its tokens are deleted.
+        """
+        return parc_reader.spans.shift_range(
+            token_range, self.new_positions, self.sentence_starts)
+
+
+    def check_token_span(self, token_span):
+        """
+        Raise a ValueError if `token_span` isn't yet following the document's
+        journal, and addresses tokens beyond those of the document.  Returns
+        the span.
+        """
+        if token_span.journal is not self.doc.journal:
+            for token_range in token_span:
+                parc_reader.spans.check_range(
+                    token_range, self.sentence_starts, len(self.doc.tokens))
+        return token_span
+
+
+    def apply(self):
+        doc = self.doc
+        self.new_positions = self.get_new_positions()
+        self.sentence_starts = list(doc.sentence_starts)
+
+        # Refuse edits that would delete a whole sentence.
+        for sentence in doc.sentences:
+            if self.shift_range(sentence['token_span'][0]) is None:
+                raise ValueError(
+                    'Cannot delete every token in sentence %d.'
+                    % sentence['id']
+                )
+
+        # Make sure annotations that are about to start following the journal
+        # only address tokens that exist, as their ranges can't be shifted
+        # otherwise.  Annotations already following it are left alone, so
+        # that their spans are only touched once they are read.
+        new_followers = [
+            annotation
+            for annotation_type in doc.annotations
+            for annotation in doc.annotations[annotation_type].values()
+            if not annotation.follows_journal(doc.journal)
+        ]
+        for annotation in new_followers:
+            annotation.map_token_spans(self.check_token_span)
+
+        # Build the new token list
+        new_tokens = list(self.insertions.get(-1, ()))
+        for abs_index, token in enumerate(doc.tokens):
+            if abs_index not in self.deletions:
+                new_tokens.append(token)
+            new_tokens.extend(self.insertions.get(abs_index, ()))
+        doc.tokens = parc_reader.token_list.TokenList(new_tokens)
+
+        # Sentences and annotations follow the document's journal of edits,
+        # so their spans are only shifted once they are next read.  The
+        # sentences' own spans are needed right away though.
+        for sentence in doc.sentences:
+            sentence.follow_journal(doc.journal)
+        for annotation in new_followers:
+            annotation.follow_journal(doc.journal)
+        doc.journal.record(self.new_positions, self.sentence_starts)
+        for sentence in doc.sentences:
+            sentence['token_span'].sync()
+
+        # Rewrite tokens' own addresses
+        doc.refresh_sentence_starts()
+        doc.write_token_ids()
+
+        self.insertions.clear()
+        self.deletions.clear()
+
+
+
 def match_split(text1, text2):
     text1_ = text1.replace("`", "'")
     text2_ = text2.replace("`", "'")
@@ -15,6 +15,7 @@ class Attribution(dict):
         # keys 'source', 'cue', 'content', and 'id'
         super(Attribution, self).__init__()
         self.document = parc_corenlp_document
+        self._heads = {}
         self['id'] = _id
         self['source'] = source if source is not None else []
         self['cue'] = cue if cue is not None else []
@@ -27,6 +28,30 @@ class Attribution(dict):
         return sentence_ids
 
 
+    def get_head(self, role):
+        """
+        Returns the head token of the span for `role` ('source', 'cue', or
+        'content'), or None if it has no head.  The head is remembered, and
+        only looked up again if any of the span's tokens are replaced (or the
+        dependency tree is changed by `interpolate_source_pronouns`).
+        """
+        tokens = self[role]
+        try:
+            cached_tokens, head = self._heads[role]
+            if len(cached_tokens) == len(tokens) and all([
+                cached_token is token
+                for cached_token, token in zip(cached_tokens, tokens)
+            ]):
+                return head
+        except KeyError:
+            pass
+
+        heads = find_head(tokens)
+        head = heads[0] if len(heads) > 0 else None
+        self._heads[role] = (tuple(tokens), head)
+        return head
+
+
     # TODO: This is a bit sketchy because it replaces the token in the
     # attribution's source, and it replaces it in the sentence token list, and
     # it replaces it in the dependency tree, but references to the original
@@ -92,6 +117,9 @@ class Attribution(dict):
 
         self['source'] = new_source
 
+        # Grafting changes the dependency tree, so heads are found again.
+        self._heads.clear()
+
 
     def get_token_substitution(self, token):
 
@@ -138,6 +166,49 @@ class Attribution(dict):
         return not self.__eq__(other)
 
 
+def find_head(tokens):
+    """
+    Finds the heads of a span of tokens: the tokens in the span that are part
+    of the dependency tree, but none of whose parents are in the span.  The
+    span may cross sentences.
+    """
+
+    # If there is only one token, that's the head
+    if len(tokens) == 1:
+        return [tokens[0]]
+
+    try:
+        span_token_ids = {(t['sentence_id'], t['id']) for t in tokens}
+    except KeyError:
+        return []
+
+    # otherwise iterate over all the tokens to find the head
+    heads = []
+    for token in tokens:
+
+        # if this token has no parents or children its not part
+        # of the dependency tree (it's a preposition, e.g.)
+        if 'parents' not in token:
+            continue
+
+        # if this token has any parents among the tokens in the span, it's
+        # not the head!
+        try:
+            has_parent_in_span = any([
+                (parent['sentence_id'], parent['id']) in span_token_ids
+                for relation, parent in token['parents']
+            ])
+        except KeyError:
+            continue
+
+        # otherwise it is the head
+        if not has_parent_in_span:
+            heads.append(token)
+
+    # NOTE: head may be none
+    return heads
+
+
 def graft_to_dependency_tree(token, substitute_token):
     """
     Remove token from the its place in the its dependency tree, and replace it
@@ -1,5 +1,7 @@
 from xml.dom import minidom
+from StringIO import StringIO
 from corenlp_xml_reader import Token
+from parc_reader.parc_xml_writer import escape_xml
 
 
 # This provisional dom is used as an element factory
@@ -34,14 +36,50 @@ class AttributionHtmlSerializer(object):
         This accepts an iterable of Attribution objects, and produces
         an HTML page that visualizes them.
         '''
-        # Make a dom and basic top-level page structure
-        dom, body = cls.prepare_dom()
+        out = StringIO()
+        cls.write_attributions(attributions, out, resolve_pronouns)
+        return out.getvalue()
+
+
+    @classmethod
+    def write_attributions(
+        cls, attributions, out, resolve_pronouns=False, indent='  ',
+        newl='\n'
+    ):
+        '''
+        Writes an HTML page that visualizes the Attribution objects in
+        `attributions` to the file-like object `out`.  The page is written
+        in chunks as each attribution is reached, so no more than one
+        attribution's markup is held in memory at a time.
+        '''
+        out.write('<?xml version="1.0" ?>' + newl)
+        out.write('<html>' + newl)
+        cls.write_head(out, indent, newl)
+
+        body_opened = False
         for attribution in attributions:
-            attribution_element = cls.get_attribution_element(
-                attribution, resolve_pronouns)
-            body.appendChild(attribution_element)
+            if not body_opened:
+                out.write(indent + '<body>' + newl)
+                body_opened = True
+            for chunk in cls.iter_attribution_html(
+                attribution, resolve_pronouns, indent, newl, depth=2
+            ):
+                out.write(chunk)
+
+        if body_opened:
+            out.write(indent + '</body>' + newl)
+        else:
+            out.write(indent + '<body/>' + newl)
+        out.write('</html>' + newl)
 
-        return dom.toprettyxml(indent='  ')
+
+    @classmethod
+    def write_head(cls, out, indent='  ', newl='\n', additional_styling={}):
+        styles = cls.get_style_rules(additional_styling)
+        out.write(indent + '<head>' + newl)
+        out.write('%s<style>%s</style>%s' % (
+            indent * 2, escape_xml('\n' + styles.serialize()), newl))
+        out.write(indent + '</head>' + newl)
 
 
     @classmethod
@@ -49,9 +87,109 @@ class AttributionHtmlSerializer(object):
         cls, attribution, resolve_pronouns=False,
         indent='', newl=' '
     ):
-        attribution_element = cls.get_attribution_element(
-            attribution, resolve_pronouns)
-        return attribution_element.toprettyxml(indent=indent, newl=newl)
+        return ''.join(cls.iter_attribution_html(
+            attribution, resolve_pronouns, indent, newl))
+
+
+    @classmethod
+    def iter_attribution_html(
+        cls, attribution, resolve_pronouns=False, indent='', newl=' ',
+        depth=0
+    ):
+        '''
+        Yields chunks of the markup for one attribution, the same as would
+        be written for the element from `get_attribution_element`.
+        '''
+        # Get the source and cue head so they can be specially highlighted
+        cue_head = cls.get_cue_head(attribution)
+        source_head = cls.get_source_head(attribution)
+
+        # Get the sentences involved in the attribution, and get all their
+        # tokens.
+        tokens = []
+        for sentence in cls.get_sentences(attribution):
+            tokens += sentence['tokens']
+
+        if len(tokens) == 0:
+            yield '%s<div class="attribution"/>%s' % (indent * depth, newl)
+            return
+
+        yield '%s<div class="attribution">%s' % (indent * depth, newl)
+        for token in tokens:
+            roles = cls.get_token_roles(token, attribution)
+
+            # Here we can optionally detect and resolve pronouns
+            if (
+                resolve_pronouns and 'source' in roles
+                and is_substitutable_pronoun(token)
+            ):
+                for chunk in cls.iter_resolved_html(
+                    token, roles, cue_head, source_head, indent, newl,
+                    depth + 1
+                ):
+                    yield chunk
+
+            # But usually we just make the markup for each token
+            else:
+                yield cls.get_token_html(
+                    token, roles, cue_head, source_head, indent, newl,
+                    depth + 1
+                )
+
+        yield '%s</div>%s' % (indent * depth, newl)
+
+
+    @classmethod
+    def get_token_html(
+        cls, token, roles, cue_head=None, source_head=None, indent='',
+        newl=' ', depth=0
+    ):
+        '''
+        The markup for a token, matching that of `make_token_element`.
+        '''
+        return (
+            '%s<span class="%s">%s' % (
+                indent * depth,
+                escape_xml(cls.get_token_class(
+                    token, roles, cue_head, source_head)),
+                newl
+            )
+            + escape_xml(
+                '%s%s%s' % (indent * (depth + 1), token['word'], newl))
+            + '%s<span class="pos">%s' % (indent * (depth + 1), newl)
+            + '%s<span class="pos-inner">%s</span>%s' % (
+                indent * (depth + 2), escape_xml('%s' % token['pos']), newl)
+            + '%s</span>%s' % (indent * (depth + 1), newl)
+            + '%s</span>%s' % (indent * depth, newl)
+        )
+
+
+    @classmethod
+    def iter_resolved_html(
+        cls, token, roles, cue_head=None, source_head=None, indent='',
+        newl=' ', depth=0
+    ):
+        '''
+        Yields the markup for a pronoun, matching that of
+        `make_resolved_element`.
+        '''
+        resolved_tokens = cls.substitute_pronoun_token(token)
+        if resolved_tokens is None:
+            yield cls.get_token_html(
+                token, roles, cue_head, source_head, indent, newl, depth)
+            return
+
+        if len(resolved_tokens) == 0:
+            yield '%s<span class="pronoun"/>%s' % (indent * depth, newl)
+            return
+
+        yield '%s<span class="pronoun">%s' % (indent * depth, newl)
+        for resolved_token in resolved_tokens:
+            yield cls.get_token_html(
+                resolved_token, roles, cue_head, source_head, indent, newl,
+                depth + 1
+            )
+        yield '%s</span>%s' % (indent * depth, newl)
 
 
 
@@ -79,11 +217,13 @@ class AttributionHtmlSerializer(object):
             roles = cls.get_token_roles(token, attribution)
 
             # Here we can optionally detect and resolve pronouns
-            if resolve_pronouns and role == 'source':
-                if is_substitutable_pronoun(token):
-                    resolved_element = cls.make_resolved_element(
-                        token, roles, cue_head, source_head)
-                    attribution_element.appendChild(resolved_element)
+            if (
+                resolve_pronouns and 'source' in roles
+                and is_substitutable_pronoun(token)
+            ):
+                resolved_element = cls.make_resolved_element(
+                    token, roles, cue_head, source_head)
+                attribution_element.appendChild(resolved_element)
 
             # But usually we just make the element for each token
             else:
@@ -138,28 +278,34 @@ class AttributionHtmlSerializer(object):
         return group_element
 
 
+    @classmethod
+    def make_token_element(cls, token, roles, cue_head=None, source_head=None):
+        attrs = {
+            'class': cls.get_token_class(token, roles, cue_head, source_head)
+        }
+        token_element = span(attrs)
+        token_element.appendChild(text(token['word']))
+        pos_element = token_element.appendChild(span({'class':'pos'}))
+        inner_pos_element = pos_element.appendChild(
+            span({'class':'pos-inner'}))
+        inner_pos_element.appendChild(text(token['pos']))
+
+        return token_element
+
+
     @staticmethod
-    def make_token_element(token, roles, cue_head=None, source_head=None):
+    def get_token_class(token, roles, cue_head=None, source_head=None):
 
         # check if element is the cue head or source head, and adjust 
         # token element's class accordingly
         _class = 'token'
         if len(roles) > 0:
             _class += ' ' + ' '.join(['role-%s' % role for role in roles])
-        attrs = {'class':_class}
         if token is cue_head:
-            attrs['class'] += ' cue-head'
+            _class += ' cue-head'
         elif token is source_head:
-            attrs['class'] += ' source-head'
-
-        token_element = span(attrs)
-        token_element.appendChild(text(token['word']))
-        pos_element = token_element.appendChild(span({'class':'pos'}))
-        inner_pos_element = pos_element.appendChild(
-            span({'class':'pos-inner'}))
-        inner_pos_element.appendChild(text(token['pos']))
-
-        return token_element
+            _class += ' source-head'
+        return _class
 
 
     @classmethod
@@ -300,28 +446,28 @@ class AttributionHtmlSerializer(object):
     def get_cue_head(attribution):
         # Find out what the head of the cue span is -- we want to give
         # it it's own styling
-        try:
-            cue_head = attribution.document._find_head(
-                attribution['cue'])[0]
-        except IndexError:
-            cue_head = None
-        return cue_head
+        return attribution.get_head('cue')
 
 
     @staticmethod
     def get_source_head(attribution):
         # Find out what the head of the source span is -- we want to give
         # it it's own styling
-        try:
-            source_head = attribution.document._find_head(
-                attribution['source'])[0]
-        except IndexError:
-            source_head = None
-        return source_head
+        return attribution.get_head('source')
 
 
-    @staticmethod
+    @classmethod
     def get_styles(
+        cls,
+        additional_styling={},
+        show_pos=True,
+    ):
+        # Make a style element
+        return cls.get_style_rules(additional_styling, show_pos).as_element()
+
+
+    @staticmethod
+    def get_style_rules(
         additional_styling={},
         show_pos=True,
     ):
@@ -362,8 +508,7 @@ class AttributionHtmlSerializer(object):
         styles.update(pos_style)
         styles.update(additional_styling)
 
-        # Make a style element
-        return Styler(styles).as_element()
+        return Styler(styles)
 
 
     @classmethod
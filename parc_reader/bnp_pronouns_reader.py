@@ -1,10 +1,13 @@
 import parc_reader
+import bisect
 import os
 import re
+import sys
 import t4k
 import copy
 import bs4
-from collections import defaultdict, Counter
+import multiprocessing
+from collections import defaultdict, deque, Counter
 
 
 BNP_PRONOUNS_PATH = os.path.join(
@@ -20,57 +23,212 @@ PROPBANK_PATH = os.path.join(
 def read_bnp_pronoun_dataset(
     subset='all',
     skip=None,
-    limit=None
+    limit=None,
+    cache=None,
+    workers=None,
+    failures=None
 ):
+    """
+    Read and merge the coreference, entity-type, attribution, and propbank
+    annotations of the documents in `subset` (limited to `skip` and `limit`),
+    returning a dictionary of the merged documents.  See
+    `iter_bnp_pronoun_dataset` for `cache` and `workers`.  Documents that
+    couldn't be created are left out; if a list is given as `failures`,
+    their failure reports are added to it.
+    """
+    merged_annotated_docs = {}
+    for doc_id, doc, failure in iter_bnp_pronoun_dataset(
+        subset, skip, limit, cache, workers
+    ):
+        if failure is not None:
+            if failures is not None:
+                failures.append(failure)
+            continue
+        merged_annotated_docs[doc_id] = doc
 
-    # Read in coreference, entity, and attribution annotations from disk
-    coreference_annotated_docs = read_coreference_annotations(
-        subset=subset, skip=skip, limit=limit)
-    entity_annotated_docs = read_bbn_entity_types(limit=limit)
-    attributions_by_doc = parc_reader.parc_dataset.read_all_parc_files(
-        subset=subset, skip=skip, limit=limit)
-    propbank_verbs_by_doc = read_propbank_verbs()
+    return merged_annotated_docs
 
-    # Prepare to iterate over all docs, combine the three anotation sources for
-    # each, and save them in a dictionary.
-    merged_annotated_docs = {}
-    seen_docs = set()
-    expected_docs = list(
-        parc_reader.parc_dataset.iter_doc_num(subset, skip, limit))
-    for doc_id in expected_docs:
 
-        # Annotations could be missing for any given doc.  Just step over it.
+def iter_bnp_pronoun_dataset(
+    subset='all',
+    skip=None,
+    limit=None,
+    cache=None,
+    workers=None
+):
+    """
+    Yields `(doc_id, merged_doc, failure)` for each document in `subset`
+    (limited to `skip` and `limit`), in order.  The four annotation sources
+    are read in step, one document at a time, into a shard per document (see
+    `iter_shards`), and each shard's annotations are merged as soon as it is
+    read.  Set `workers` to merge documents in that many processes (loading
+    the PARC files that way too).  If a `doc_cache.DocumentCache` is given as
+    `cache`, the indexes of the propbank and BBN pronoun files are kept there.
+
+    Exactly one of `merged_doc` and `failure` is None.  A failure is a
+    dictionary giving the `doc_id`, the `stage` that failed ('load',
+    'merge', or, when merging in a pool, 'transport' if the document
+    couldn't be sent to or back from its worker), the annotation sources
+    that were `missing`, and the `error` raised, if any.
+    """
+    shards = iter_shards(subset, skip, limit, cache, workers)
+    for result in iter_merged_shards(shards, workers):
+        yield result
+
+
+def iter_shards(subset='all', skip=None, limit=None, cache=None, workers=None):
+    """
+    Yields a shard, `(doc_id, missing, annotations)`, for each document in
+    `subset` (limited to `skip` and `limit`), in order.  `annotations` holds
+    the document's coreference, attribution, and entity annotations, and its
+    propbank verbs, or is None if any sources are `missing`.  Each source is
+    read only as far as the document being yielded.
+    """
+    doc_ids = list(parc_reader.parc_dataset.iter_doc_num(subset, skip, limit))
+    if len(doc_ids) == 0:
+        return
+
+    # Only read the range of documents needed from disk
+    parc_docs = parc_reader.parc_dataset.iter_parc_docs(
+        subset=subset, skip=skip, limit=limit, workers=workers)
+    skip, limit = min(doc_ids), max(doc_ids) + 1
+    entity_docs = (
+        (doc.doc_id, doc)
+        for doc in iter_bbn_entity_types(limit=limit, skip=skip)
+    )
+    coreference_docs = iter_coreference_annotations(
+        skip=skip, limit=limit, cache=cache)
+    sources = [
+        ('coreference', DocStream(coreference_docs)),
+        ('attribution', DocStream(parc_docs)),
+        ('entity', DocStream(entity_docs)),
+    ]
+    propbank_verbs_by_doc = PropbankVerbIndex(cache=cache)
+
+    # Annotations could be missing for any given doc.  Those docs are
+    # reported rather than merged.
+    for doc_id in doc_ids:
+        annotations = [docs.pop(doc_id) for name, docs in sources]
+        missing = [
+            name for (name, docs), annotation in zip(sources, annotations)
+            if annotation is None
+        ]
+        if len(missing) > 0:
+            yield doc_id, missing, None
+        else:
+            annotations.append(propbank_verbs_by_doc[doc_id])
+            yield doc_id, missing, annotations
+
+
+def iter_merged_shards(shards, workers=None):
+    """
+    Merge each of `shards` (`(doc_id, missing, annotations)`, where
+    `annotations` is None if any sources are `missing`), yielding
+    `(doc_id, merged_doc, failure)`, in order.  If `workers` is more than
+    one, shards are merged by a pool of that many processes, which reads
+    `shards` as it goes.  Either way, an error raised while reading `shards`
+    is raised here.
+    """
+    if workers is None or workers <= 1:
+        for shard in shards:
+            yield try_merge_shard(shard)
+        return
+
+    # The pool reads shards from its own thread, noting their ids so that
+    # failures can be attributed.  The pool doesn't reliably pass on errors
+    # raised while reading the shards (one raised before the first shard is
+    # lost), so they are kept, and raised here once the shards read so far
+    # are merged.
+    pending_doc_ids = deque()
+    read_errors = []
+    def iter_tasks():
         try:
-            coreference_annotated_doc = coreference_annotated_docs[doc_id]
-            attribution_annotated_doc = attributions_by_doc[doc_id]
-            entity_annotated_doc = entity_annotated_docs[doc_id]
-            propbank_verbs = propbank_verbs_by_doc[doc_id]
-        except KeyError:
-            print 'Could not create doc_id %d' % doc_id
-            continue
+            for shard in shards:
+                pending_doc_ids.append(shard[0])
+                yield shard
+        except Exception:
+            read_errors.append(sys.exc_info())
 
-        # Merge entity-type annotations with coreference annotations.
-        coreference_annotated_doc.merge_tokens(
-            entity_annotated_doc,
-            copy_token_fields=['entity'],
-            copy_annotations=['entities'],
-            verbose=True
-        )
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.imap(try_merge_shard, iter_tasks())
+        while True:
+            try:
+                result = results.next()
+            except StopIteration:
+                if len(read_errors) > 0:
+                    error_type, error, traceback = read_errors[0]
+                    raise error_type, error, traceback
+                break
+
+            # A shard that can't be sent to or returned from a worker (e.g.
+            # because it can't be pickled) fails by itself.
+            except Exception as e:
+                doc_id = pending_doc_ids.popleft()
+                result = (
+                    doc_id, None, make_failure(doc_id, 'transport', error=e))
+            else:
+                pending_doc_ids.popleft()
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
 
-        # Merge the parc-derived annotations (attribution, constituency parse,
-        # and part-of-speech (POS)) with the other annotations.
-        attribution_annotated_doc.merge_tokens(
-            coreference_annotated_doc,
-            copy_token_fields=['entity'],
-            copy_annotations=['entities', 'coreferences']
-        )
 
-        merge_propbank_verbs(attribution_annotated_doc, propbank_verbs)
+def try_merge_shard(shard):
+    """
+    Merges the annotations in one shard for `iter_merged_shards`.  Any
+    failure is caught and reported, so that one bad document can't take down
+    the whole pool.
+    """
+    doc_id, missing, annotations = shard
+    if len(missing) > 0:
+        return doc_id, None, make_failure(doc_id, 'load', missing=missing)
+    try:
+        return doc_id, merge_doc_annotations(*annotations), None
+    except Exception as e:
+        return doc_id, None, make_failure(doc_id, 'merge', error=e)
 
-        merged_annotated_docs[doc_id] = attribution_annotated_doc
-        seen_docs.add(doc_id)
 
-    return merged_annotated_docs
+def make_failure(doc_id, stage, missing=(), error=None):
+    return {
+        'doc_id': doc_id,
+        'stage': stage,
+        'missing': list(missing),
+        'error': None if error is None else repr(error),
+    }
+
+
+def merge_doc_annotations(
+    coreference_annotated_doc,
+    attribution_annotated_doc,
+    entity_annotated_doc,
+    propbank_verbs
+):
+    """
+    Merge one document's annotations onto `attribution_annotated_doc`,
+    which is returned.
+    """
+
+    # Merge entity-type annotations with coreference annotations.
+    coreference_annotated_doc.merge_tokens(
+        entity_annotated_doc,
+        copy_token_fields=['entity'],
+        copy_annotations=['entities'],
+        verbose=True
+    )
+
+    # Merge the parc-derived annotations (attribution, constituency parse,
+    # and part-of-speech (POS)) with the other annotations.
+    attribution_annotated_doc.merge_tokens(
+        coreference_annotated_doc,
+        copy_token_fields=['entity'],
+        copy_annotations=['entities', 'coreferences']
+    )
+
+    merge_propbank_verbs(attribution_annotated_doc, propbank_verbs)
+    return attribution_annotated_doc
 
 
 
@@ -84,10 +242,11 @@ def merge_propbank_verbs(annotated_doc, propbank_verbs):
 
     This works by mutating annotated_doc.
     """
+    lemma_index = LemmaIndex(annotated_doc)
     propbank_verb_tokens = {}
     for verb_id, (sentence_id, token_id, lemma) in enumerate(propbank_verbs):
         token = find_nearest_matching_token(
-            annotated_doc, sentence_id, token_id, lemma)
+            annotated_doc, sentence_id, token_id, lemma, lemma_index)
 
         # It may not be possible to find a match.  Just keep going if so.
         if token is None: 
@@ -103,25 +262,132 @@ def merge_propbank_verbs(annotated_doc, propbank_verbs):
     annotated_doc.annotations['propbank_verbs'] = propbank_verb_tokens
 
 
+class LemmaIndex(object):
+    """
+    Indexes the tokens of an annotated document by their (normalized) lemma,
+    so that the tokens matching a lemma can be found near a given position by
+    binary search, rather than by probing the tokens around it one at a time.
+    Verbs are also indexed by position, to look for near matches among them.
+    """
+
+    def __init__(self, annotated_doc):
+        self.positions = defaultdict(list)
+        self.verb_positions = []
+        for abs_index, token in enumerate(annotated_doc.tokens):
+            self.positions[normalize_lemma(token['lemma'])].append(abs_index)
+            if token['pos'].startswith('VB'):
+                self.verb_positions.append(abs_index)
+
+        self.char_sets = dict([(key, set(key)) for key in self.positions])
+        self.char_counts = {}
+        self.matching_positions = {}
+
+
+    def get_matching_positions(self, lemma):
+        """
+        Returns the sorted positions of tokens whose lemma `is_same_token` as
+        `lemma`.  These are worked out once for each distinct lemma.
+        """
+        if lemma in self.matching_positions:
+            return self.matching_positions[lemma]
+
+        normalized = lemma.replace('`', "'")
+        exact_key = parc_reader.annotated_document.translation(
+            normalized).lower()
+        chars = set(normalized.lower())
+
+        # Besides the exact match, allow lemmas lacking only the letter e.
+        positions = []
+        for key, key_chars in self.char_sets.iteritems():
+            if key == exact_key or chars - key_chars == MISSING_CHARS:
+                positions.extend(self.positions[key])
+        positions.sort()
+
+        self.matching_positions[lemma] = positions
+        return positions
+
+
+    def find_nearest(self, lemma, abs_index, max_distance):
+        """
+        Returns the position of the token nearest `abs_index` whose lemma
+        matches `lemma`, preferring later tokens over earlier ones at the same
+        distance, or None if there is none within `max_distance`.
+        """
+        positions = self.get_matching_positions(lemma)
+        index = bisect.bisect_left(positions, abs_index)
+
+        nearest = None
+        if index < len(positions):
+            nearest = positions[index]
+        if index > 0 and (
+            nearest is None
+            or abs_index - positions[index-1] < nearest - abs_index
+        ):
+            nearest = positions[index-1]
+
+        if nearest is None or abs(nearest - abs_index) > max_distance:
+            return None
+        return nearest
+
+
+    def iter_nearby_verbs(self, abs_index, max_distance):
+        """
+        Yields the positions of verbs within `max_distance` of `abs_index`,
+        working outward, with later tokens before earlier ones at the same
+        distance.
+        """
+        start = bisect.bisect_left(
+            self.verb_positions, abs_index - max_distance)
+        end = bisect.bisect_right(
+            self.verb_positions, abs_index + max_distance)
+        return sorted(
+            self.verb_positions[start:end],
+            key=lambda position: (
+                abs(position - abs_index), position < abs_index)
+        )
+
+
+    def get_char_counts(self, text):
+        if text not in self.char_counts:
+            self.char_counts[text] = Counter(text)
+        return self.char_counts[text]
+
+
+MISSING_CHARS = set('e')
+def normalize_lemma(lemma):
+    return lemma.replace('`', "'").lower()
+
+
 # TODO: compress this functionality.
 MAX_TOKEN_EXACT_MATCH_DISTANCE = 50
 MAX_TOKEN_NEAR_MATCH_DISTANCE = 10
-def find_nearest_matching_token(annotated_doc, sentence_id, token_id, lemma):
+def find_nearest_matching_token(
+    annotated_doc,
+    sentence_id,
+    token_id,
+    lemma,
+    lemma_index=None
+):
     """
     Look for a token having `lemma`, near `(sentence_id, token_id)` in 
     `annotated_doc`.  First, look for an exact match.  If none is found, accept
     the closest match (in terms of number of characters in common overlap).
+    When looking up many tokens in the same document, build a `LemmaIndex`
+    for it once and pass it in.
     """
+    if lemma_index is None:
+        lemma_index = LemmaIndex(annotated_doc)
     try:
         return find_nearest_exact_matching_token(
-            annotated_doc, sentence_id, token_id, lemma)
+            annotated_doc, sentence_id, token_id, lemma, lemma_index)
     except ValueError:
         return find_closest_near_matching_token(
-            annotated_doc, sentence_id, token_id, lemma)
+            annotated_doc, sentence_id, token_id, lemma, lemma_index)
 
 
-def character_overlap(str1, str2):
-    counts1, counts2 = Counter(str1), Counter(str2)
+def character_overlap(str1, str2, counts1=None, counts2=None):
+    counts1 = counts1 or Counter(str1)
+    counts2 = counts2 or Counter(str2)
     overlap_amount = 0
     for c in counts1:
         overlap_amount += min(counts1[c], counts2[c])
@@ -132,7 +398,8 @@ def find_nearest_exact_matching_token(
     annotated_doc,
     sentence_id,
     token_id,
-    lemma
+    lemma,
+    lemma_index=None
 ):
 
     # Absolutize the location that we're expecting the token
@@ -140,38 +407,13 @@ def find_nearest_exact_matching_token(
         [(sentence_id, token_id, token_id+1)]
     )[0][1]
 
-    token_found = False
-    distance = 0
-    while not token_found and distance <= MAX_TOKEN_EXACT_MATCH_DISTANCE:
+    if lemma_index is None:
+        lemma_index = LemmaIndex(annotated_doc)
+    found_token_id = lemma_index.find_nearest(
+        lemma, absolute_token_id, MAX_TOKEN_EXACT_MATCH_DISTANCE)
+    if found_token_id is not None:
+        return annotated_doc.tokens[found_token_id]
 
-        if distance == 6:
-            print annotated_doc.doc_id
-            print lemma
-            print annotated_doc.get_sentence_tokens(sentence_id).text()
-        try:
-            check_token_id = absolute_token_id + distance
-            found_lemma = annotated_doc.tokens[check_token_id]['lemma']
-            if parc_reader.annotated_document.is_same_token(lemma, found_lemma):
-                print 'found at +%d' % check_token_id
-                return annotated_doc.tokens[check_token_id]
-        except IndexError:
-            pass
-
-        check_token_id = absolute_token_id - distance
-        if check_token_id >= 0:
-            try:
-                found_lemma = annotated_doc.tokens[check_token_id]['lemma']
-                is_same_token = parc_reader.annotated_document.is_same_token(
-                    lemma, found_lemma)
-                if is_same_token:
-                    print 'found at +%d' % check_token_id
-                    return annotated_doc.tokens[check_token_id]
-            except IndexError:
-                pass
-
-        distance += 1
-
-    sentence_text = annotated_doc.get_sentence_tokens(sentence_id).text()
     sentence_lemmas = ' '.join([
         t['lemma'] for t in 
         annotated_doc.get_sentence_tokens(sentence_id)
@@ -187,7 +429,8 @@ def find_closest_near_matching_token(
     annotated_doc,
     sentence_id,
     token_id,
-    lemma
+    lemma,
+    lemma_index=None
 ):
 
     # Absolutize the location that we're expecting the token
@@ -195,32 +438,20 @@ def find_closest_near_matching_token(
         [(sentence_id, token_id, token_id+1)]
     )[0][1]
 
-    distance = 0
-    max_overlap = t4k.Max()
-    for distance in range(MAX_TOKEN_NEAR_MATCH_DISTANCE+1):
-
-        try:
-            check_token_id = absolute_token_id + distance
-            check_token = annotated_doc.tokens[check_token_id]
-            if check_token['pos'].startswith('VB'):
-                found_lemma = check_token['lemma']
-                overlap_amount = character_overlap(lemma, found_lemma)
-                max_overlap.add(overlap_amount, check_token_id)
-        except IndexError:
-            pass
-
-        check_token_id = absolute_token_id - distance
-        if check_token_id >= 0:
-            check_token = annotated_doc.tokens[check_token_id]
-            if check_token['pos'].startswith('VB'):
-                found_lemma = annotated_doc.tokens[check_token_id]['lemma']
-                overlap_amount = character_overlap(lemma, found_lemma)
-                max_overlap.add(overlap_amount, check_token_id)
+    if lemma_index is None:
+        lemma_index = LemmaIndex(annotated_doc)
+    lemma_counts = lemma_index.get_char_counts(lemma)
 
-    sentence_lemmas = ' '.join([
-        t['lemma'] for t in 
-        annotated_doc.get_sentence_tokens(sentence_id)
-    ])
+    max_overlap = t4k.Max()
+    for check_token_id in lemma_index.iter_nearby_verbs(
+        absolute_token_id, MAX_TOKEN_NEAR_MATCH_DISTANCE
+    ):
+        found_lemma = annotated_doc.tokens[check_token_id]['lemma']
+        overlap_amount = character_overlap(
+            lemma, found_lemma,
+            lemma_counts, lemma_index.get_char_counts(found_lemma)
+        )
+        max_overlap.add(overlap_amount, check_token_id)
 
     max_overlap_amount, max_overlap_token_id = max_overlap.get()
 
@@ -229,20 +460,23 @@ def find_closest_near_matching_token(
     if max_overlap_token_id is None:
         return None
 
-    token = annotated_doc.tokens[max_overlap_token_id]
-    central_token = annotated_doc.tokens[absolute_token_id]
-    print central_token
-    print ('found max overlap: %.2f %s %s %s: \n\n%s' % (
-        max_overlap_amount, lemma, central_token['lemma'],
-        token['lemma'], sentence_lemmas
-    ))
-    return token
-
+    return annotated_doc.tokens[max_overlap_token_id]
 
 
-def read_propbank_verbs(path=PROPBANK_PATH):
 
+def read_propbank_verbs(path=PROPBANK_PATH, doc_ids=None):
+    """
+    Read the propbank verbs of each document, as lists of
+    `(sentence_id, token_id, lemma)`.  If `doc_ids` are given, only their
+    lines get parsed.
+    """
     propbank_verbs_by_doc = defaultdict(list)
+    if doc_ids is not None:
+        propbank_index = PropbankVerbIndex(path)
+        for doc_id in doc_ids:
+            propbank_verbs_by_doc[doc_id] = propbank_index[doc_id]
+        return propbank_verbs_by_doc
+
     for line in t4k.trimmed_nonblank(open(path)):
         doc_id, sentence_id, token_id, lemma = parse_propbank_line(line)
         propbank_verbs_by_doc[doc_id].append((sentence_id, token_id, lemma))
@@ -250,7 +484,82 @@ def read_propbank_verbs(path=PROPBANK_PATH):
     return propbank_verbs_by_doc
 
 
+class PropbankVerbIndex(object):
+    """
+    Provides the propbank verbs of documents on demand, as lists of
+    `(sentence_id, token_id, lemma)`.  The byte ranges of each document's
+    lines in the propbank file are found in one pass, so that only the lines
+    of documents that are asked for get parsed.  If a `doc_cache.DocumentCache`
+    is given as `cache`, the byte ranges are kept there, so later processes
+    needn't scan the file at all.
+
+    Like the dictionary made by `read_propbank_verbs`, documents having no
+    propbank verbs get an empty list.
+    """
+
+    def __init__(self, path=PROPBANK_PATH, cache=None):
+        self.path = path
+        if cache is None:
+            self.doc_offsets = index_propbank_file(path)
+        else:
+            self.doc_offsets = cache.load(
+                ('propbank-index',), [path], index_propbank_file, path)
+
+
+    def __contains__(self, doc_id):
+        return doc_id in self.doc_offsets
+
+
+    def __getitem__(self, doc_id):
+        return self.get_verbs(doc_id)
+
+
+    def keys(self):
+        return sorted(self.doc_offsets)
+
+
+    def get_verbs(self, doc_id):
+        propbank_verbs = []
+        with open(self.path) as propbank_file:
+            for start, end in self.doc_offsets.get(doc_id, []):
+                propbank_file.seek(start)
+                for line in propbank_file.read(end - start).split('\n'):
+                    line = line.strip()
+                    if line == '':
+                        continue
+                    line_doc_id, sentence_id, token_id, lemma = (
+                        parse_propbank_line(line))
+                    propbank_verbs.append((sentence_id, token_id, lemma))
+
+        return propbank_verbs
+
+
+def index_propbank_file(path=PROPBANK_PATH):
+    """
+    Returns a dictionary of the byte ranges, as lists of `(start, end)`,
+    that hold the lines of each document in the propbank file at `path`.
+    """
+    doc_offsets = defaultdict(list)
+    offset = 0
+    for line in open(path):
+        matched = PROPBANK_DOC_PARSER.match(line)
+        if matched is not None:
+            ranges = doc_offsets[int(matched.group(1))]
+
+            # Lines of a document are usually contiguous, in which case they
+            # extend the document's last byte range.
+            if len(ranges) > 0 and ranges[-1][1] == offset:
+                ranges[-1] = (ranges[-1][0], offset + len(line))
+            else:
+                ranges.append((offset, offset + len(line)))
+
+        offset += len(line)
+
+    return dict(doc_offsets)
 
+
+
+PROPBANK_DOC_PARSER = re.compile('\s*wsj/\d\d/wsj_(\d\d\d\d).mrg ')
 PROPBANK_LINE_PARSER = re.compile(
     'wsj/\d\d/wsj_(\d\d\d\d).mrg (\d+) (\d+) (\w+)')
 def parse_propbank_line(line):
@@ -296,46 +605,117 @@ def verify_mention_tokens(mention, doc):
         assert_text_match(doc.doc_id, mention['id'], expected_text, found_text)
 
 
-def read_bbn_entity_types(entity_types_path=BBN_ENTITY_TYPES_DIR, limit=None):
+def read_bbn_entity_types(
+    entity_types_path=BBN_ENTITY_TYPES_DIR,
+    limit=None,
+    skip=None
+):
     print "Reading BBN entity types.  This will take a minute..."
-    annotated_docs = {}
-    for path in t4k.ls(entity_types_path):
+    return dict([
+        (doc.doc_id, doc) for doc in
+        iter_bbn_entity_types(entity_types_path, limit, skip)
+    ])
 
-        annotated_docs_to_add, hit_limit = parse_bbn_entity_types_file(
-            open(path).read(), limit)
-        annotated_docs.update(annotated_docs_to_add)
+
+def iter_bbn_entity_types(
+    entity_types_path=BBN_ENTITY_TYPES_DIR,
+    limit=None,
+    skip=None
+):
+    """
+    Yields an AnnotatedDocument for each document in the BBN entity-type
+    files, from the one whose id is `skip` up to (but not including)
+    `limit`.  Files are read line by line, and only the documents that get
+    yielded are parsed, one at a time.
+    """
+    for path in t4k.ls(entity_types_path):
+        hit_limit = False
+        with open(path) as entity_file:
+            for doc in iter_entity_type_docs(entity_file, limit, skip):
+                if doc is None:
+                    hit_limit = True
+                    break
+                yield doc
 
         # Stop if we hit the limit
         if hit_limit:
-            return annotated_docs
-
-        # Can stop early for debugging purposes
-        #doc_id = max(annotated_docs.keys())
-        #if limit is not None and doc_id == limit:
-        #    return annotated_docs
+            return
 
-    return annotated_docs
 
-
-
-def parse_bbn_entity_types_file(xml_string, limit=None):
-    xml_string = xml_string.replace(
-        'vic<ENAMEX TYPE="PER_DESC">e pres</ENAMEX>ident',
-        '<ENAMEX TYPE="PER_DESC">vice president</ENAMEX>'
-    )
-    xml_tree = bs4.BeautifulSoup(xml_string, 'xml')
+def parse_bbn_entity_types_file(xml_string, limit=None, skip=None):
     annotated_docs = {}
     hit_limit = False
-    for doc_tag in xml_tree.find_all('DOC'):
-        doc = parse_entity_type_doc(doc_tag)
-        if limit is not None and doc.doc_id >= limit:
+    for doc in iter_entity_type_docs(
+        xml_string.splitlines(True), limit, skip
+    ):
+        if doc is None:
             hit_limit = True
-            return annotated_docs, hit_limit
+            break
         annotated_docs[doc.doc_id] = doc
 
     return annotated_docs, hit_limit
 
 
+def iter_entity_type_docs(lines, limit=None, skip=None):
+    """
+    Parse the documents found in `lines` of a BBN entity-type file, yielding
+    an AnnotatedDocument for each one whose id is in the `skip`-`limit`
+    window.  Documents before `skip` are passed over without being parsed.
+    On reaching a document at or past `limit`, None is yielded, and parsing
+    stops.
+    """
+    for doc_id, doc_xml in iter_entity_type_doc_strings(lines):
+        if limit is not None and doc_id >= limit:
+            yield None
+            return
+        if skip is not None and doc_id < skip:
+            continue
+
+        doc_xml = doc_xml.replace(
+            'vic<ENAMEX TYPE="PER_DESC">e pres</ENAMEX>ident',
+            '<ENAMEX TYPE="PER_DESC">vice president</ENAMEX>'
+        )
+        doc_tag = bs4.BeautifulSoup(doc_xml, 'xml').find('DOC')
+        yield parse_entity_type_doc(doc_tag)
+
+
+DOC_START, DOC_END = '<DOC>', '</DOC>'
+DOCNO_MATCHER = re.compile('<DOCNO>\s*(.*?)\s*</DOCNO>', re.DOTALL)
+def iter_entity_type_doc_strings(lines):
+    """
+    Yields `(doc_id, doc_xml)` for each <DOC> element in `lines`, where
+    `doc_xml` is the element's markup, without parsing it.
+    """
+    doc_lines = None
+    for line in lines:
+        while line:
+
+            # Look for the start of the next document
+            if doc_lines is None:
+                start = line.find(DOC_START)
+                if start < 0:
+                    break
+                doc_lines = []
+                line = line[start:]
+
+            # Accumulate lines until the document ends
+            end = line.find(DOC_END)
+            if end < 0:
+                doc_lines.append(line)
+                break
+
+            end += len(DOC_END)
+            doc_lines.append(line[:end])
+            line = line[end:]
+
+            doc_xml = ''.join(doc_lines)
+            doc_lines = None
+            docno = DOCNO_MATCHER.search(doc_xml)
+            if docno is None:
+                raise ValueError('Document has no DOCNO: "%s".' % doc_xml)
+            yield parse_doc_id(docno.group(1)), doc_xml
+
+
 
 def parse_entity_type_doc(doc_tag):
     doc_id = parse_doc_id(doc_tag.find('DOCNO').text.strip())
@@ -349,28 +729,31 @@ def parse_entity_type_doc(doc_tag):
 
         if is_text_node(child):
             for text in child.strip().split():
-                token = {
+                token = parc_reader.token_list.Token({
                     'text':text,
                     'abs_id': len(tokens),
                     'entity': None
-                }
+                })
                 tokens.append(token)
 
         else:
             entity = parc_reader.spans.Span({
                 'id': len(entities),
-                'entity_type': tuple([child.name] + child['TYPE'].split(':')),
+                'entity_type': tuple([
+                    parc_reader.string_table.intern_string(part) for part in
+                    [child.name] + child['TYPE'].split(':')
+                ]),
                 'text': child.text.strip()
             }, absolute=True)
             entities[entity['id']] = entity
 
             token_ids = []
             for text in entity['text'].split():
-                token = {
+                token = parc_reader.token_list.Token({
                     'text': text, 
                     'entity': entity['id'],
                     'abs_id': len(tokens),
-                }
+                })
                 tokens.append(token)
                 token_ids.append(token['abs_id'])
 
@@ -437,12 +820,40 @@ class AutoIncrementer(object):
         return self.pointer - 1
 
 
-def read_coreference_sentences_from_disk(path=BNP_SENTENCES_PATH, limit=None):
+def read_coreference_sentences_from_disk(
+    path=BNP_SENTENCES_PATH,
+    limit=None,
+    skip=None,
+    use_index=True,
+    cache=None
+):
+    """
+    Read the tokenized sentences of BBN documents, from the one whose id is
+    `skip` up to (but not including) `limit`.  The file is read line by line,
+    and, if `use_index` is True, seeks straight to the first document wanted
+    (see `open_at_doc` for `cache`).
+    """
     print "Reading BBN sentences.  This will take a minute..."
-    documents = {}
+    with open_at_doc(path, skip, use_index, cache) as sentences_file:
+        return parse_coreference_sentences(sentences_file, limit, skip)
+
+
+def parse_coreference_sentences(lines, limit=None, skip=None):
+    """
+    Parse the tokenized sentences of BBN documents from `lines`, keeping
+    those whose id is `skip` up to (but not including) `limit`.
+    """
+    return dict(iter_coreference_sentences(lines, limit, skip))
+
+
+def iter_coreference_sentences(lines, limit=None, skip=None):
+    """
+    Yields `(doc_id, document)` for each document in `lines` whose id is
+    `skip` up to (but not including) `limit`, as soon as it has been read.
+    """
     state = 'root'
     abs_token_id = AutoIncrementer()
-    for i, line in enumerate(open(BNP_SENTENCES_PATH)):
+    for i, line in enumerate(lines):
 
         line = line.rstrip()
         #print '%d\t%s' % (i, repr(line))
@@ -455,13 +866,12 @@ def read_coreference_sentences_from_disk(path=BNP_SENTENCES_PATH, limit=None):
 
                 # Can stop early
                 if limit is not None and doc_id >= limit:
-                    return documents
+                    return
 
                 state = 'in_doc'
                 abs_token_id.reset()
                 new_token_list = parc_reader.token_list.TokenList()
                 document = {'sentences':[], 'tokens':new_token_list}
-                documents[doc_id] = document
 
             else:
                 raise ValueError(
@@ -473,6 +883,8 @@ def read_coreference_sentences_from_disk(path=BNP_SENTENCES_PATH, limit=None):
 
             if line == ')':
                 state = 'root'
+                if skip is None or doc_id >= skip:
+                    yield doc_id, document
 
             elif line.startswith('\tS'):
                 sentence_spec, content = line.lstrip().split(':', 1)
@@ -484,12 +896,12 @@ def read_coreference_sentences_from_disk(path=BNP_SENTENCES_PATH, limit=None):
                     )
 
                 tokens = parc_reader.token_list.TokenList([
-                    {
+                    parc_reader.token_list.Token({
                         'id': i,                        # index within sentence
                         'abs_id': abs_token_id.next(),  # index within doc
                         'sentence_id': sentence_id, 
                         'text': t
-                    }
+                    })
                     for i, t in enumerate(content.lstrip().split())
                 ])
 
@@ -512,8 +924,6 @@ def read_coreference_sentences_from_disk(path=BNP_SENTENCES_PATH, limit=None):
         else:
             raise ValueError('Unexpected state: "%s".' % state)
 
-    return documents
-
 
 WHITESPACE = re.compile('\s+')
 def remove_whitespace(string):
@@ -530,13 +940,22 @@ def read_coreference_annotations(
     path=BNP_PRONOUNS_PATH,
     subset='all',
     skip=None,
-    limit=None
+    limit=None,
+    cache=None
 ):
-    coref_sentences_by_doc = read_coreference_sentences_from_disk(limit=limit)
-    coref_info_by_doc = read_coreference_information_from_disk(limit=limit)
+    doc_ids = list(parc_reader.parc_dataset.iter_doc_num(subset, skip, limit))
+    if len(doc_ids) == 0:
+        return {}
+
+    # Only read the range of documents needed from disk
+    skip, limit = min(doc_ids), max(doc_ids) + 1
+    coref_sentences_by_doc = read_coreference_sentences_from_disk(
+        limit=limit, skip=skip, cache=cache)
+    coref_info_by_doc = read_coreference_information_from_disk(
+        path, limit=limit, skip=skip, cache=cache)
 
     coreference_annotated_docs = {}
-    for doc_id in parc_reader.parc_dataset.iter_doc_num(subset, skip, limit):
+    for doc_id in doc_ids:
 
         try:
             sentences = coref_sentences_by_doc[doc_id]
@@ -557,12 +976,150 @@ def read_coreference_annotations(
     return coreference_annotated_docs
 
 
-def read_coreference_information_from_disk(path=BNP_PRONOUNS_PATH, limit=None):
-    parsed_docs = parse_coreference_annotations(open(path).read(), limit)
+def iter_coreference_annotations(
+    path=BNP_PRONOUNS_PATH,
+    sentences_path=BNP_SENTENCES_PATH,
+    skip=None,
+    limit=None,
+    cache=None
+):
+    """
+    Yields `(doc_id, doc)` for each coreference-annotated document whose id
+    is `skip` up to (but not including) `limit`, in order of id.  The
+    sentence and pronoun files are read in step, one document at a time,
+    starting from `skip` (see `open_at_doc` for `cache`).
+    """
+    with open_at_doc(sentences_path, skip, cache=cache) as sentences_file:
+        with open_at_doc(path, skip, cache=cache) as pronouns_file:
+            coref_infos = DocStream(
+                (doc_id, assemble_doc_coreference_annotations(specs))
+                for doc_id, specs
+                in iter_coreference_specs(pronouns_file, limit, skip)
+            )
+            for doc_id, sentences in iter_coreference_sentences(
+                sentences_file, limit, skip
+            ):
+                coref_info = coref_infos.pop(doc_id)
+                if coref_info is None:
+                    continue
+                coreferences, mentions = coref_info
+                yield doc_id, make_coreference_annotated_text(
+                    sentences['tokens'],
+                    sentences['sentences'],
+                    coreferences,
+                    mentions,
+                    doc_id
+                )
+
+
+class DocStream(object):
+    """
+    Hands out the documents of an iterable of `(doc_id, doc)`, ordered by
+    id, one at a time as they are asked for (in order of id too), without
+    reading further ahead than needed.
+    """
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+        self.next_doc = None
+
+
+    def pop(self, doc_id):
+        """
+        Returns the document having `doc_id`, or None if there isn't one.
+        Documents having smaller ids are passed over.
+        """
+        while self.next_doc is None or self.next_doc[0] < doc_id:
+            try:
+                self.next_doc = self.docs.next()
+            except StopIteration:
+                self.next_doc = None
+                return None
+
+        if self.next_doc[0] != doc_id:
+            return None
+        doc = self.next_doc[1]
+        self.next_doc = None
+        return doc
+
+
+def read_coreference_information_from_disk(
+    path=BNP_PRONOUNS_PATH,
+    limit=None,
+    skip=None,
+    use_index=True,
+    cache=None
+):
+    with open_at_doc(path, skip, use_index, cache) as pronouns_file:
+        parsed_docs = parse_coreference_annotations(
+            pronouns_file, limit, skip)
     annotations_by_doc = assemble_all_coreference_annotations(parsed_docs)
     return annotations_by_doc
 
 
+DOC_OFFSET_INDEXES = {}
+def get_doc_offsets(path, cache=None):
+    """
+    Returns the byte offsets of the documents in the BBN file at `path`, as a
+    list of `(doc_id, offset)` pairs, in file order (see `index_bbn_file`).
+    The index is kept for later calls, until the file gets modified.  If a
+    `doc_cache.DocumentCache` is given as `cache`, the index is kept there
+    too, so later processes needn't scan the file at all.
+    """
+    key = (path, os.path.getmtime(path))
+    if key not in DOC_OFFSET_INDEXES:
+        if cache is None:
+            DOC_OFFSET_INDEXES[key] = index_bbn_file(path)
+        else:
+            DOC_OFFSET_INDEXES[key] = cache.load(
+                ('bbn-doc-offsets',), [path], index_bbn_file, path)
+
+    return DOC_OFFSET_INDEXES[key]
+
+
+def index_bbn_file(path):
+    """
+    Returns the `(doc_id, offset)` pairs of the documents in the BBN file at
+    `path`, found in one pass over the file.  Documents open with a line like
+    "(WSJ0001".
+    """
+    doc_offsets = []
+    offset = 0
+    with open(path) as bbn_file:
+        for line in bbn_file:
+            if line.startswith('('):
+                doc_offsets.append((parse_doc_id(line), offset))
+            offset += len(line)
+    return doc_offsets
+
+
+def open_at_doc(path, skip=None, use_index=True, cache=None):
+    """
+    Open the BBN file at `path`, positioned at the start of the first
+    document whose id is at least `skip`.  If `skip` is None, or `use_index`
+    is False, the file is opened at its start, and earlier documents have to
+    be read past.  The index of documents' offsets can be kept in `cache`
+    (see `get_doc_offsets`).  The caller is responsible for closing the file.
+    """
+    if skip is None or not use_index:
+        return open(path)
+
+    # Seeking relies on documents being in order of id.  The index is read
+    # before the file is opened, so that a failure can't leave it open.
+    doc_offsets = get_doc_offsets(path, cache)
+    doc_ids = [doc_id for doc_id, offset in doc_offsets]
+    bbn_file = open(path)
+    if doc_ids != sorted(doc_ids):
+        return bbn_file
+
+    index = bisect.bisect_left(doc_ids, skip)
+    if index < len(doc_offsets):
+        bbn_file.seek(doc_offsets[index][1])
+    else:
+        bbn_file.seek(0, os.SEEK_END)
+    return bbn_file
+
+
 def assemble_all_coreference_annotations(parsed_docs):
     return {
         doc_id : assemble_doc_coreference_annotations(coreference_specs)
@@ -658,12 +1215,27 @@ def assert_text_match(doc_id, mention_id, expected_text, found_text):
 
 
 
-def parse_coreference_annotations(text_to_parse, limit=None):
+def parse_coreference_annotations(lines, limit=None, skip=None):
+    """
+    Parse the coreference annotations of BBN documents from `lines` (an open
+    file, or any other iterable of lines; a string gets split into lines),
+    keeping those whose id is `skip` up to (but not including) `limit`.
+    """
     print "Reading BBN pronouns.  This will take a minute..."
+    return dict(iter_coreference_specs(lines, limit, skip))
+
+
+def iter_coreference_specs(lines, limit=None, skip=None):
+    """
+    Yields `(doc_id, coreferences)` for each document in `lines` whose id is
+    `skip` up to (but not including) `limit`, as soon as it has been read.
+    """
     state = 'root'
-    documents = {}
 
-    for i, line in enumerate(t4k.skip_blank(text_to_parse.split('\n'))):
+    if isinstance(lines, basestring):
+        lines = lines.split('\n')
+
+    for i, line in enumerate(t4k.skip_blank(lines)):
 
         line = line.rstrip()
 
@@ -674,11 +1246,10 @@ def parse_coreference_annotations(text_to_parse, limit=None):
 
                 # Can stop early for debugging purposes
                 if limit is not None and doc_id >= limit:
-                    return documents
+                    return
 
                 state = 'in_doc'
                 coreferences = []
-                documents[doc_id] = coreferences
 
             else:
                 raise ValueError(
@@ -689,6 +1260,8 @@ def parse_coreference_annotations(text_to_parse, limit=None):
         elif state == 'in_doc':
 
             if line[0] == ')':
+                if skip is None or doc_id >= skip:
+                    yield doc_id, coreferences
                 coreferences = None
                 state = 'root'
 
@@ -730,8 +1303,6 @@ def parse_coreference_annotations(text_to_parse, limit=None):
             'but currently in "%s" state; on line %d.' % (state, i)
         )
 
-    return documents
-
 
 
 def correct_token_offset_error(mention):
@@ -757,7 +1328,8 @@ def parse_mention(line):
     sentence_id, start, stop = parse_location_spec(location_spec)
 
     return parc_reader.spans.Span(
-        mention_type=mention_type.lower(),
+        mention_type=parc_reader.string_table.intern_string(
+            mention_type.lower()),
         sentence_id=sentence_id,
         token_span=[(sentence_id, start, stop)],
         text=text
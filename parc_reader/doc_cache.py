@@ -0,0 +1,248 @@
+'''
+A persistent cache of parsed documents.  Each document is stored as a
+pickled snapshot, and is reused for as long as the files it was parsed from
+are unchanged.
+'''
+
+import os
+import hashlib
+import tempfile
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+CACHE_VERSION = 7
+DEFAULT_MAX_BYTES = 2 * 1024**3
+SNAPSHOT_EXTENSION = '.pkl'
+
+
+class DocumentCache(object):
+    '''
+    Stores parsed documents in `cache_dir`.  A snapshot is keyed by what was
+    loaded (e.g. `('parc', doc_num, include_nested)`) and by the paths of the
+    source files it was parsed from.  Alongside the document, the snapshot
+    records the size, modification time, and content hash of each source file;
+    if any of them have changed, the snapshot is considered stale, and the
+    document is re-parsed.
+
+    The total size of snapshots is kept below `max_bytes` by evicting the
+    least recently used snapshots first.  A running total of their size is
+    kept as snapshots are written, so that the cache directory is only walked
+    when the total goes over `max_bytes`.  (Snapshots written by other
+    processes are only counted once it is walked.)
+    '''
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+        self.total_bytes = None
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+
+    def load(self, key, source_paths, build, *args, **kwargs):
+        '''
+        Get the document identified by `key`, either from its snapshot, or,
+        if there is no fresh snapshot, by calling `build(*args, **kwargs)`,
+        in which case a snapshot of the result is saved.
+        '''
+        snapshot_path = self.get_snapshot_path(key, source_paths)
+        document = self.read_snapshot(snapshot_path, source_paths)
+        if document is not None:
+            return document
+
+        signatures = [get_source_signature(path) for path in source_paths]
+        document = build(*args, **kwargs)
+        self.write_snapshot(snapshot_path, signatures, document)
+        return document
+
+
+    def get_snapshot_path(self, key, source_paths):
+        digest = hashlib.sha1(
+            repr((CACHE_VERSION, key, tuple(source_paths)))).hexdigest()
+        return os.path.join(self.cache_dir, digest + SNAPSHOT_EXTENSION)
+
+
+    def read_snapshot(self, snapshot_path, source_paths):
+        '''
+        Returns the document stored at `snapshot_path` if it is still fresh,
+        otherwise removes the snapshot and returns None.
+        '''
+        try:
+            with open(snapshot_path, 'rb') as snapshot_file:
+                signatures, document = pickle.load(snapshot_file)
+        except IOError:
+            return None
+
+        # Treat a snapshot that can't be read like a stale one.
+        except Exception:
+            self.discard_snapshot(snapshot_path)
+            return None
+
+        fresh_signatures = get_fresh_signatures(signatures, source_paths)
+        if fresh_signatures is None:
+            self.discard_snapshot(snapshot_path)
+            return None
+
+        # If a source file was touched without being changed, record its new
+        # modification time, so that it isn't hashed again on every load.
+        # Rewriting the snapshot also marks it as recently used.
+        if fresh_signatures != signatures:
+            self.write_snapshot(snapshot_path, fresh_signatures, document)
+            return document
+
+        # Mark the snapshot as recently used.  If another process evicted it
+        # in the meantime, treat it as missing.
+        try:
+            os.utime(snapshot_path, None)
+        except OSError:
+            return None
+        return document
+
+
+    def write_snapshot(self, snapshot_path, signatures, document):
+
+        # Write to a temporary file first, so that a partially written
+        # snapshot can never be read.  Its name is unique, so that processes
+        # writing the same snapshot don't write into each other's files.
+        temp_fd, temp_path = tempfile.mkstemp(
+            suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(temp_fd, 'wb') as snapshot_file:
+                pickle.dump(
+                    (signatures, document), snapshot_file,
+                    pickle.HIGHEST_PROTOCOL
+                )
+
+        # Some documents can't be pickled (e.g. their reference structure is
+        # too deep).  They simply don't get cached.
+        except (pickle.PicklingError, RuntimeError, TypeError):
+            self.remove_snapshot(temp_path)
+            return
+        except:
+            self.remove_snapshot(temp_path)
+            raise
+
+        # An older snapshot being replaced no longer counts.
+        replaced_bytes = get_size(snapshot_path)
+        os.rename(temp_path, snapshot_path)
+        self.add_to_total(get_size(snapshot_path) - replaced_bytes)
+
+
+    def add_to_total(self, num_bytes):
+        '''
+        Count a newly written snapshot towards the running total, evicting
+        snapshots if it goes over `max_bytes`.
+        '''
+        if self.total_bytes is None:
+            self.evict()
+        else:
+            self.total_bytes = max(0, self.total_bytes + num_bytes)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+
+    def discard_snapshot(self, snapshot_path):
+        '''
+        Remove a stale or unreadable snapshot, taking it off the running
+        total.
+        '''
+        num_bytes = get_size(snapshot_path)
+        self.remove_snapshot(snapshot_path)
+        if self.total_bytes is not None:
+            self.total_bytes = max(0, self.total_bytes - num_bytes)
+
+
+    def remove_snapshot(self, snapshot_path):
+        try:
+            os.remove(snapshot_path)
+        except OSError:
+            pass
+
+
+    def iter_snapshots(self):
+        '''
+        Yields `(last_used, size, path)` for every snapshot in the cache.
+        '''
+        for fname in os.listdir(self.cache_dir):
+            if not fname.endswith(SNAPSHOT_EXTENSION):
+                continue
+            path = os.path.join(self.cache_dir, fname)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            yield stat.st_mtime, stat.st_size, path
+
+
+    def evict(self):
+        '''
+        Remove the least recently used snapshots until the cache fits within
+        `max_bytes`.
+        '''
+        snapshots = sorted(self.iter_snapshots())
+        total_bytes = sum(size for last_used, size, path in snapshots)
+        for last_used, size, path in snapshots:
+            if total_bytes <= self.max_bytes:
+                break
+            self.remove_snapshot(path)
+            total_bytes -= size
+        self.total_bytes = total_bytes
+
+
+    def clear(self):
+        for last_used, size, path in list(self.iter_snapshots()):
+            self.remove_snapshot(path)
+        self.total_bytes = 0
+
+
+
+def get_source_signature(path):
+    '''
+    Returns `(path, size, mtime, sha1)` for the file at `path`.
+    '''
+    sha1 = hash_file(path)
+    stat = os.stat(path)
+    return path, stat.st_size, stat.st_mtime, sha1
+
+
+def get_size(path):
+    '''
+    Returns the size of the file at `path`, or 0 if there is no such file.
+    '''
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def get_fresh_signatures(signatures, source_paths):
+    '''
+    Check that the source files recorded in `signatures` still match those on
+    disk.  Returns the signatures, with the current modification times, or
+    None if any file has changed.  The content hash is only recomputed when
+    the modification time of a file has changed (but not its size).
+    '''
+    if [signature[0] for signature in signatures] != list(source_paths):
+        return None
+
+    fresh_signatures = []
+    for path, size, mtime, sha1 in signatures:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        if stat.st_size != size:
+            return None
+        if stat.st_mtime != mtime and hash_file(path) != sha1:
+            return None
+        fresh_signatures.append((path, size, stat.st_mtime, sha1))
+
+    return fresh_signatures
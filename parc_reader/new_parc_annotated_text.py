@@ -2,6 +2,13 @@ from parc_reader.parc_sentence import ParcSentence
 import parc_reader
 from bs4 import BeautifulSoup as Soup
 from collections import defaultdict
+from io import BytesIO
+from xml.sax.saxutils import unescape as unescape_xml
+import re
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
 from brat_reader import BratAnnotatedText
 
 ROLES = {'cue', 'content', 'source'}
@@ -11,7 +18,7 @@ def new_annotation():
 
 
 
-def read_parc_file(parc_xml, doc_id=None, include_nested=False):
+def read_parc_file(parc_xml, doc_id=None, include_nested=False, engine='soup'):
     """
     This reads in annotation information from parc xml files.  
     It includes the following annotations:
@@ -25,30 +32,206 @@ def read_parc_file(parc_xml, doc_id=None, include_nested=False):
     Because it carries it's own alignment of annotations onto tokens, it
     can be combined with annotations whose opinion on tokenization differs
     slightly, as long as some effort to reconcile tokens is made. 
+
+    Two parse engines are available.  The default, `'soup'`, builds a full
+    BeautifulSoup tree for the file.  `'iterparse'` streams the file through
+    an incremental xml parser, and discards each sentence's xml once it has
+    been parsed, so that memory is bounded by the largest sentence rather than
+    the whole file.  Both engines produce the same document.
     """
-    soup = Soup(parc_xml, 'html.parser')
-    sentence_wrapper_tags = soup.find_all('sentence')
     annotated_doc = parc_reader.annotated_document.AnnotatedDocument(
         doc_id=doc_id)
+
+    if engine == 'soup':
+        all_attributions = parse_parc_soup(
+            parc_xml, annotated_doc, include_nested)
+    elif engine == 'iterparse':
+        all_attributions = parse_parc_stream(
+            parc_xml, annotated_doc, include_nested)
+    else:
+        raise ValueError(
+            'Unknown parse engine "%s".  Expected one of %s.'
+            % (engine, ', '.join(PARSE_ENGINES))
+        )
+
+    # Assemble attribution fragments and use sentence-relative addressing
+    attributions = stitch_attributions(all_attributions, annotated_doc)
+    annotated_doc.annotations['attributions'] = attributions
+
+    # Make non-sentence constituents use sentence-relative addressing
+    annotated_doc.relativize_spans([
+        constituent['token_span']
+        for sentence in annotated_doc.sentences
+        for child in sentence['constituent_children']
+        for depth, constituent in parc_reader.spans.get_dfs_constituents(child)
+    ])
+
+    return annotated_doc
+
+
+PARSE_ENGINES = ('soup', 'iterparse')
+
+
+def parse_parc_soup(parc_xml, annotated_doc, include_nested=False):
+    """
+    Parse the sentences of `parc_xml` into `annotated_doc` by building a
+    BeautifulSoup tree and walking it recursively.  Returns the attribution
+    fragments found on tokens.
+    """
+    soup = Soup(parc_xml, 'html.parser')
+    sentence_wrapper_tags = soup.find_all('sentence')
     all_attributions = []
-    #print 'doc_id', doc_id
-    for sentence_id, sentence_wrapper_tag in enumerate(sentence_wrapper_tags):
+    for sentence_wrapper_tag in sentence_wrapper_tags:
         real_sentence_tag = parc_reader.utils.first_non_text_child(
             sentence_wrapper_tag)
         sentence, attributions = recursively_parse(
             real_sentence_tag, annotated_doc, include_nested=include_nested)
         all_attributions.extend(attributions)
 
-    # Assemble attribution fragments and use sentence-relative addressing
-    attributions = stitch_attributions(all_attributions, annotated_doc)
-    annotated_doc.annotations['attributions'] = attributions
+    return all_attributions
 
-    # Make non-sentence constituents use sentence-relative addressing
-    for sentence in annotated_doc.sentences:
-        for child in sentence['constituent_children']:
-            child.relativize(annotated_doc)
 
-    return annotated_doc
+def parse_parc_stream(parc_xml, annotated_doc, include_nested=False):
+    """
+    Parse the sentences of `parc_xml` into `annotated_doc` using an
+    incremental xml parser.  Constituents are built bottom-up as their end
+    tags are reached, mirroring what `recursively_parse` does on the soup
+    tree.  Returns the attribution fragments found on tokens.
+    """
+    if isinstance(parc_xml, unicode):
+        parc_xml = parc_xml.encode('utf8')
+
+    all_attributions = []
+
+    # Open constituents of the current sentence, as (node, attributions,
+    # token_ranges) triples
+    stack = []
+    root = None
+    in_sentence = False
+    sentence_done = False
+    word_depth = 0
+    ignore_depth = 0
+
+    events = ElementTree.iterparse(BytesIO(parc_xml), events=('start', 'end'))
+    try:
+        for event, elem in events:
+            tag_name = elem.tag.lower()
+
+            if root is None:
+                root = elem
+
+            if event == 'start':
+
+                # Anything inside a <word> is handled when the word closes.
+                # Anything after the real sentence tag is ignored, as is done
+                # when parsing the soup.
+                if word_depth or ignore_depth:
+                    word_depth += bool(word_depth)
+                    ignore_depth += bool(ignore_depth)
+
+                elif not in_sentence:
+                    if tag_name == 'sentence':
+                        in_sentence = True
+                        sentence_done = False
+
+                elif sentence_done:
+                    ignore_depth = 1
+
+                elif tag_name == 'word' and stack:
+                    word_depth = 1
+
+                elif tag_name == 'attribution' and stack:
+                    raise ValueError(
+                        'Got <attribution> tag.  Expecting a constituency tag.')
+
+                elif tag_name == 'attribution' or tag_name == 'word':
+                    raise ValueError(
+                        'Expected non-token constituency tag.  Got <%s>.'
+                        % tag_name
+                    )
+
+                else:
+                    node = parc_reader.spans.Constituency({
+                        'constituent_type':
+                            parc_reader.string_table.intern_string(tag_name)
+                    }, absolute=True, **lower_keys(elem.attrib))
+                    stack.append((node, [], []))
+
+                continue
+
+            # Handle end events
+            if ignore_depth:
+                ignore_depth -= 1
+
+            elif word_depth:
+                word_depth -= 1
+                if word_depth == 0:
+                    node, attributions, token_ranges = stack[-1]
+                    token = make_token(
+                        lower_keys(elem.attrib),
+                        iter_attribution_elements(elem),
+                        include_nested
+                    )
+                    attributions.extend(add_child_token(
+                        node, token, annotated_doc, token_ranges))
+
+            elif not in_sentence:
+                pass
+
+            elif tag_name == 'sentence' and not stack:
+                in_sentence = False
+                root.clear()
+
+            else:
+                node, attributions, token_ranges = stack.pop()
+                node['token_span'].assign_consolidated(token_ranges)
+
+                # This is the real sentence tag.
+                if not stack:
+                    annotated_doc.add_sentence(node)
+                    all_attributions.extend(attributions)
+                    sentence_done = True
+                    continue
+
+                # Refuse children that are <none> tags, or that themselves
+                # have no children, despite not being tokens.
+                if node['constituent_type'] == 'none':
+                    continue
+                if len(node['constituent_children']) == 0:
+                    continue
+
+                parent, parent_attributions, parent_ranges = stack[-1]
+                for token_range in token_ranges:
+                    parc_reader.spans.append_range(parent_ranges, token_range)
+                parent['constituent_children'].append(node)
+                parent_attributions.extend(attributions)
+
+    except ElementTree.ParseError as e:
+        raise ValueError('Could not parse parc xml: %s' % str(e))
+
+    return all_attributions
+
+
+def lower_keys(attrs):
+    """
+    Lowercase xml attribute names, matching what the html parser used for the
+    soup does.
+    """
+    return dict((key.lower(), value) for key, value in attrs.items())
+
+
+def iter_attribution_elements(word_elem):
+    """
+    Yields `(attribution_id, roles)` for each <attribution> element under an
+    ElementTree <word> element.
+    """
+    for attr_elem in word_elem:
+        attrs = lower_keys(attr_elem.attrib)
+        roles = [
+            lower_keys(role_elem.attrib)['rolevalue'] for role_elem in attr_elem
+            if role_elem.tag.lower() == 'attributionrole'
+        ]
+        yield attrs['id'], roles
 
 
 
@@ -69,7 +252,10 @@ def stitch_attributions(attribution_specs, annotated_doc):
     for attribution in attributions.values():
         for role in attribution.ROLES:
             attribution[role].consolidate()
-        attribution.relativize(annotated_doc)
+    annotated_doc.relativize_spans([
+        attribution[role] for attribution in attributions.values()
+        for role in attribution.ROLES
+    ])
 
     return attributions
 
@@ -88,11 +274,14 @@ def recursively_parse(tag, annotated_doc, depth=0, include_nested=True):
     # Each constituent is modelled as a span that has direct references to its
     # children.  Then need to be modelled as absolute spans at first.
     node = parc_reader.spans.Constituency({
-        'constituent_type': node_type
+        'constituent_type': parc_reader.string_table.intern_string(node_type)
     }, absolute=True, **tag.attrs)
 
-    # We'll capture attributions from children
+    # We'll capture attributions from children.  Tokens are added to the
+    # document in order, so the node's token ranges can be built up in order
+    # too, and assigned to its span, already consolidated, once it's parsed.
     attributions = []
+    token_ranges = []
 
     # Parse the children
     for child_tag in parc_reader.utils.non_text_children(tag):
@@ -108,26 +297,8 @@ def recursively_parse(tag, annotated_doc, depth=0, include_nested=True):
         # Handle parsing child tokens
         elif child_tag.name.lower() == 'word':
             child_node = parse_token(child_tag, include_nested)
-            child_node['sentence_id'] = len(annotated_doc.sentences)
-            child_attributions = child_node['attributions']
-
-            abs_id = annotated_doc.add_token(child_node)
-            token_pointer = (None, abs_id, abs_id+1)
-            for attribution in child_attributions:
-                attribution['token_span'].add_token_range(token_pointer)
-            node['token_span'].add_token_range(token_pointer)
-
-            # As usual, we only want to provide a pointer to tokens, but for
-            # consistency in traversing the constituency tree, the token should
-            # appear in the node's constituent_children list.  We provide only
-            # a stub to create the link
-            node['constituent_children'].append(
-                parc_reader.spans.Constituency({
-                    'constituent_type': 'token',
-                    'sentence_id': len(annotated_doc.sentences),
-                    'token_span': [(None, abs_id, abs_id+1)]
-                }, absolute=True)
-            )
+            child_attributions = add_child_token(
+                node, child_node, annotated_doc, token_ranges)
 
         # Handle parsing child internal constituency nodes
         else:
@@ -143,18 +314,50 @@ def recursively_parse(tag, annotated_doc, depth=0, include_nested=True):
             if len(child_node['constituent_children']) == 0:
                 continue
 
-            node['token_span'].add_token_ranges(child_node['token_span'])
+            for token_range in child_node['token_span']:
+                parc_reader.spans.append_range(token_ranges, token_range)
             node['constituent_children'].append(child_node)
 
         attributions.extend(child_attributions)
 
-    node['token_span'].consolidate()
+    node['token_span'].assign_consolidated(token_ranges)
     if depth == 0:
         annotated_doc.add_sentence(node)
 
     return node, attributions
 
 
+def add_child_token(node, token, annotated_doc, token_ranges):
+    """
+    Add a freshly parsed token to the document, and link it as a child of the
+    constituency `node`, appending its position to `token_ranges`, which
+    collects the node's span.  Returns the token's attribution fragments, now
+    pointing at the token's absolute position.
+    """
+    token['sentence_id'] = len(annotated_doc.sentences)
+    token_attributions = token['attributions']
+
+    abs_id = annotated_doc.add_token(token)
+    token_pointer = (None, abs_id, abs_id+1)
+    for attribution in token_attributions:
+        attribution['token_span'].add_token_range(token_pointer)
+    parc_reader.spans.append_range(token_ranges, token_pointer)
+
+    # As usual, we only want to provide a pointer to tokens, but for
+    # consistency in traversing the constituency tree, the token should
+    # appear in the node's constituent_children list.  We provide only
+    # a stub to create the link
+    node['constituent_children'].append(
+        parc_reader.spans.Constituency({
+            'constituent_type': 'token',
+            'sentence_id': len(annotated_doc.sentences),
+            'token_span': [(None, abs_id, abs_id+1)]
+        }, absolute=True)
+    )
+
+    return token_attributions
+
+
 def parse_token(tag, include_nested=True):
     """
     Base case of the recursive parsing of parc xml.  Parsing of a token.
@@ -166,34 +369,56 @@ def parse_token(tag, include_nested=True):
     if tag_name != 'word':
         raise ValueError('Expecting a <word> tag, but got <%s>' % tag_name)
 
+    attribution_specs = [
+        (attr_tag['id'], get_attribution_roles(attr_tag))
+        for attr_tag in parc_reader.utils.non_text_children(tag)
+    ]
+    return make_token(tag.attrs, attribution_specs, include_nested)
+
+
+def make_token(attrs, attribution_specs, include_nested=True):
+    """
+    Build a token from its (lowercased) xml attributes, and the
+    `(attribution_id, roles)` pairs found under its <word> tag.
+    """
+
     # We're building a leaf node in the constituency parse; a *token*.
-    node = {'is_token': True}
-    node.update(tag.attrs)
+    node = parc_reader.token_list.Token(attrs)
     node['is_token'] = True
 
     # Correct an inconsistency in WSJ document 4 of PTB2
-    if tag['gorn'].split(',')[0] == '1':
+    if attrs['gorn'].split(',')[0] == '1':
         if node['text'] == 'IBC/Donoghue':
             node['text'] = 'IBC'
 
     # Tokens don't have children in the constituency parse, but the attribution
-    # annotations appear as children in the xml.
-    node['attributions'] = []
+    # annotations appear as children in the xml.  Most tokens have none, and
+    # share an empty tuple.
+    attributions = []
 
     # Parse any attribution tags.  Ignore nested ones if desired.
-    for attr_tag in parc_reader.utils.non_text_children(tag):
-        attribution = parse_attribution(attr_tag)
+    for attr_id, roles in attribution_specs:
+        attribution = make_attribution(attr_id, roles)
         if not include_nested and 'Nested' in attribution['id']:
             continue
-        node['attributions'].append(attribution)
+        attributions.append(attribution)
 
+    node['attributions'] = attributions or ()
     return node
 
 
 def parse_attribution(tag):
+    return make_attribution(tag['id'], get_attribution_roles(tag))
+
+
+def get_attribution_roles(tag):
+    return [role_tag['rolevalue'] for role_tag in tag('attributionrole')]
+
+
+def make_attribution(attr_id, roles):
     return parc_reader.spans.Span({
-        'id': tag['id'],
-        'roles': [role_tag['rolevalue'] for role_tag in tag('attributionrole')]
+        'id': attr_id,
+        'roles': [parc_reader.string_table.intern_string(r) for r in roles]
     }, absolute=True)
 
 
@@ -208,39 +433,137 @@ def get_attributions(parc_xml, include_nested=False):
     raw text where tokenization is based on spaces and sentences are based on
     newlines, and the CoreNLP annotations were generated in respect of this.
     """
+    word_offsets, attributions = scan_parc_xml(
+        parc_xml, include_nested, read_offsets=False)
+    return attributions
+
 
-    # Our main concern is to build attributions, including their 
-    # associations to tokens and sentences
+
+def get_offsets_and_attributions(parc_xml, include_nested=False):
+    """
+    Reads both the character offsets of every word, and the attribution
+    relations (as provided by `get_attributions`) from parc xml, parsing it
+    only once.  Word offsets are returned as a list of `(start, end)` tuples,
+    in document order.
+    """
+    return scan_parc_xml(parc_xml, include_nested)
+
+
+
+# Matches any start, end, or self-closing tag.  Attribute values are matched
+# as quoted strings so that a literal ">" inside one doesn't end the tag.
+TAG_MATCHER = re.compile(
+    r'''<(/?)([A-Za-z][\w.:-]*)((?:[^>"']|"[^"]*"|'[^']*')*)>''')
+# Attribute names are anchored on whitespace, so that e.g. `id` doesn't match
+# the end of `data-id`.
+ATTRIBUTE_MATCHERS = {
+    name: re.compile(
+        r'''(?:^|\s)%s\s*=\s*(?:"([^"]*)"|'([^']*)')''' % name,
+        re.IGNORECASE
+    )
+    for name in ['bytecount', 'id', 'rolevalue']
+}
+CHARACTER_REFERENCE_MATCHER = re.compile(r'&#(?:(\d+)|[xX]([0-9a-fA-F]+));')
+def scan_parc_xml(parc_xml, include_nested=False, read_offsets=True):
+    """
+    Scans parc xml in a single forward pass over its tags, without building
+    any tree, and collects the attribution relations in the same form as
+    `get_attributions`.  Only <sentence>, <word>, <attribution> and
+    <attributionRole> tags are looked at, and only their `ByteCount`, `id`,
+    and `roleValue` attributes are read.  If `read_offsets` is True, the
+    `(start, end)` offsets of every word are collected too (otherwise an empty
+    list is returned in their place).
+    """
     attributions = defaultdict(new_annotation)
+    word_offsets = []
+
+    sentence_id = -1
+    word_id = -1
+    in_sentence = False
+    in_word = False
+    in_attribution = False
+    attribution = None
+
+    for match in TAG_MATCHER.finditer(parc_xml):
+        is_end, tag_name, attrs_text = match.groups()
+        tag_name = tag_name.lower()
+        is_self_closing = attrs_text.endswith('/')
+
+        if tag_name == 'sentence':
+            if is_end:
+                in_sentence = False
+            else:
+                sentence_id += 1
+                word_id = -1
+                in_sentence = not is_self_closing
+
+        elif not in_sentence:
+            continue
 
-    # Parse the xml.
-    soup = Soup(parc_xml, 'html.parser')
+        elif tag_name == 'word':
+            if is_end:
+                in_word = False
+                continue
+            word_id += 1
+            in_word = not is_self_closing
+            if read_offsets:
+                word_offsets.append(parse_byte_count(
+                    get_scanned_attribute(attrs_text, 'bytecount')))
 
-    # Iterate through sentence / token tags, and find attribution tags
-    sentence_tags = soup.find_all('sentence')
-    for sentence_id, sentence_tag in enumerate(sentence_tags):
-        word_tags = sentence_tag.find_all('word')
-        for word_id, word_tag in enumerate(word_tags):
+        elif not in_word:
+            continue
 
-            attribution_tags = word_tag.find_all('attribution')
-            for attribution_tag in attribution_tags:
+        elif tag_name == 'attribution':
+            if is_end:
+                in_attribution = False
+                continue
+            in_attribution = not is_self_closing
+
+            # Include nested attributions only if desired.  Either way, get
+            # the attribution this word's roles should be added to.
+            attr_id = get_scanned_attribute(attrs_text, 'id')
+            if not include_nested and 'Nested' in attr_id:
+                attribution = None
+            else:
+                attribution = attributions[attr_id]
+
+        elif tag_name == 'attributionrole':
+            if is_end or not in_attribution or attribution is None:
+                continue
 
-                # Include nested attributions only if desired
-                if not include_nested and 'Nested' in attribution_tag['id']:
-                    continue
+            # Note this token's role in the attribution, and note this
+            # sentence's involvment in the attribution.
+            role = get_scanned_attribute(attrs_text, 'rolevalue')
+            attribution[role].append((sentence_id, word_id))
+            attribution['sentences'].add(sentence_id)
 
-                # Get / create an attribution object for this attribution
-                attribution = attributions[attribution_tag['id']]
+    return word_offsets, attributions
 
-                # Note this token's role in the attribution, and note this
-                # sentence's involvment in the attribution.
-                role_tags = attribution_tag.find_all('attributionrole')
-                roles = [role_tag['rolevalue'] for role_tag in role_tags]
-                for role in roles:
-                    attribution[role].append((sentence_id, word_id))
-                    attribution['sentences'].add(sentence_id)
 
-    return attributions
+def get_scanned_attribute(attrs_text, name):
+    match = ATTRIBUTE_MATCHERS[name].search(attrs_text)
+    if match is None:
+        raise ValueError(
+            'Expected a "%s" attribute in tag: <%s>' % (name, attrs_text))
+    double_quoted, single_quoted = match.groups()
+    value = double_quoted if double_quoted is not None else single_quoted
+    if '&' in value:
+        value = CHARACTER_REFERENCE_MATCHER.sub(
+            unescape_character_reference, value)
+        value = unescape_xml(value, {'&quot;': '"', '&apos;': "'"})
+    return value
+
+
+def unescape_character_reference(match):
+    decimal, hexadecimal = match.groups()
+    if decimal is not None:
+        return unichr(int(decimal))
+    return unichr(int(hexadecimal, 16))
+
+
+def parse_byte_count(byte_count):
+    start, stop = byte_count.split(',')
+    return int(start), int(stop)
 
 
 
@@ -1,15 +1,16 @@
 from collections import defaultdict
-from xml.dom import minidom
-from parc_reader.utils import get_spans
-from parc_reader.attribution import Attribution
+from bisect import bisect_left
+from StringIO import StringIO
+from parc_reader.utils import get_spans, align_paragraphs
+from parc_reader.attribution import Attribution, find_head
+from parc_reader.parc_xml_writer import write_parc_xml
 from corenlp_xml_reader.annotated_text import (
     AnnotatedText as CorenlpAnnotatedText, Token
 )
 from attribution_html_serializer import AttributionHtmlSerializer
 from parc_reader.new_parc_annotated_text import (
-    get_attributions, get_attributions_from_brat)
+    get_attributions, get_attributions_from_brat, get_offsets_and_attributions)
 import re
-from bs4 import BeautifulSoup as Soup
 
 
 ROLES = {'cue', 'content', 'source'}
@@ -41,6 +42,9 @@ class ParcCorenlpReader(object):
         # Own the raw text
         self.raw_txt = raw_txt
 
+        # Lookup of tokens by their character offsets, built when needed
+        self._token_offset_index = None
+
         # Construct the corenlp datastructure.  
         self.core = CorenlpAnnotatedText(
             corenlp_xml, aida_json, **corenlp_options
@@ -59,20 +63,28 @@ class ParcCorenlpReader(object):
 
         # If a parc_xml file was provided, either as a source of attributions
         # or for the expressed purpose of alignment, adopt the tokens'
-        # character offsets from parc
+        # character offsets from parc.  When it serves both purposes, only
+        # parse it once.
         align_to_parc = align_to_parc or parc_xml
-        if align_to_parc:
-            self.align_to_parc(align_to_parc)
+        if parc_xml is not None and align_to_parc is parc_xml:
+            word_offsets, attributions = get_offsets_and_attributions(parc_xml)
+            self.adopt_offsets(word_offsets)
+            self.merge(attributions)
+
+        else:
+            if align_to_parc:
+                self.align_to_parc(align_to_parc)
 
-        # Get attribution information from the parc file now (if provided)
-        if parc_xml is not None:
-            self.merge_parc(parc_xml)
+            # Get attribution information from the parc file now (if provided)
+            if parc_xml is not None:
+                self.merge_parc(parc_xml)
 
         # Get attribution information from the Brat file (if provided)
         if brat_path is not None:
             self.merge_brat(brat_path)
 
         # Determine where paragraph breaks should go (if raw text provided)
+        self._paragraphs = None
         if self.raw_txt is not None:
             self.delineate_paragraphs()
 
@@ -82,17 +94,19 @@ class ParcCorenlpReader(object):
 
 
     def align_to_parc(self, parc_xml):
+        word_offsets, attributions = get_offsets_and_attributions(parc_xml)
+        self.adopt_offsets(word_offsets)
+
+
+    def adopt_offsets(self, word_offsets):
 
         # Iterate through tokens adopting the start-end positions from parc
-        soup = Soup(parc_xml, 'html.parser')
-        zipped_tokens = zip(self.core.tokens, soup.find_all('word'))
-        for core_token, parc_token_tag in zipped_tokens:
-            start, stop = parc_token_tag['bytecount'].split(',')
-            start, stop = int(start), int(stop)
+        for core_token, (start, stop) in zip(self.core.tokens, word_offsets):
             core_token['character_offset_begin'] = start
             core_token['character_offset_end'] = stop
 
         self.core.refresh_token_offsets()
+        self._token_offset_index = None
 
 
 
@@ -109,120 +123,52 @@ class ParcCorenlpReader(object):
             self.attributions.values(), resolve_pronouns)
 
 
-    def get_parc_xml(self, indent='  '):
-        xml_dom = self.create_xml_dom()
-        return xml_dom.toprettyxml(indent=indent)
-
-
-    def create_xml_dom(self):
-
-        # Make a document and a root element
-        doc = minidom.Document()
-        root = doc.createElement('root')
-        doc.appendChild(root)
-
-        # Make an element for every sentence tag
-        gorn = 0
-        word = 0
-        for sentence in self.sentences:
+    def get_parc_xml(self, indent='  ', pretty=True):
+        out = StringIO()
+        self.write_parc_xml(out, indent=indent, pretty=pretty)
+        return out.getvalue()
 
-            sentence_word = 0    # keeps track of token index w/in sentence
 
-            # First get the top (sentence) tag (bypass the root tag)
-            sentence_constituent = sentence['c_root']['c_children'][0]
-
-            # Recursively build the sentence tag (with all constituent
-            # and word tags)
-            root_sentence_xml_tag = doc.createElement('SENTENCE')
-            root_sentence_xml_tag.setAttribute('gorn', str(gorn))
-            sentence_xml_tag, word, sentence_word = self.create_sentence_tag(
-                doc, sentence_constituent, word=word, 
-                sentence_word=sentence_word, gorn_trail=(), gorn=gorn
-            )
-            root_sentence_xml_tag.appendChild(sentence_xml_tag)
-            gorn += 1
-
-            # Append the sentence tag to the growing document
-            root.appendChild(root_sentence_xml_tag)
-
-        return doc
-
-
-    def create_sentence_tag(
-        self,
-        doc,
-        constituent,
-        word=0,
-        sentence_word=0,
-        gorn_trail=(),
-        gorn=0
-    ):
-
-        # Is this a compund constituent, or a token?
-        is_token = False
-        if len(constituent['c_children']) == 0:
-            is_token = True
-
-        # Create the xml tag for this constituent
-        if is_token:
-            element = doc.createElement('WORD')
-            element.setAttribute(
-                'ByteCount', '%s,%s' % (
-                constituent['character_offset_begin'],
-                constituent['character_offset_end'])
-            )
-            element.setAttribute('lemma', constituent['lemma'])
-            element.setAttribute('pos', constituent['pos'])
-            element.setAttribute('text', constituent['word'])
-            element.setAttribute('gorn', self.gorn_str(gorn_trail, gorn))
-            element.setAttribute('word', str(word))
-            element.setAttribute('sentenceWord', str(sentence_word))
-            word += 1
-            sentence_word += 1
-
-            # A token can be involved in multiple attributions
-            for attr_id in constituent['attributions']:
-
-                attribution = element.appendChild(
-                    doc.createElement('attribution'))
-                attribution.setAttribute('id', attr_id)
-
-                # A token can have multiple roles for a given attribution
-                for role in constituent['attributions'][attr_id]:
-                    attribution_role = attribution.appendChild(
-                        doc.createElement('attributionRole'))
-                    attribution_role.setAttribute('roleValue', role)
-
-            return element, word, sentence_word
-
-        element = doc.createElement(constituent['c_tag'])
-        element.setAttribute('gorn', self.gorn_str(gorn_trail, gorn))
-
-        # Create the child elements
-        child_gorn = 0
-        for child in constituent['c_children']:
-            child_elm, word, sentence_word = self.create_sentence_tag(
-                doc, child, word=word, sentence_word=sentence_word,
-                gorn_trail=(gorn_trail + (gorn,)), gorn=child_gorn
-            )
-            element.appendChild(child_elm)
-            child_gorn += 1
-
-        return element, word, sentence_word
+    def write_parc_xml(self, out, indent='  ', pretty=True):
+        '''
+        Writes the PARC xml for this document to the file-like object `out`,
+        without building a DOM.  Unless `pretty` is True, no indentation or
+        newlines are added.
+        '''
+        if not pretty:
+            indent = ''
+        write_parc_xml(
+            self.sentences, out, self.get_token_attributions, indent=indent,
+            newl='\n' if pretty else ''
+        )
 
 
-    def gorn_str(self, gorn_trail, gorn):
-        return ','.join([str(g) for g in gorn_trail + (gorn,)])
+    def get_token_attributions(self, token):
+        '''
+        Yields `(attribution_id, roles)` for each attribution `token` is part
+        of.
+        '''
+        return token['attributions'].iteritems()
 
 
     def __str__(self):
         return self.core.__str__()
 
 
-    def delineate_paragraphs(self):
+    @property
+    def paragraphs(self):
+        '''
+        A list of paragraphs, each being a list of sentences.  Paragraphs are
+        delineated (and sentences given a `paragraph_idx`) when the reader is
+        made, if raw text was provided.
+        '''
+        if self._paragraphs is None:
+            raise AttributeError(
+                'Paragraphs can only be delineated if raw_txt is provided')
+        return self._paragraphs
 
-        # A paragraph is just an array of CorenlpSentence objects
-        self.paragraphs = []
+
+    def delineate_paragraphs(self):
 
         # Read the orignial raw text, and split it into its paragraphs
         paragraph_texts = self.raw_txt.strip().split('\n\n')
@@ -230,138 +176,34 @@ class ParcCorenlpReader(object):
         # Collapse all whitespace out of the paragraphs.  This makes
         # aligning them to the sentences easier, because whitespace
         # does not consistently appear between tokens
-        collapsed_paragraph_texts = [
-            WHITESPACE_MATCHER.sub('', p) for p in paragraph_texts
+        paragraph_lengths = [
+            len(WHITESPACE_MATCHER.sub('', p)) for p in paragraph_texts
+        ]
+        sentence_lengths = [
+            self.get_collapsed_length(sentence_num)
+            for sentence_num in range(len(self.sentences))
         ]
+        paragraph_ranges = align_paragraphs(
+            sentence_lengths, paragraph_lengths)
 
-        sentence_pointer = 0
-        last_excess = 0
-        paragraph_idx = -1
-        for collapsed_paragraph in collapsed_paragraph_texts:
-
-            # We begin by assuming the paragraph consists of one sentence
-            target_length = len(collapsed_paragraph)
-            current_num_sentences = 1
-
-            # Occasionally a paragraph break occurs within what was
-            # considered one sentence in PARC.  This can happen when a 
-            # heading is followed by a subheading.  If this paragraph
-            # helps to make up for the excess of length in the last 
-            # paragraph then that's probably what happened.  Skip it, and
-            # deduct its length from the excess length.
-            if last_excess - target_length >= 0:
-                #print 'skipping!'
-                last_excess -= target_length
-                continue
-
-            # But if we run out of sentences, then there's no more 
-            # paragraphs to make, so break!
-            try:
-                current_length = self.get_collapsed_length(sentence_pointer)
-            except IndexError:
-                break
+        # If there's sentences left over, add them to the last paragraph
+        if paragraph_ranges:
+            start, stop = paragraph_ranges[-1]
+            paragraph_ranges[-1] = (start, len(self.sentences))
 
-            closest_length = current_length
-            closest_distance = abs(target_length - current_length)
-            best_num_sentences = 1
-
-            # Continually include more sentences, until we exceed the
-            # target length of the paragraph.  Keep track of how many
-            # sentences gave the closest length to that of the paragraph
-            while current_length <= target_length:
-
-                # Try adding another sentence to this paragraph.
-                # but if we run out of sentences, break.
-                current_num_sentences += 1
-                try:
-                    current_length += self.get_collapsed_length(
-                        sentence_pointer + current_num_sentences - 1
-                    )
-                except IndexError:
-                    break
-
-                # How close is the length of the paragraph with this 
-                # many sentences?  If its the closest so far, record it.
-                current_distance = abs(target_length - current_length)
-                if current_distance < closest_distance:
-                    closest_length = current_length
-                    closest_distance = current_distance
-                    best_num_sentences = current_num_sentences
-
-            # Now put the correct number of sentences into the paragraph,
-            # and store this paragraph in the article object's global list
-            paragraph_idx += 1
-            this_paragraph = []
-            add_sentences = self.sentences[
-                sentence_pointer : sentence_pointer + best_num_sentences
-            ]
-            for sentence in add_sentences:
+        # A paragraph is just an array of CorenlpSentence objects
+        self._paragraphs = []
+        for paragraph_idx, (start, stop) in enumerate(paragraph_ranges):
+            this_paragraph = self.sentences[start:stop]
+            for sentence in this_paragraph:
                 sentence['paragraph_idx'] = paragraph_idx
-                this_paragraph.append(sentence)
-            self.paragraphs.append(this_paragraph)
-
-            # Advance the sentence pointer according to how many sentences
-            # were aligned to the last paragraph
-            sentence_pointer += best_num_sentences
+            self._paragraphs.append(this_paragraph)
 
-            # If the paragraph we built was too big, it may be because
-            # PARC glues multiple paragraphs together (because the 
-            # "paragraphs" in the original are just sentence fragments and
-            # we won't split paragraphs within sentence fragments).
-            # Keep track of this so that we can skip these fragmentary 
-            # "paragraphs" as needed.
-            last_excess = closest_length - target_length
-
-        # If there's sentences left over, add them to the last paragraph
-        additional_sentences = self.sentences[sentence_pointer:]
-        for sentence in additional_sentences:
-            this_paragraph.append(sentence)
-            sentence['paragraph_idx'] = paragraph_idx
+        return self._paragraphs
 
 
     def _find_head(self, tokens):
-
-        heads = []
-
-        # If there is only one token, that's the head
-        if len(tokens) ==  1:
-            heads = [tokens[0]]
-
-        else:
-
-            # otherwise iterate over all the tokens to find the head
-            for token in tokens:
-
-                # if this token has no parents or children its not part
-                # of the dependency tree (it's a preposition, e.g.)
-                if 'parents' not in token and 'children' not in token:
-                    continue
-
-                # if this token has any parents that among the tokens list
-                # it's not the head!
-                try:
-
-                    token_ids = [(t['sentence_id'], t['id']) for t in tokens]
-
-                    has_parent_in_span = any([
-                        (t[1]['sentence_id'], t[1]['id'])
-                        in token_ids for t in token['parents']
-                    ])
-
-                    if has_parent_in_span:
-                        relations_to_parents = [
-                            t for t in token['parents'] if t[1] in tokens
-                        ]
-                        continue
-                except KeyError:
-                    pass
-
-                # otherwise it is the head
-                else:
-                    heads.append(token)
-
-        # NOTE: head may be none
-        return heads
+        return find_head(tokens)
 
 
     def get_collapsed_length(self, sentence_num):
@@ -516,34 +358,75 @@ class ParcCorenlpReader(object):
             sentence['attributions'].add(attribution_id)
 
 
+    def get_token_offset_index(self):
+        """
+        Returns the sorted start offsets of tokens, and the tokens starting at
+        those offsets, in the same order.  This is built once, and rebuilt only
+        after token offsets change.
+        """
+        if self._token_offset_index is None:
+            token_starts = sorted(self.core.tokens_by_offset)
+            self._token_offset_index = (token_starts, [
+                self.core.tokens_by_offset[token_start]
+                for token_start in token_starts
+            ])
+        return self._token_offset_index
+
+
     def map_byte_range_to_tokens(self, start, end):
         """
         Given a start byte and end byte, collect the corresponding list of
         (sentence_id, token_id) tuples.
         """
-        pointer = start
-        tokens = []
-        while pointer < end:
+        token_starts, tokens = self.get_token_offset_index()
+        pointer = bisect_left(token_starts, start)
+        return self._collect_tokens_until(pointer, end)
 
-            # Get the next token.  If we turn up nothing, move the pointer
-            # forward one byte.
-            try:
-                cur_token = self.core.tokens_by_offset[pointer]
-            except KeyError:
-                pointer += 1
-                continue
 
-            # Add the found token to the list, and advance to pointer to the
-            # end of that token
-            tokens.append(cur_token)
-            pointer = cur_token['character_offset_end']
+    def _collect_tokens_until(self, pointer, end):
+        """
+        Collect tokens starting from position `pointer` in the token offset
+        index, up to the byte offset `end`.  After each token, skip ahead to
+        the first token that starts after it ends.
+        """
+        token_starts, tokens = self.get_token_offset_index()
+        found_tokens = []
+        while pointer < len(token_starts) and token_starts[pointer] < end:
+            cur_token = tokens[pointer]
+            found_tokens.append(cur_token)
+            pointer = bisect_left(
+                token_starts, cur_token['character_offset_end'], pointer + 1)
 
-        return tokens
+        return found_tokens
 
 
     def map_byte_range_to_token_ids(self, start, end):
         tokens = self.map_byte_range_to_tokens(start, end)
         return [(t['sentence_id'], t['id']) for t in tokens]
+
+
+    def map_byte_ranges_to_token_ids(self, byte_ranges):
+        """
+        Bulk version of `map_byte_range_to_token_ids`.  Resolves all the
+        `(start, end)` byte ranges in one sweep over the token offsets, taking
+        them in order of their start.  Returns a list of token id lists, in
+        the same order as `byte_ranges`.
+        """
+        token_starts, tokens = self.get_token_offset_index()
+        token_ids = [None] * len(byte_ranges)
+        order = sorted(
+            range(len(byte_ranges)), key=lambda i: byte_ranges[i][0])
+
+        pointer = 0
+        for i in order:
+            start, end = byte_ranges[i]
+            pointer = bisect_left(token_starts, start, pointer)
+            token_ids[i] = [
+                (t['sentence_id'], t['id'])
+                for t in self._collect_tokens_until(pointer, end)
+            ]
+
+        return token_ids
         
 
     def merge_brat(self, brat_path):
@@ -556,10 +439,31 @@ class ParcCorenlpReader(object):
         self.merge(attributions)
 
 
-    def get_brat_attributions(self, brat_text):
+    def get_brat_attributions(self, brat_text, bulk=True):
+        """
+        Reads attributions from brat annotations, converting their byte ranges
+        into token ids.  In `bulk` mode, all of the byte ranges are resolved
+        together in one sorted sweep, rather than one at a time.
+        """
         # Get a representation of the annotations in the brat file
         attribution_specs = get_attributions_from_brat(brat_text)
 
+        # Gather all the byte ranges that need to be converted into token ids
+        range_specs = [
+            range_spec
+            for attr_label, attr_spec in attribution_specs.iteritems()
+            for role in attr_spec
+            for range_spec in attr_spec[role]
+        ]
+        if bulk:
+            token_ids_by_range = iter(
+                self.map_byte_ranges_to_token_ids(range_specs))
+        else:
+            token_ids_by_range = (
+                self.map_byte_range_to_token_ids(*range_spec)
+                for range_spec in range_specs
+            )
+
         # Convert the byte ranges in the attribution specs into token_id lists
         attributions = {}
         for attr_label, attr_spec in attribution_specs.iteritems():
@@ -568,7 +472,7 @@ class ParcCorenlpReader(object):
             for role in attr_spec:
                 new_attribution[role] = []
                 for range_spec in attr_spec[role]:
-                    token_ids = self.map_byte_range_to_token_ids(*range_spec)
+                    token_ids = next(token_ids_by_range)
                     sentence_ids = [sid for sid, tid in token_ids]
                     new_attribution[role].extend(token_ids)
                     new_attribution['sentences'].update(sentence_ids)
@@ -1,5 +1,6 @@
 from parc_reader.utils import IncrementingMap as IncMap, rangify
 from parc_reader.parc_sentence import ParcSentence
+from parc_reader.string_table import intern_string
 from bs4 import BeautifulSoup as Soup
 
 ROLES = {'cue', 'content', 'source'}
@@ -47,8 +48,8 @@ class ParcAnnotatedText(object):
 
                 token = {
                     'word': unescape(word_tag['text']),
-                    'pos': word_tag['pos'],
-                    'lemma': word_tag['lemma']
+                    'pos': intern_string(word_tag['pos']),
+                    'lemma': intern_string(word_tag['lemma'])
                 }
 
                 attributions = word_tag.find_all('attribution')
@@ -57,7 +58,8 @@ class ParcAnnotatedText(object):
 
                     # Get the info characterizing this token's role in this
                     # attribution
-                    role = attribution.find('attributionrole')['rolevalue']
+                    role = intern_string(
+                        attribution.find('attributionrole')['rolevalue'])
                     _id = attribution['id']
 
                     # Keep track of the viable attributions that are 
@@ -6,8 +6,10 @@ import subprocess
 import SETTINGS
 import json
 import random
+import multiprocessing.pool
 
 MAX_ARTICLE_NUM = 2499
+SOURCE_KINDS = ('parc', 'corenlp', 'raw')
 ARTICLE_NUM_MATCHER = re.compile('wsj_(\d\d\d\d)')
 
 
@@ -41,19 +43,29 @@ def get_raw_path(doc_num):
 
 
 def raw_article_exists(doc_num):
-    try:
-        open(get_raw_path(doc_num))
-    except IOError:
-        return False
-    return True
+    return article_exists(doc_num, 'raw')
 
 
 def corenlp_article_exists(doc_num):
+    return article_exists(doc_num, 'corenlp')
+
+
+def parc_article_exists(doc_num):
+    return article_exists(doc_num, 'parc')
+
+
+def article_exists(doc_num, kinds=SOURCE_KINDS):
+    """
+    Checks, using the corpus manifest, whether the files of the given `kinds`
+    (any of 'parc', 'corenlp', and 'raw') exist for `doc_num`.
+    """
+    if isinstance(kinds, basestring):
+        kinds = [kinds]
     try:
-        open(get_corenlp_path(doc_num))
-    except IOError:
+        entry = get_manifest()[doc_num]
+    except KeyError:
         return False
-    return True
+    return all(entry[kind] is not None for kind in kinds)
 
 
 def get_corenlp_path(doc_num):
@@ -100,18 +112,171 @@ def get_parc_path(doc_num):
     return os.path.join(parc_dir, subsubdir, fname + '.xml')
 
 
-def load_parc_doc(doc_num, include_nested=True):
+def get_split(doc_num):
+    prefix_digits = doc_num / 100
+    if prefix_digits < 23:
+        return 'train'
+    elif prefix_digits < 24:
+        return 'test'
+    elif prefix_digits < 25:
+        return 'dev'
+    raise ValueError(
+        "Parc data has no articles with ids in the range of %d00's."
+        % prefix_digits
+    )
+
+
+SOURCE_PATH_GETTERS = {
+    'parc': get_parc_path,
+    'corenlp': get_corenlp_path,
+    'raw': get_raw_path
+}
+MANIFEST_FNAME = 'corpus-manifest.json'
+_manifest = None
+def get_manifest(refresh=False):
+    """
+    Returns the corpus manifest, which says, for every doc_num, which of its
+    parc, corenlp, and raw files exist, where they are, and how big they are:
+
+        {doc_num: {
+            'split': 'train',
+            'parc': {'path': ..., 'size': ...},
+            'corenlp': None,        # (file doesn't exist)
+            'raw': {'path': ..., 'size': ...}
+        }}
+
+    The manifest is built once, saved in the data directory, and kept in
+    memory.  The saved manifest records the modification time of each corpus
+    directory, and is rebuilt when it is next read if any of them (or the
+    corpus directories in SETTINGS) have changed, or if `refresh` is True.
+    """
+    global _manifest
+    if _manifest is not None and not refresh:
+        return _manifest
+
+    manifest_path = os.path.join(SETTINGS.DATA_DIR, MANIFEST_FNAME)
+    if not refresh:
+        _manifest = read_manifest(manifest_path)
+    if _manifest is None:
+        dir_mtimes = {}
+        _manifest = build_manifest(dir_mtimes)
+        write_manifest(manifest_path, _manifest, dir_mtimes)
+
+    return _manifest
+
+
+def build_manifest(dir_mtimes=None):
+    """
+    Builds the corpus manifest by listing each corpus directory once, and
+    stat-ing only the files that exist.  If `dir_mtimes` is given, the
+    modification time of each directory, taken just before it is listed, is
+    put in it.
+    """
+    dir_mtimes = {} if dir_mtimes is None else dir_mtimes
+    listings = {}
+    manifest = {}
+    for doc_num in range(MAX_ARTICLE_NUM + 1):
+        entry = {'split': get_split(doc_num)}
+        for kind, get_path in SOURCE_PATH_GETTERS.items():
+            path = get_path(doc_num)
+            dirname, fname = os.path.split(path)
+            if dirname not in listings:
+                dir_mtimes[dirname] = get_dir_mtime(dirname)
+                listings[dirname] = list_dir(dirname)
+            if fname in listings[dirname]:
+                entry[kind] = {'path': path, 'size': os.stat(path).st_size}
+            else:
+                entry[kind] = None
+        manifest[doc_num] = entry
+
+    return manifest
+
+
+def list_dir(dirname):
+    try:
+        return set(os.listdir(dirname))
+    except OSError:
+        return set()
+
+
+def get_dir_mtime(dirname):
+    try:
+        return os.stat(dirname).st_mtime
+    except OSError:
+        return None
+
+
+def get_corpus_dirs():
+    """
+    The corpus directories that the manifest was built from.  Used to tell
+    whether a saved manifest still describes the corpus in SETTINGS.
+    """
+    return sorted(set(
+        os.path.dirname(get_path(doc_num))
+        for get_path in SOURCE_PATH_GETTERS.values()
+        for doc_num in range(0, MAX_ARTICLE_NUM + 1, 100)
+    ))
+
+
+def read_manifest(manifest_path):
+    try:
+        stored = json.loads(open(manifest_path).read())
+    except (IOError, ValueError):
+        return None
+    if stored.get('corpus_dirs') != get_corpus_dirs():
+        return None
+
+    # Files added to, or removed from, a directory change its mtime.
+    dir_mtimes = stored.get('dir_mtimes') or {}
+    if sorted(dir_mtimes) != get_corpus_dirs():
+        return None
+    for dirname, mtime in dir_mtimes.items():
+        if get_dir_mtime(dirname) != mtime:
+            return None
+
+    return {int(doc_num): entry for doc_num, entry in stored['docs'].items()}
+
+
+def write_manifest(manifest_path, manifest, dir_mtimes):
+    stored = {
+        'corpus_dirs': get_corpus_dirs(), 'dir_mtimes': dir_mtimes,
+        'docs': manifest
+    }
+    try:
+        open(manifest_path, 'w').write(json.dumps(stored))
+    except IOError:
+        pass
+
+
+
+def load_parc_doc(doc_num, include_nested=True, engine='soup', cache=None):
     """
     Loads a parc file into memory, but does not load the associated corenlp 
-    annotations
+    annotations.  See `new_parc_annotated_text.read_parc_file` for the choice
+    of parse `engine`.  If a `doc_cache.DocumentCache` is given as `cache`,
+    the parsed document is taken from, or saved to, the cache.
     """
+    if cache is not None:
+        return cache.load(
+            ('parc', doc_num, include_nested), [get_parc_path(doc_num)],
+            load_parc_doc, doc_num, include_nested, engine
+        )
+
     return parc_reader.new_parc_annotated_text.read_parc_file(
-        open(get_parc_path(doc_num)).read(), doc_num, include_nested
+        open(get_parc_path(doc_num)).read(), doc_num, include_nested, engine
     )
 
 
 
-def load_article(doc_num):
+def load_article(doc_num, cache=None):
+
+    if cache is not None:
+        source_paths = [
+            get_parc_path(doc_num), get_corenlp_path(doc_num),
+            get_raw_path(doc_num)
+        ]
+        return cache.load(
+            ('article', doc_num), source_paths, load_article, doc_num)
 
     parc_xml = open(get_parc_path(doc_num)).read()
     corenlp_xml = open(get_corenlp_path(doc_num)).read()
@@ -121,12 +286,24 @@ def load_article(doc_num):
         corenlp_xml, parc_xml, raw_txt)
 
 
-def iter_doc_num(subset='train', skip=None, limit=None):
+CACHE_DIRNAME = 'parc-cache'
+def get_document_cache(max_bytes=None):
+    """
+    Get a cache of parsed documents that lives in the data directory, for use
+    with `load_parc_doc`, `load_article`, and the iterators built on them.
+    """
+    return parc_reader.doc_cache.DocumentCache(
+        os.path.join(SETTINGS.DATA_DIR, CACHE_DIRNAME), max_bytes)
+
+
+def iter_doc_num(subset='train', skip=None, limit=None, require=None):
     """
     Provides iteration over named ranges of documents.  The iterator yields the
     document IDs only, not the documents themselves.  Allows you to
     individually select the training, testing, or development subsets, or to
-    select all document numbers.
+    select all document numbers.  If `require` is given, as a list of the
+    kinds of files ('parc', 'corenlp', 'raw') needed, only document IDs that
+    have those files, according to the corpus manifest, are yielded.
     """
     if subset == 'train':
         start = 0; stop = 2300
@@ -144,10 +321,21 @@ def iter_doc_num(subset='train', skip=None, limit=None):
         stop = min(limit, stop)
 
     for doc_num in range(start, stop):
+        if require is not None and not article_exists(doc_num, require):
+            continue
         yield doc_num
 
 
-def iter_parc_docs(subset='train', skip=None, limit=None, include_nested=True):
+def iter_parc_docs(
+    subset='train',
+    skip=None,
+    limit=None,
+    include_nested=True,
+    engine='soup',
+    cache=None,
+    workers=None,
+    failures=None
+):
     """
     Yields all parc files, parsed to surface tokenization, sentence splitting, 
     constituence parse structure, and attributions.
@@ -155,29 +343,41 @@ def iter_parc_docs(subset='train', skip=None, limit=None, include_nested=True):
 
         'train', 'test', 'dev', or 'all.
 
+    Set `workers` to parse documents in that many processes.  Documents are
+    still yielded in order.  See `iter_loaded_docs` for `failures`.
     """
-    for doc_num in iter_doc_num(subset, skip=skip, limit=limit):
-        doc = try_do(load_parc_doc, doc_num, include_nested)
+    doc_nums = iter_doc_num(subset, skip=skip, limit=limit, require=['parc'])
+    loaded_docs = iter_loaded_docs(
+        load_parc_doc, doc_nums, (include_nested, engine, cache), workers,
+        failures
+    )
+    for doc_num, doc in loaded_docs:
         if doc is not None:
             yield doc_num, doc
 
 
-def read_all_parc_files(subset='train', skip=None, limit=None):
+def read_all_parc_files(
+    subset='train', skip=None, limit=None, cache=None, workers=None
+):
     print 'Reading PARC3 files.  This will take a minute...'
     return {
         doc_num : doc
-        for doc_num, doc in iter_parc_docs(subset, skip=skip, limit=limit)
+        for doc_num, doc in iter_parc_docs(
+            subset, skip=skip, limit=limit, cache=cache, workers=workers)
     }
 
 
-def iter_articles(subset='train'):
+def iter_articles(subset='train', cache=None, workers=None, failures=None):
     """
     Generator that yields all articles in the dataset, according to the subset
     specified.  ``subset`` can be ``'train'``, ``'test'``, ``'dev'``, or
-    ``'all'``.
+    ``'all'``.  Set ``workers`` to load articles in that many processes.  See
+    ``iter_loaded_docs`` for ``failures``.
     """
-    for doc_num in iter_doc_num(subset):
-        doc = try_do(load_article, doc_num)
+    doc_nums = iter_doc_num(subset, require=SOURCE_KINDS)
+    loaded_docs = iter_loaded_docs(
+        load_article, doc_nums, (cache,), workers, failures)
+    for doc_num, doc in loaded_docs:
         if doc is not None:
             yield get_parc_fname(doc_num), doc
 
@@ -189,6 +389,57 @@ def try_do(func, *args, **kwargs):
         return None
 
 
+def iter_loaded_docs(load, doc_nums, args=(), workers=None, failures=None):
+    """
+    Yields `(doc_num, load(doc_num, *args))` for each of `doc_nums`, in order.
+    Documents with missing or malformed files come back as None (see
+    `try_do`); any other error is raised.  If `workers` is more than one,
+    documents are loaded by a pool of that many processes, which keep working
+    ahead while a slow document holds up the results after it.  Errors raised
+    in a worker are raised here just the same, except that a document that
+    can't be sent back from its worker (e.g. because it can't be pickled)
+    comes back as None.  If a list is given as `failures`, a failure report
+    (giving the `doc_id`, the `stage` that failed, and the `error`) is added
+    to it for each such document.
+    """
+    if workers is None or workers <= 1:
+        for doc_num in doc_nums:
+            yield doc_num, try_do(load, doc_num, *args)
+        return
+
+    doc_nums = list(doc_nums)
+    pool = multiprocessing.Pool(workers)
+    try:
+        tasks = ((load, doc_num, args) for doc_num in doc_nums)
+        results = pool.imap(run_load_task, tasks)
+        for doc_num in doc_nums:
+            try:
+                result = results.next()
+            except multiprocessing.pool.MaybeEncodingError as e:
+                if failures is not None:
+                    failures.append({
+                        'doc_id': doc_num, 'stage': 'transport',
+                        'error': repr(e)
+                    })
+                result = doc_num, None
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run_load_task(task):
+    """
+    Runs one task for `iter_loaded_docs` in a worker process, skipping
+    missing or malformed documents just as loading serially does (see
+    `try_do`).  Any other error is passed back to be raised by
+    `iter_loaded_docs`.
+    """
+    load, doc_num, args = task
+    return doc_num, try_do(load, doc_num, *args)
+
+
 def load_corpus_stats():
     corpus_stats_path = os.path.join(
         SETTINGS.DATA_DIR, 'corpus-statistics.json')
@@ -321,10 +572,12 @@ class ParcDataset(object):
         # Pack all data into a tuple for easy saving and loading
         self.data = self.articles, self.cues, self.contents, self.sources
 
+        # Skip articles that are missing some of their files.  There are
+        # frequently holes in the file name series.
         if article_nums is None:
             article_nums = range(start, limit)
-        else:
-            article_nums = list(article_nums)
+        article_nums = [
+            doc_num for doc_num in article_nums if article_exists(doc_num)]
 
         for doc_num in article_nums:
 
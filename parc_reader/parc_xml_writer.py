@@ -0,0 +1,147 @@
+'''
+Writes a document's sentences out as PARC xml.  Elements are written to a
+file-like object as soon as they are reached, so no DOM is built, and
+constituency trees are walked with an explicit stack, so their depth is not
+limited by python's recursion limit.  The output is the same as
+`minidom`'s `toprettyxml` (or `toxml`, in compact mode) would produce.
+'''
+
+
+def write_parc_xml(
+    sentences, out, get_token_attributions, indent='  ', newl='\n'
+):
+    '''
+    Write the PARC xml for `sentences` to `out`.
+    `get_token_attributions(token)` should yield an `(attribution_id, roles)`
+    pair for each attribution the token belongs to.  For compact output, pass
+    empty strings for `indent` and `newl`.
+    '''
+    out.write('<?xml version="1.0" ?>' + newl)
+    if not sentences:
+        out.write('<root/>' + newl)
+        return
+
+    out.write('<root>' + newl)
+    word = 0
+    for gorn, sentence in enumerate(sentences):
+
+        # The sentence's top constituent is wrapped in a SENTENCE tag
+        # (bypassing the corenlp root constituent)
+        out.write('%s<SENTENCE gorn="%d">%s' % (indent, gorn, newl))
+        word = write_sentence_tag(
+            out, sentence['c_root']['c_children'][0], gorn, word,
+            get_token_attributions, indent, newl
+        )
+        out.write('%s</SENTENCE>%s' % (indent, newl))
+
+    out.write('</root>' + newl)
+
+
+def write_sentence_tag(
+    out, constituent, gorn, word, get_token_attributions, indent, newl
+):
+    '''
+    Write the tag for a sentence's top constituent, along with all of its
+    descendant constituent and WORD tags.  `word` is the index of the first
+    token in the sentence among all tokens in the document.  Returns the
+    index of the token that follows the sentence.
+    '''
+    sentence_word = 0
+
+    # The stack holds constituents still to be opened, along with their gorn
+    # address and depth, and the closing tags of constituents already opened.
+    stack = [(constituent, (gorn,), 2)]
+    while stack:
+        constituent, gorn_address, depth = stack.pop()
+        this_indent = indent * depth
+
+        # Close a constituent whose children have all been written
+        if gorn_address is None:
+            out.write('%s</%s>%s' % (this_indent, constituent, newl))
+            continue
+
+        gorn_str = ','.join([str(g) for g in gorn_address])
+
+        # Tokens become WORD tags, holding their attributions
+        if len(constituent['c_children']) == 0:
+            out.write('%s<WORD%s' % (this_indent, get_attributes_str([
+                ('ByteCount', '%s,%s' % (
+                    constituent['character_offset_begin'],
+                    constituent['character_offset_end'])
+                ),
+                ('gorn', gorn_str),
+                ('lemma', constituent['lemma']),
+                ('pos', constituent['pos']),
+                ('sentenceWord', str(sentence_word)),
+                ('text', constituent['word']),
+                ('word', str(word)),
+            ])))
+            word += 1
+            sentence_word += 1
+            write_attributions(
+                out, get_token_attributions(constituent),
+                indent, depth, newl
+            )
+            continue
+
+        # Other constituents are opened, and their children written before
+        # they get closed.
+        out.write('%s<%s gorn="%s">%s' % (
+            this_indent, constituent['c_tag'], escape_xml(gorn_str), newl))
+        stack.append((constituent['c_tag'], None, depth))
+        children = constituent['c_children']
+        for child_gorn in reversed(range(len(children))):
+            stack.append((
+                children[child_gorn],
+                gorn_address + (child_gorn,),
+                depth + 1
+            ))
+
+    return word
+
+
+def write_attributions(out, attributions, indent, depth, newl):
+    '''
+    Finish a WORD tag whose attributes have been written, writing the
+    attributions it belongs to as its children.
+    '''
+    attributions = list(attributions)
+    if not attributions:
+        out.write('/>' + newl)
+        return
+
+    out.write('>' + newl)
+    for attribution_id, roles in attributions:
+        out.write('%s<attribution id="%s"' % (
+            indent * (depth + 1), escape_xml(attribution_id)))
+        roles = list(roles)
+        if not roles:
+            out.write('/>' + newl)
+            continue
+
+        out.write('>' + newl)
+        for role in roles:
+            out.write('%s<attributionRole roleValue="%s"/>%s' % (
+                indent * (depth + 2), escape_xml(role), newl))
+        out.write('%s</attribution>%s' % (indent * (depth + 1), newl))
+
+    out.write('%s</WORD>%s' % (indent * depth, newl))
+
+
+def get_attributes_str(attributes):
+    '''
+    Formats `(name, value)` pairs as xml attributes.  They should be given
+    in sorted order, which is the order that minidom writes them in.
+    '''
+    return ''.join([
+        ' %s="%s"' % (name, escape_xml(value)) for name, value in attributes
+    ])
+
+
+def escape_xml(value):
+    if not value:
+        return ''
+    return (
+        value.replace('&', '&amp;').replace('<', '&lt;')
+        .replace('"', '&quot;').replace('>', '&gt;')
+    )
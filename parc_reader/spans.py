@@ -1,3 +1,5 @@
+from collections import defaultdict
+import weakref
 import parc_reader
 
 class Span(dict):
@@ -30,10 +32,40 @@ class Span(dict):
         self['token_span'].accomodate_inserted_token(sentence_id, index)
 
 
+    def follow_journal(self, journal):
+        self['token_span'].follow_journal(journal)
+
+
+    def follows_journal(self, journal):
+        return self['token_span'].journal is journal
+
+
+    def map_token_spans(self, function):
+        """
+        Replace each of this annotation's TokenSpans with the result of
+        calling `function` on it.
+        """
+        self['token_span'] = function(self['token_span'])
+
+
     def relativize(self, doc):
         self['token_span'].relativize(doc)
 
 
+    # Labels are interned in the shared string table when parsed.  Pickles
+    # lose that sharing, so the labels are interned again when unpickled.
+    INTERNED_KEYS = ('constituent_type', 'entity_type', 'mention_type', 'roles')
+
+    def __getstate__(self):
+        return dict([
+            (key, self[key]) for key in self.INTERNED_KEYS if key in self])
+
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            self[key] = parc_reader.string_table.intern_strings(value)
+
+
 
 class Constituency(Span):
 
@@ -50,6 +82,23 @@ class Constituency(Span):
             child.accomodate_inserted_token(sentence_id, index)
 
 
+    def follow_journal(self, journal):
+
+        # The whole tree follows the journal as one group, so there's nothing
+        # to do for a constituent that already follows it.
+        if self.follows_journal(journal):
+            return
+        cursor = JournalCursor(journal)
+        for depth, constituent in get_dfs_constituents(self):
+            constituent['token_span'].follow_journal(journal, cursor)
+
+
+    def map_token_spans(self, function):
+        super(Constituency, self).map_token_spans(function)
+        for child in self['constituent_children']:
+            child.map_token_spans(function)
+
+
     def relativize(self, doc):
         super(Constituency, self).relativize(doc)
         for child in self['constituent_children']:
@@ -96,6 +145,19 @@ class Attribution(dict):
         for span_type in self.ROLES:
             self[span_type].accomodate_inserted_token(sentence_id, index)
 
+    def follow_journal(self, journal):
+        cursor = JournalCursor(journal)
+        for span_type in self.ROLES:
+            self[span_type].follow_journal(journal, cursor)
+
+    def follows_journal(self, journal):
+        return all([
+            self[span_type].journal is journal for span_type in self.ROLES])
+
+    def map_token_spans(self, function):
+        for span_type in self.ROLES:
+            self[span_type] = function(self[span_type])
+
     def relativize(self, doc):
         for span_type in self.ROLES:
             self[span_type].relativize(doc)
@@ -122,8 +184,17 @@ class TokenSpan(list):
 
     In either case, the start and end indices follow the convention of slice
     notation.
+
+    Once consolidated, the ranges are kept sorted and disjoint, so a single
+    range is added by binary search, merging it into its neighbours, and
+    spans can be combined with `union`, `intersection` and `difference` (or
+    measured against one another with `overlap_length`) in linear time.
     """
 
+    # A span can follow a document's EditJournal, through a JournalCursor
+    # recording the version up to which it has accounted for the edits.
+    journal_cursor = None
+
     def __init__(
         self, token_span=None, single_range=None, absolute=False
     ):
@@ -204,21 +275,69 @@ class TokenSpan(list):
     def add_token_range(self, token_range, skip_consolidation=False):
         token_range = self._normalize_range(token_range)
         self._validate_range(token_range)
+        self.sync()
+
+        # Ranges can be inserted directly into a consolidated span.
+        if self.consolidated and not skip_consolidation:
+            self._insert_range(token_range)
+            return
+
         self._check_if_still_consolidated(token_range)
         super(TokenSpan, self).append(token_range)
         if not skip_consolidation:
             self.consolidate()
 
 
+    def _insert_range(self, token_range):
+        """
+        Insert a range into this consolidated span, merging it with any
+        ranges it overlaps or abuts.  The insertion point is found by binary
+        search.
+        """
+        get_range = super(TokenSpan, self).__getitem__
+        num_ranges = super(TokenSpan, self).__len__()
+        sentence_id, start, end = token_range
+
+        # Find the first range that isn't ordered before this one
+        low, high = 0, num_ranges
+        while low < high:
+            middle = (low + high) // 2
+            if get_range(middle) < token_range:
+                low = middle + 1
+            else:
+                high = middle
+
+        # Merge with the preceding range if it reaches this one, then with
+        # following ranges that this one reaches.
+        first = low
+        if first > 0:
+            prev_sentence_id, prev_start, prev_end = get_range(first - 1)
+            if prev_sentence_id == sentence_id and prev_end >= start:
+                first -= 1
+                start, end = prev_start, max(prev_end, end)
+
+        last = low
+        while last < num_ranges:
+            next_sentence_id, next_start, next_end = get_range(last)
+            if next_sentence_id != sentence_id or next_start > end:
+                break
+            end = max(end, next_end)
+            last += 1
+
+        super(TokenSpan, self).__setslice__(
+            first, last, [(sentence_id, start, end)])
+
+
     def _check_if_still_consolidated(self, token_range):
         """
         Check if this token range comes strictly after existing token ranges,
         in which case consolidation isn't needed.
         """
         sentence_id, start, end = token_range
-        if self.num_segments() > 0:
-            last_range_end = self[-1][2]
-            if last_range_end >= start:
+        if super(TokenSpan, self).__len__() > 0:
+            last_sentence_id, last_start, last_end = (
+                super(TokenSpan, self).__getitem__(-1))
+            if (sentence_id, start) <= (last_sentence_id, last_end):
                 self.consolidated = False
 
 
@@ -256,6 +375,7 @@ class TokenSpan(list):
 
         # Replace elements in place
         self._replace_with_consolidated(new_span)
+        self.consolidated = True
 
 
     def _replace_with_consolidated(self, token_ranges):
@@ -266,6 +386,15 @@ class TokenSpan(list):
         self[:] = token_ranges
 
 
+    def assign_consolidated(self, token_ranges):
+        """
+        Assign token ranges that are already sorted and consolidated (such as
+        those built up with `append_range`), skipping validation.
+        """
+        self._replace_with_consolidated(token_ranges)
+        self.consolidated = True
+
+
     def replace_with(self, token_ranges, absolute=None):
         """
         Assign new token ranges.  Subject ranges to validation and
@@ -277,6 +406,7 @@ class TokenSpan(list):
 
 
     def num_segments(self):
+        self.sync()
         return super(TokenSpan, self).__len__()
 
 
@@ -298,6 +428,203 @@ class TokenSpan(list):
         ])
 
 
+    def follow_journal(self, journal, cursor=None):
+        """
+        Have this span keep up with the token edits recorded in `journal` from
+        now on.  Rather than being shifted as each batch of edits is applied,
+        the span catches up on all of them the next time it is read.  Spans
+        belonging together (like the constituents of a parse tree) can share
+        a `cursor`, so that the journal only counts them once.
+        """
+        if cursor is None:
+            if self.journal is journal:
+                return
+            cursor = JournalCursor(journal)
+        elif self.journal_cursor is cursor:
+            return
+        self.sync()
+        if self.journal_cursor is not None:
+            self.journal_cursor.remove_span(self)
+        cursor.add_span(self)
+        self.journal_cursor = cursor
+
+
+    @property
+    def journal(self):
+        if self.journal_cursor is None:
+            return None
+        return self.journal_cursor.journal
+
+
+    @property
+    def journal_version(self):
+        if self.journal_cursor is None:
+            return 0
+        return self.journal_cursor.version
+
+
+    def sync(self):
+        """
+        Shift this span's ranges (along with those of the other spans sharing
+        its cursor) to account for any edits recorded in its journal since it
+        was last read.
+        """
+        if self.journal_cursor is not None:
+            self.journal_cursor.sync()
+
+
+    def replay(self, journal, since_version):
+        """
+        Shift this span's ranges through the edits recorded in `journal`
+        since `since_version`.  Called by the span's cursor.
+        """
+        token_ranges = list(super(TokenSpan, self).__iter__())
+        try:
+            token_ranges = journal.replay(token_ranges, since_version)
+        except IndexError:
+            raise ValueError(
+                'The token span %r addresses tokens that did not exist when '
+                'it was last edited.' % token_ranges
+            )
+        self.replace_with(token_ranges)
+
+
+    # Pickling and copying read the list's storage directly, so the span is
+    # brought up to date first.  A shallow copy is a new span, following the
+    # journal along with this one.
+    def __getstate__(self):
+        self.sync()
+        return self.__dict__
+
+
+    def __copy__(self):
+        copied = TokenSpan(self, absolute=self.absolute)
+        if self.journal_cursor is not None:
+            copied.follow_journal(self.journal, self.journal_cursor)
+        return copied
+
+
+    # Reading or changing a span's list of ranges first brings it up to date
+    # with its journal.  (Code that reads the list's storage directly, like
+    # the C encoder used by json.dumps, should call sync() first.)
+    def __iter__(self):
+        self.sync()
+        return super(TokenSpan, self).__iter__()
+
+
+    def __getitem__(self, index):
+        self.sync()
+        return super(TokenSpan, self).__getitem__(index)
+
+
+    def __getslice__(self, start, stop):
+        self.sync()
+        return super(TokenSpan, self).__getslice__(start, stop)
+
+
+    def __len__(self):
+        self.sync()
+        return super(TokenSpan, self).__len__()
+
+
+    def __eq__(self, other):
+        return self._compare(other, super(TokenSpan, self).__eq__)
+
+
+    def __ne__(self, other):
+        return not self == other
+
+
+    def __lt__(self, other):
+        return self._compare(other, super(TokenSpan, self).__lt__)
+
+
+    def __le__(self, other):
+        return self._compare(other, super(TokenSpan, self).__le__)
+
+
+    def __gt__(self, other):
+        return self._compare(other, super(TokenSpan, self).__gt__)
+
+
+    def __ge__(self, other):
+        return self._compare(other, super(TokenSpan, self).__ge__)
+
+
+    def _compare(self, other, compare):
+        self.sync()
+        if isinstance(other, TokenSpan):
+            other.sync()
+        return compare(other)
+
+
+    def __repr__(self):
+        self.sync()
+        return super(TokenSpan, self).__repr__()
+
+
+    def __contains__(self, token_range):
+        self.sync()
+        return super(TokenSpan, self).__contains__(token_range)
+
+
+    def __reversed__(self):
+        self.sync()
+        return super(TokenSpan, self).__reversed__()
+
+
+    def __add__(self, other):
+        self.sync()
+        return list(self) + list(other)
+
+
+    def __radd__(self, other):
+        self.sync()
+        return list(other) + list(self)
+
+
+    def __mul__(self, times):
+        self.sync()
+        return super(TokenSpan, self).__mul__(times)
+
+
+    __rmul__ = __mul__
+
+
+    def index(self, token_range, *args):
+        self.sync()
+        return super(TokenSpan, self).index(token_range, *args)
+
+
+    def count(self, token_range):
+        self.sync()
+        return super(TokenSpan, self).count(token_range)
+
+
+    def _synced(method_name):
+        method = getattr(list, method_name)
+        def synced_method(self, *args):
+            self.sync()
+            return method(self, *args)
+        synced_method.__name__ = method_name
+        return synced_method
+
+    __setitem__ = _synced('__setitem__')
+    __delitem__ = _synced('__delitem__')
+    __setslice__ = _synced('__setslice__')
+    __delslice__ = _synced('__delslice__')
+    __iadd__ = _synced('__iadd__')
+    __imul__ = _synced('__imul__')
+    append = _synced('append')
+    extend = _synced('extend')
+    insert = _synced('insert')
+    pop = _synced('pop')
+    remove = _synced('remove')
+    reverse = _synced('reverse')
+    sort = _synced('sort')
+    del _synced
+
+
     def maybe_shift_range(self, token_range, at_sentence_id, at_index):
 
         sentence_id, start, end = token_range
@@ -327,6 +654,61 @@ class TokenSpan(list):
         return sum([end-start for _, start, end in self])
 
 
+    def _check_compatible(self, other):
+        if not isinstance(other, TokenSpan):
+            other = TokenSpan(other, absolute=self.absolute)
+        if other.absolute != self.absolute:
+            raise ValueError(
+                'Cannot combine absolute and sentence-relative token spans.')
+        self.consolidate()
+        other.consolidate()
+        return other
+
+
+    def union(self, other):
+        """
+        Returns a TokenSpan covering the tokens in this span or `other`.
+        """
+        other = self._check_compatible(other)
+        union = TokenSpan(absolute=self.absolute)
+        union._replace_with_consolidated(
+            union_ranges(list(self), list(other)))
+        return union
+
+
+    def intersection(self, other):
+        """
+        Returns a TokenSpan covering the tokens in both this span and `other`.
+        """
+        other = self._check_compatible(other)
+        intersection = TokenSpan(absolute=self.absolute)
+        intersection._replace_with_consolidated(
+            intersect_ranges(list(self), list(other)))
+        return intersection
+
+
+    def difference(self, other):
+        """
+        Returns a TokenSpan covering the tokens in this span but not `other`.
+        """
+        other = self._check_compatible(other)
+        difference = TokenSpan(absolute=self.absolute)
+        difference._replace_with_consolidated(
+            subtract_ranges(list(self), list(other)))
+        return difference
+
+
+    def overlap_length(self, other):
+        """
+        Returns the number of tokens shared by this span and `other`.
+        """
+        other = self._check_compatible(other)
+        return sum([
+            end - start for _, start, end
+            in intersect_ranges(list(self), list(other))
+        ])
+
+
     #def extend(self, iterable):
     #    super(TokenSpan, self).extend(iterable)
     #    self.sort()
@@ -346,8 +728,351 @@ class TokenSpan(list):
 
 
 
+# The functions below work on lists of consolidated ranges (sorted, and not
+# touching one another within a sentence), in time linear in their lengths.
+
+def append_range(ranges, token_range):
+    """
+    Append `token_range` to `ranges`, which it must not come before, merging
+    it into the last range if they touch.
+    """
+    if ranges:
+        sentence_id, start, end = ranges[-1]
+        if sentence_id == token_range[0] and end >= token_range[1]:
+            if token_range[2] > end:
+                ranges[-1] = (sentence_id, start, token_range[2])
+            return
+    ranges.append(tuple(token_range))
+
+
+def union_ranges(ranges1, ranges2):
+    merged = []
+    i, j = 0, 0
+    while i < len(ranges1) or j < len(ranges2):
+        if j == len(ranges2) or (i < len(ranges1) and ranges1[i] < ranges2[j]):
+            sentence_id, start, end = ranges1[i]
+            i += 1
+        else:
+            sentence_id, start, end = ranges2[j]
+            j += 1
+
+        if merged and merged[-1][0] == sentence_id and merged[-1][2] >= start:
+            if end > merged[-1][2]:
+                merged[-1] = (sentence_id, merged[-1][1], end)
+        else:
+            merged.append((sentence_id, start, end))
+
+    return merged
+
+
+def intersect_ranges(ranges1, ranges2):
+    intersection = []
+    i, j = 0, 0
+    while i < len(ranges1) and j < len(ranges2):
+        sentence_id1, start1, end1 = ranges1[i]
+        sentence_id2, start2, end2 = ranges2[j]
+
+        if sentence_id1 != sentence_id2:
+            if sentence_id1 < sentence_id2:
+                i += 1
+            else:
+                j += 1
+            continue
+
+        start, end = max(start1, start2), min(end1, end2)
+        if start < end:
+            intersection.append((sentence_id1, start, end))
+
+        # Move past whichever range ends first
+        if end1 <= end2:
+            i += 1
+        else:
+            j += 1
+
+    return intersection
+
+
+def subtract_ranges(ranges1, ranges2):
+    difference = []
+    j = 0
+    for sentence_id, start, end in ranges1:
+
+        # Skip ranges to subtract that come entirely before this one
+        while j < len(ranges2) and (
+            ranges2[j][0] < sentence_id
+            or (ranges2[j][0] == sentence_id and ranges2[j][2] <= start)
+        ):
+            j += 1
+
+        # Cut out the ranges that overlap this one.  The last of them may
+        # also overlap the next range, so it isn't passed.
+        k = j
+        while k < len(ranges2) and ranges2[k][0] == sentence_id:
+            cut_sentence_id, cut_start, cut_end = ranges2[k]
+            if cut_start >= end:
+                break
+            if cut_start > start:
+                difference.append((sentence_id, start, cut_start))
+            start = max(start, cut_end)
+            if cut_end > end:
+                break
+            k += 1
+        j = k
+
+        if start < end:
+            difference.append((sentence_id, start, end))
+
+    return difference
+
+
+
+class EditJournal(object):
+    """
+    Records the token edits applied to a document, as tables giving where
+    each token boundary moved to (along with the sentence starts that
+    sentence-relative ranges were measured from).  Spans following the
+    journal replay the edits they haven't yet accounted for when they are
+    read, so applying edits needn't touch every span in the document.
+
+    Spans follow the journal through JournalCursors.  The journal keeps
+    weak references to the cursors, and counts how many of them are at each
+    version.  It drops the oldest edits once no cursor still needs them.  A
+    cursor whose spans are thrown away stops counting as soon as it is
+    garbage collected, even if its spans were never read.
+    """
+
+    def __init__(self):
+        self.edits = []
+        self.first_version = 0
+        self.init_followers()
+
+
+    def init_followers(self):
+        # Maps a weak reference to each following cursor to the version it
+        # was last counted at.
+        self.followers = {}
+        self.follower_counts = defaultdict(int)
+
+
+    @property
+    def version(self):
+        return self.first_version + len(self.edits)
+
+
+    def add_follower(self, cursor):
+        """
+        Start counting `cursor`, at its `version`.  Returns the weak reference
+        by which the journal knows it.
+        """
+        reference = weakref.ref(cursor, self.drop_follower)
+        self.count_follower(reference, cursor.version)
+        return reference
+
+
+    def move_follower(self, reference, version):
+        """
+        Note that a following cursor has caught up to `version`.
+        """
+        self.forget_follower(reference)
+        self.count_follower(reference, version)
+        self.prune()
+
+
+    def count_follower(self, reference, version):
+        self.followers[reference] = version
+        self.follower_counts[version] += 1
+
+
+    def forget_follower(self, reference):
+        version = self.followers.pop(reference)
+        self.follower_counts[version] -= 1
+        if self.follower_counts[version] == 0:
+            del self.follower_counts[version]
+
+
+    def drop_follower(self, reference):
+        """
+        Stop counting a following cursor that was garbage collected.  This
+        can happen in the middle of any other work, so the edits that no
+        longer need keeping are only dropped when the next batch is recorded.
+        """
+        if reference in self.followers:
+            self.forget_follower(reference)
+
+
+    def record(self, new_positions, sentence_starts):
+        self.edits.append((new_positions, sentence_starts))
+        self.prune()
+
+
+    def prune(self):
+        """
+        Drop the oldest edits, for as long as no span is waiting to replay
+        them.
+        """
+        num_dropped = 0
+        while (
+            num_dropped < len(self.edits)
+            and self.first_version + num_dropped not in self.follower_counts
+        ):
+            num_dropped += 1
+        if num_dropped:
+            del self.edits[:num_dropped]
+            self.first_version += num_dropped
+
+
+    def replay(self, token_ranges, since_version):
+        if since_version < self.first_version:
+            raise ValueError(
+                'Edits since version %d were dropped from the journal.'
+                % since_version
+            )
+        edits = self.edits[since_version - self.first_version:]
+        for new_positions, sentence_starts in edits:
+            token_ranges = [
+                shifted_range for shifted_range in (
+                    shift_range(token_range, new_positions, sentence_starts)
+                    for token_range in token_ranges
+                )
+                if shifted_range is not None
+            ]
+        return token_ranges
+
+
+    # Followers aren't kept in pickles; they are counted again as they are
+    # unpickled.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['followers']
+        del state['follower_counts']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.init_followers()
+
+
+class JournalCursor(object):
+    """
+    The version of an EditJournal up to which a group of spans (like the
+    roles of an attribution, or the constituents of a parse tree) has
+    accounted for the edits recorded in it.  The journal counts the group
+    once, and the whole group catches up as soon as any of its spans is read.
+    """
+
+    # Spans can be read while a copied or unpickled cursor is still being
+    # built.  Their ranges are already up to date.
+    journal = None
+
+    def __init__(self, journal):
+        self.journal = journal
+        self.version = journal.version
+        self.spans = []
+        self.reference = journal.add_follower(self)
+
+
+    def add_span(self, span):
+        """
+        Add `span`, whose ranges are up to date with the document, to the
+        group.
+        """
+        self.sync()
+        self.spans.append(span)
+
+
+    def remove_span(self, span):
+        self.spans = [
+            other_span for other_span in self.spans if other_span is not span]
+
+
+    def sync(self):
+        journal = self.journal
+        if journal is None or self.version == journal.version:
+            return
+
+        # The version is moved first, so that spans changing their ranges
+        # while replaying don't try to sync again.
+        since_version, self.version = self.version, journal.version
+        for span in self.spans:
+            span.replay(journal, since_version)
+        journal.move_follower(self.reference, self.version)
+
+
+    # Cursors are counted by their journal again when unpickled.  (Copies
+    # made without the journal stop following it.)
+    def __getstate__(self):
+        self.sync()
+        state = dict(self.__dict__)
+        del state['reference']
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.reference = None
+        if self.journal is not None:
+            self.reference = self.journal.add_follower(self)
+
+
+
+def check_range(token_range, sentence_starts, num_tokens):
+    """
+    Raise a ValueError if `token_range` addresses tokens beyond those of a
+    document having `num_tokens` tokens, with sentences starting at
+    `sentence_starts`.
+    """
+    sentence_id, start, end = token_range
+    if sentence_id is None:
+        sentence_end = num_tokens
+    elif sentence_id >= len(sentence_starts):
+        sentence_end = None
+    elif sentence_id + 1 < len(sentence_starts):
+        sentence_end = (
+            sentence_starts[sentence_id + 1] - sentence_starts[sentence_id])
+    else:
+        sentence_end = num_tokens - sentence_starts[sentence_id]
+
+    if sentence_end is None or end > sentence_end:
+        raise ValueError(
+            'The token range %r addresses tokens beyond the end of the %s.'
+            % (token_range, 'document' if sentence_id is None else 'sentence')
+        )
+
+
+def shift_range(token_range, new_positions, sentence_starts):
+    """
+    Returns where `token_range` ends up after a batch of token edits, or None
+    if all of its tokens were deleted.  `new_positions[i]` is where the
+    boundary before token `i` moved to, and `sentence_starts` are the
+    absolute starts of sentences before the edits.
+    """
+    sentence_id, start, end = token_range
+    if sentence_id is None:
+        old_offset, new_offset = 0, 0
+    else:
+        old_offset = sentence_starts[sentence_id]
+        new_offset = new_positions[old_offset]
+
+    start = new_positions[start + old_offset] - new_offset
+    end = new_positions[end + old_offset] - new_offset
+    if start >= end:
+        return None
+    return sentence_id, start, end
+
+
+
 class Coreference(dict):
     def accomodate_inserted_token(self, sentence_id, index):
         pass
 
+    def follow_journal(self, journal):
+        pass
+
+    def follows_journal(self, journal):
+        return True
 
+
+
+    def map_token_spans(self, function):
+        pass
@@ -0,0 +1,118 @@
+'''
+A table of interned strings, shared across the corpus.  Strings that recur
+in every document (part-of-speech tags, lemmas, attribution roles,
+constituent labels, entity types) are interned while parsing, so that each is
+stored once, however many tokens or nodes carry it.  Each interned string
+also gets an integer code, for comparing and grouping as ints.  Tables can be
+saved and loaded, so that codes stay the same across processes.
+
+Interning never changes a value's type: a `str` and an equal `unicode` share
+a code, but each is interned as its own type.
+'''
+
+import json
+
+
+class StringTable(object):
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.codes = {}
+        self.interned = {}
+        for string in strings:
+            self.intern(string)
+
+
+    def __len__(self):
+        return len(self.strings)
+
+
+    def __contains__(self, string):
+        return string in self.codes
+
+
+    def intern(self, string):
+        '''
+        Returns the table's copy of `string`, adding it to the table if it's
+        new.  Anything other than a string is returned as is.
+        '''
+        if not isinstance(string, basestring):
+            return string
+        key = (type(string), string)
+        interned = self.interned.get(key)
+        if interned is None:
+            self.get_code(string)
+            interned = self.interned[key] = string
+        return interned
+
+
+    def get_code(self, string):
+        '''
+        Returns the integer code of `string`, adding it to the table if it's
+        new.
+        '''
+        code = self.codes.get(string)
+        if code is None:
+            code = len(self.strings)
+            self.codes[string] = code
+            self.strings.append(string)
+        return code
+
+
+    def get_string(self, code):
+        return self.strings[code]
+
+
+    def save(self, path):
+        '''
+        Write the table's strings to `path`, in order of their codes.
+        '''
+        with open(path, 'w') as table_file:
+            json.dump(self.strings, table_file)
+
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a table written by `save`.  Strings come back as (utf-8) `str`,
+        as the parsers produce them.
+        '''
+        with open(path) as table_file:
+            return cls([
+                string.encode('utf8') for string in json.load(table_file)])
+
+
+
+STRING_TABLE = StringTable()
+
+def intern_string(string):
+    return STRING_TABLE.intern(string)
+
+
+def intern_strings(value):
+    '''
+    Intern `value` if it's a string, or the strings in it if it's a tuple or
+    list (such as an entity type, or a list of attribution roles).
+    '''
+    if isinstance(value, tuple):
+        return tuple([intern_string(item) for item in value])
+    if isinstance(value, list):
+        return [intern_string(item) for item in value]
+    return intern_string(value)
+
+
+def get_code(string):
+    return STRING_TABLE.get_code(string)
+
+
+def get_string(code):
+    return STRING_TABLE.get_string(code)
+
+
+def set_string_table(table):
+    '''
+    Use `table` (e.g. one made with `StringTable.load`) as the shared table.
+    To keep codes stable across processes, do this before parsing anything.
+    '''
+    global STRING_TABLE
+    STRING_TABLE = table
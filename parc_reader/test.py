@@ -1,5 +1,14 @@
 from collections import defaultdict
+from StringIO import StringIO
 from unittest import main, TestCase
+import copy
+import gc
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from xml.dom import minidom
 import parc_reader as pr
 from parc_reader.new_reader import ParcCorenlpReader, ROLES
 import t4k
@@ -53,6 +62,296 @@ class TestAnnotatedDocument(TestCase):
         pass
 
 
+    def test_relativize(self):
+        doc = make_dummy_doc()
+        token_ranges = [(None, 1, 3), (None, 3, 6), (None, 4, 5)]
+
+        # Ranges crossing a sentence boundary get split
+        expected = [(0, 1, 3), (0, 3, 4), (1, 0, 2), (1, 0, 1)]
+        self.assertEqual(doc.relativize(token_ranges), expected)
+        self.assertEqual(
+            doc.relativize_many([token_ranges[1:], [], token_ranges[:1]]),
+            [expected[1:], [], expected[:1]]
+        )
+        self.assertEqual(
+            doc.absolutize(expected),
+            [(None, 1, 3), (None, 3, 4), (None, 4, 6), (None, 4, 5)]
+        )
+        self.assertEqual(
+            doc.absolutize_many([expected[:1], expected[3:]]),
+            [[(None, 1, 3)], [(None, 4, 5)]]
+        )
+
+        # Ranges outside of the sentences can't be relativized
+        self.assertRaises(ValueError, doc.relativize, [(None, 8, 10)])
+        self.assertRaises(ValueError, doc.relativize_many, [[(None, 9, 10)]])
+
+
+    def test_token_views(self):
+        doc = make_dummy_doc()
+        view = doc.get_tokens([(0, 2, 4), (1, 1, 3)])
+        self.assertTrue(isinstance(view, pr.token_list.TokenView))
+        self.assertEqual(view.text(), 'three four six seven')
+        self.assertEqual(view.ranges, [(2, 4), (5, 7)])
+
+        # Views share the document's tokens, and can be indexed and sliced
+        self.assertIs(view[2], doc.tokens[5])
+        self.assertEqual(view[-1]['text'], 'seven')
+        self.assertEqual(view[1:3].text(), 'four six')
+        self.assertEqual(doc.get_tokens_abs([(None, 6, 20)]).text(),
+            'seven eight')
+
+
+    def test_batch_token_edits(self):
+        tokens = [
+            {'text':text} for text in
+            ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight']
+        ]
+        sentences = [
+            {'token_span': [(None, 0, 4)]}, {'token_span': [(None, 4, 8)]}]
+        doc = pr.annotated_document.AnnotatedDocument(
+            tokens=tokens, sentences=sentences)
+        entity = pr.spans.Span({'token_span': [(None, 2, 5)]}, absolute=True)
+        attribution = pr.spans.Attribution({
+            'source': [(0, 3, 4)], 'cue': [(1, 0, 2)], 'content': [(1, 1, 2)]
+        })
+        doc.annotations = {
+            'entities': {0: entity}, 'attributions': {0: attribution}}
+
+        edits = doc.batch_token_edits()
+        edits.insert_token_after({'text': 'zero'}, -1)
+        edits.insert_token_after({'text': 'and'}, 3)
+        edits.delete_token(5)
+        edits.apply()
+
+        # Annotation spans aren't shifted until they are read
+        self.assertEqual(doc.journal.version, 1)
+        self.assertEqual(entity['token_span'].journal_version, 0)
+        self.assertEqual(list(entity['token_span']), [(None, 3, 7)])
+        self.assertEqual(entity['token_span'].journal_version, 1)
+
+        # Inserted tokens join the spans of the token they follow
+        self.assertEqual(
+            doc.tokens.text(), 'zero one two three four and five seven eight')
+        self.assertEqual(
+            doc.get_sentence_tokens(0).text(), 'zero one two three four and')
+        self.assertEqual(
+            doc.get_tokens_abs(entity).text(), 'three four and five')
+        self.assertEqual(
+            doc.get_tokens(attribution['source']).text(), 'four and')
+
+        # Spans left without tokens are dropped, and tokens are renumbered
+        self.assertEqual(doc.get_tokens(attribution['cue']).text(), 'five')
+        self.assertEqual(list(attribution['content']), [])
+        self.assertEqual(
+            [(t['abs_id'], t['sentence_id'], t['id']) for t in doc.tokens[5:]],
+            [(5, 0, 5), (6, 1, 0), (7, 1, 1), (8, 1, 2)]
+        )
+
+        # A split token's remainder can itself be split
+        with doc.batch_token_edits() as edits:
+            token, remainder = edits.split_token(doc.tokens[2], 'tw')
+            self.assertEqual(token['text'], 'tw')
+            edits.split_token(edits.split_token(doc.tokens[7], 'se')[1], 'v')
+        self.assertEqual(
+            doc.get_sentence_tokens(1).text(), 'five se v en eight')
+        self.assertEqual(
+            doc.get_tokens_abs(entity).text(), 'three four and five')
+
+        # Sentences can't lose all of their tokens
+        edits = doc.batch_token_edits()
+        for abs_index in range(7):
+            edits.delete_token(abs_index)
+        self.assertRaises(ValueError, edits.apply)
+
+
+    def test_edit_journal(self):
+        tokens = [
+            {'text':text} for text in
+            ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight']
+        ]
+        sentences = [
+            {'token_span': [(None, 0, 4)]}, {'token_span': [(None, 4, 8)]}]
+        doc = pr.annotated_document.AnnotatedDocument(
+            tokens=tokens, sentences=sentences)
+        entity = pr.spans.Span({'token_span': [(None, 2, 5)]}, absolute=True)
+        doc.annotations = {'entities': {0: entity}}
+
+        # Edits are dropped once every following span has replayed them
+        doc.insert_token_after({'text': 'zero'}, -1)
+        doc.insert_token_after({'text': 'and'}, 3)
+        self.assertEqual(len(doc.journal.edits), 2)
+        self.assertEqual(list(entity['token_span']), [(None, 3, 7)])
+        doc.delete_token(0)
+        self.assertEqual(doc.journal.version, 3)
+        self.assertEqual(len(doc.journal.edits), 1)
+
+        # Spans keep following the journal once unpickled
+        doc, entity = pickle.loads(pickle.dumps((doc, entity)))
+        self.assertEqual(doc.journal.follower_counts, {3: 3})
+        doc.delete_token(0)
+        self.assertEqual(entity['token_span'].journal_version, 3)
+        self.assertEqual(len(doc.journal.edits), 1)
+        self.assertEqual(
+            doc.get_tokens_abs(entity).text(), 'three and four five')
+
+        # Annotations addressing tokens that don't exist are refused
+        doc.annotations['entities'][1] = pr.spans.Span(
+            {'token_span': [(1, 2, 9)]})
+        self.assertRaises(ValueError, doc.delete_token, 0)
+
+
+    def test_journal_followers(self):
+        tokens = [
+            {'text':text} for text in ['one', 'two', 'three', 'four', 'five']]
+        sentences = [{'token_span': [(None, 0, 5)]}]
+        doc = pr.annotated_document.AnnotatedDocument(
+            tokens=tokens, sentences=sentences)
+        span = pr.spans.TokenSpan([(0, 1, 3)])
+        span.follow_journal(doc.journal)
+        doc.delete_token(0)
+
+        # Every way of reading the span sees the edits
+        self.assertTrue((0, 0, 2) in span)
+        self.assertFalse((0, 1, 3) in span)
+        self.assertEqual(span + [], [(0, 0, 2)])
+        self.assertEqual([] + span, [(0, 0, 2)])
+        self.assertEqual(span.index((0, 0, 2)), 0)
+        self.assertEqual(span.count((0, 0, 2)), 1)
+        self.assertEqual(list(reversed(span)), [(0, 0, 2)])
+
+        # Edits made to the list itself come after those in the journal
+        doc.delete_token(0)
+        span.append((0, 2, 3))
+        self.assertEqual(list(span), [(0, 0, 1), (0, 2, 3)])
+
+        # Spans that are thrown away without being read stop holding on to
+        # the journal's edits
+        doc.delete_token(0)
+        self.assertEqual(len(doc.journal.edits), 1)
+        del span
+        gc.collect()
+        doc.delete_token(0)
+        self.assertEqual(len(doc.journal.edits), 0)
+
+
+    def test_journal_cursors(self):
+        tokens = [
+            {'text':text} for text in ['one', 'two', 'three', 'four', 'five']]
+        sentences = [{'token_span': [(None, 0, 5)]}]
+        doc = pr.annotated_document.AnnotatedDocument(
+            tokens=tokens, sentences=sentences)
+        leaf = pr.spans.Constituency({'token_span': [(0, 3, 4)]})
+        tree = pr.spans.Constituency({
+            'token_span': [(0, 1, 4)],
+            'constituent_children': [
+                pr.spans.Constituency({
+                    'token_span': [(0, 1, 4)], 'constituent_children': [leaf]
+                })
+            ]
+        })
+        attribution = pr.spans.Attribution({
+            'source': [(0, 0, 1)], 'cue': [(0, 1, 2)], 'content': [(0, 2, 5)]
+        })
+        doc.annotations = {
+            'constituencies': {0: tree}, 'attributions': {0: attribution}}
+
+        # A parse tree, like an attribution, is counted by the journal once,
+        # and reading any of its spans brings the whole tree up to date.
+        doc.delete_token(0)
+        followers = set(doc.journal.followers)
+        self.assertEqual(len(followers), 3)
+        self.assertEqual(list(leaf['token_span']), [(0, 2, 3)])
+        self.assertEqual(tree['token_span'].journal_version, 1)
+        self.assertEqual(set(doc.journal.followers), followers)
+
+        # Lengths, copies, and pickles see the edits too
+        doc.delete_token(0)
+        self.assertEqual(len(attribution['cue']), 0)
+        doc.delete_token(0)
+        self.assertEqual(list(copy.deepcopy(leaf['token_span'])), [(0, 0, 1)])
+        doc.delete_token(0)
+        span = pickle.loads(pickle.dumps(attribution['content']))
+        self.assertEqual(list(span), [(0, 0, 1)])
+        self.assertEqual(list(copy.copy(attribution['content'])), [(0, 0, 1)])
+
+
+    def test_merge_tokens(self):
+        def make_doc(texts, sentence_lengths, fields={}):
+            tokens = [dict(fields, text=text) for text in texts]
+            sentences, start = [], 0
+            for length in sentence_lengths:
+                sentences.append({'token_span': [(None, start, start+length)]})
+                start += length
+            return pr.annotated_document.AnnotatedDocument(
+                tokens=tokens, sentences=sentences)
+
+        # Local tokens get split, merged, or left unmatched relative to `other`
+        doc = make_doc(
+            ['Smith', "'s", 'U.S.', 'can', 'not', '.', 'It'], [6, 1],
+            {'entity': None}
+        )
+        other = make_doc(['Smith', "'", 's', 'U.S', '.', 'cannot', 'It'], [6, 1])
+        for abs_index, token in enumerate(other.tokens):
+            token['entity'] = 'E%d' % abs_index
+        other.annotations['entities'] = {}
+
+        alignment = doc.merge_tokens(other, ['entity'], ['entities'])
+        self.assertEqual(
+            doc.get_sentence_tokens(0).text(), "Smith ' s U.S . can not .")
+        self.assertEqual(
+            [token['entity'] for token in doc.tokens],
+            ['E0', 'E1', 'E2', 'E3', 'E4', 'E5', 'E5', None, 'E6']
+        )
+        self.assertEqual(doc.annotations['entities'], {})
+
+        # The returned alignment goes from `other`'s tokens to the local ones
+        self.assertEqual(alignment.groups, [
+            ((0,1), (0,1)), ((1,2), (1,2)), ((2,3), (2,3)), ((3,4), (3,4)),
+            ((4,5), (4,5)), ((5,6), (5,7)), ((6,6), (7,8)), ((6,7), (8,9))
+        ])
+        self.assertEqual(
+            list(alignment.project_span([(None, 1, 3), (None, 5, 7)])),
+            [(None, 1, 3), (None, 5, 9)]
+        )
+        self.assertEqual(
+            list(alignment.invert().project_span([(None, 5, 8)])),
+            [(None, 5, 6)]
+        )
+
+        # Copied annotations are projected onto the merged tokens
+        doc = make_doc(['Smith', "'s", 'house', 'can', 'not', '.'], [6])
+        other = make_doc(['Smith', "'", 's', 'house', 'cannot', '.'], [6])
+        other.annotations['entities'] = {
+            0: pr.spans.Span({'token_span': [(0, 3, 4)]}),
+            1: pr.spans.Span({'token_span': [(0, 4, 5)]}),
+            2: pr.spans.Span({'token_span': [(None, 1, 3)]}, absolute=True),
+        }
+        doc.merge_tokens(other, [], ['entities'])
+        entities = doc.annotations['entities']
+        self.assertEqual(doc.get_tokens(entities[0]).text(), 'house')
+        self.assertEqual(doc.get_tokens(entities[1]).text(), 'can not')
+        self.assertEqual(doc.get_tokens_abs(entities[2]).text(), "' s")
+        self.assertEqual(list(entities[1]['token_span']), [(0, 4, 6)])
+
+        # The annotations of `other` are left as they were
+        self.assertEqual(
+            list(other.annotations['entities'][1]['token_span']), [(0, 4, 5)])
+
+        # Documents whose texts differ too much aren't aligned
+        doc = make_doc(['abc', 'def'], [2])
+        other = make_doc(['xyz', 'def'], [2])
+        self.assertRaises(
+            ValueError, doc.merge_tokens, other, [], [], max_edits=5)
+        self.assertEqual(
+            pr.token_alignment.align_tokens(
+                doc.tokens, other.tokens, max_edits=6).groups,
+            [((0,1), (0,1)), ((1,2), (1,2))]
+        )
+        self.assertRaises(
+            ValueError, pr.token_alignment.diff, 'a' * 10, 'a' * 100000, 5)
+
+
 
 class TestReadCoreferenceAnnotations(TestCase):
 
@@ -175,8 +474,492 @@ class TestMergingPropbankVerbs(TestCase):
 
 
 
+class TestLemmaIndex(TestCase):
+
+    def test_find_nearest_matching_token(self):
+        lemmas = ['say', 'make', 'the', 'say', 'mak', 'go', 'said', 'say']
+        tokens = [
+            {'text': lemma, 'lemma': lemma, 'pos': 'VB'} for lemma in lemmas]
+        doc = pr.annotated_document.AnnotatedDocument(
+            tokens=tokens,
+            sentences=[{'token_span': [(None, 0, 4)]},
+                {'token_span': [(None, 4, 8)]}]
+        )
+        index = pr.bnp_pronouns_reader.LemmaIndex(doc)
+        find = pr.bnp_pronouns_reader.find_nearest_matching_token
+
+        # Exact matches prefer later tokens at the same distance
+        self.assertIs(find(doc, 0, 2, 'say', index), doc.tokens[3])
+        self.assertIs(find(doc, 1, 3, 'say', index), doc.tokens[7])
+
+        # Lemmas may lack an "e"
+        self.assertIs(find(doc, 1, 1, 'make', index), doc.tokens[4])
+
+        # Otherwise the verb having the most characters in common is used
+        self.assertIs(find(doc, 1, 2, 'sad', index), doc.tokens[6])
+
+
+
+
+
+
+
+
+class TestReadBbnFiles(TestCase):
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.pron_path = os.path.join(self.data_dir, 'WSJ.pron')
+        self.sent_path = os.path.join(self.data_dir, 'WSJ.sent')
+        pron_file = open(self.pron_path, 'w')
+        sent_file = open(self.sent_path, 'w')
+        for doc_id in [1, 3, 4, 7]:
+            pron_file.write(
+                '(WSJ%04d\n    (\n'
+                '\tAntecedent -> S1:1-2 -> Doc %d\n'
+                '\tPronoun -> S2:1-1 -> it\n    )\n)\n' % (doc_id, doc_id)
+            )
+            sent_file.write(
+                '(WSJ%04d\n\tS1: Doc %d works .\n\tS2: it does .\n)\n'
+                % (doc_id, doc_id)
+            )
+        pron_file.close()
+        sent_file.close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.data_dir)
+
+
+    def test_skip_and_limit(self):
+        offsets = pr.bnp_pronouns_reader.get_doc_offsets(self.sent_path)
+        self.assertEqual([doc_id for doc_id, offset in offsets], [1, 3, 4, 7])
+
+        for use_index in [True, False]:
+            sentences = (
+                pr.bnp_pronouns_reader.read_coreference_sentences_from_disk(
+                    self.sent_path, limit=7, skip=2, use_index=use_index))
+            self.assertEqual(sorted(sentences), [3, 4])
+            self.assertEqual(sentences[4]['tokens'].text(),
+                'Doc 4 works . it does .')
+
+            corefs = (
+                pr.bnp_pronouns_reader.read_coreference_information_from_disk(
+                    self.pron_path, limit=7, skip=2, use_index=use_index))
+            self.assertEqual(sorted(corefs), [3, 4])
+            coreferences, mentions = corefs[3]
+            self.assertEqual(mentions[0]['text'], 'Doc 3')
+            self.assertEqual(list(mentions[1]['token_span']), [(1, 0, 1)])
+
+        # Documents can also be read one at a time
+        docs = pr.bnp_pronouns_reader.iter_coreference_annotations(
+            self.pron_path, self.sent_path, skip=2, limit=7)
+        self.assertEqual(next(docs)[0], 3)
+        self.assertEqual([doc_id for doc_id, doc in docs], [4])
+
+
+    def test_doc_offset_cache(self):
+
+        # With a cache, the index outlives the process that built it.
+        cache = pr.doc_cache.DocumentCache(os.path.join(self.data_dir, 'cache'))
+        self.assertEqual(
+            pr.bnp_pronouns_reader.get_doc_offsets(self.pron_path, cache),
+            pr.bnp_pronouns_reader.index_bbn_file(self.pron_path)
+        )
+        index_bbn_file = pr.bnp_pronouns_reader.index_bbn_file
+        pr.bnp_pronouns_reader.DOC_OFFSET_INDEXES.clear()
+        pr.bnp_pronouns_reader.index_bbn_file = None
+        try:
+            offsets = pr.bnp_pronouns_reader.get_doc_offsets(
+                self.pron_path, cache)
+        finally:
+            pr.bnp_pronouns_reader.index_bbn_file = index_bbn_file
+            pr.bnp_pronouns_reader.DOC_OFFSET_INDEXES.clear()
+        self.assertEqual([doc_id for doc_id, offset in offsets], [1, 3, 4, 7])
+
+
+    def test_entity_type_doc_strings(self):
+        lines = [
+            '<DOC>\n', '<DOCNO> WSJ0001 </DOCNO>\n',
+            'Pierre <ENAMEX TYPE="PERSON">Vinken</ENAMEX>\n',
+            '</DOC><DOC><DOCNO> WSJ0002 </DOCNO> Mr. </DOC>\n',
+            '<DOC>\n', '<DOCNO> WSJ0003 </DOCNO>\n', '</DOC>\n',
+        ]
+        doc_strings = list(
+            pr.bnp_pronouns_reader.iter_entity_type_doc_strings(lines))
+        self.assertEqual([doc_id for doc_id, xml in doc_strings], [1, 2, 3])
+        self.assertEqual(
+            doc_strings[1][1], '<DOC><DOCNO> WSJ0002 </DOCNO> Mr. </DOC>')
+
+        # Documents past the limit aren't parsed
+        docs = pr.bnp_pronouns_reader.iter_entity_type_docs(lines, limit=1)
+        self.assertEqual(list(docs), [None])
+
+
+    def test_propbank_verb_index(self):
+        propbank_path = os.path.join(self.data_dir, 'vloc.txt')
+        open(propbank_path, 'w').write(
+            'wsj/00/wsj_0001.mrg 0 8 join\n'
+            'wsj/00/wsj_0001.mrg 1 2 be\n'
+            'wsj/00/wsj_0003.mrg 0 4 use\n'
+            '\n'
+            'wsj/00/wsj_0001.mrg 2 0 say\n'
+        )
+        expected = pr.bnp_pronouns_reader.read_propbank_verbs(propbank_path)
+        self.assertEqual(
+            expected[1], [(0, 8, 'join'), (1, 2, 'be'), (2, 0, 'say')])
+
+        # With a cache, the index is only built once.
+        indexed = []
+        index_propbank_file = pr.bnp_pronouns_reader.index_propbank_file
+        def counting_index_propbank_file(path):
+            indexed.append(path)
+            return index_propbank_file(path)
+        self.addCleanup(
+            setattr, pr.bnp_pronouns_reader, 'index_propbank_file',
+            index_propbank_file
+        )
+        pr.bnp_pronouns_reader.index_propbank_file = (
+            counting_index_propbank_file)
+        cache = pr.doc_cache.DocumentCache(os.path.join(self.data_dir, 'cache'))
+        for i in range(2):
+            index = pr.bnp_pronouns_reader.PropbankVerbIndex(
+                propbank_path, cache)
+            self.assertEqual(index.keys(), [1, 3])
+            self.assertEqual(index[1], expected[1])
+            self.assertEqual(index[3], expected[3])
+            self.assertEqual(index[2], [])
+        self.assertEqual(indexed, [propbank_path])
+
+        # Without one, nothing is written.
+        data_files = sorted(os.listdir(self.data_dir))
+        self.assertEqual(
+            pr.bnp_pronouns_reader.read_propbank_verbs(propbank_path, [3]),
+            {3: expected[3]}
+        )
+        self.assertEqual(sorted(os.listdir(self.data_dir)), data_files)
+
+
 
+class TestMergeShards(TestCase):
 
+    def make_shard(self, doc_id):
+        def make_doc(texts, **annotations):
+            return pr.annotated_document.AnnotatedDocument(
+                tokens=[
+                    {'text': text, 'lemma': text.lower(), 'pos': 'VB'}
+                    for text in texts
+                ],
+                sentences=[{'token_span': [(None, 0, len(texts))]}],
+                annotations=annotations
+            )
+
+        coreference_doc = make_doc(['They', 'ran', '.'], coreferences={})
+        entity_doc = make_doc(['They', 'ran', '.'], entities={})
+        for token in entity_doc.tokens:
+            token['entity'] = 0 if token['text'] == 'They' else None
+        attribution_doc = make_doc(['They', 'ran.'])
+        propbank_verbs = [(0, 1, 'ran.')]
+        return doc_id, [], [
+            coreference_doc, attribution_doc, entity_doc, propbank_verbs]
+
+
+    def test_merge_shards(self):
+        bad_shard = self.make_shard(3)
+        bad_shard[2][0] = None
+        unpicklable_shard = self.make_shard(5)
+        unpicklable_shard[2][3] = lambda: None
+        shards = [
+            self.make_shard(1), (2, ['entity'], None), bad_shard,
+            self.make_shard(4), unpicklable_shard
+        ]
+
+        # Shards can be read as they are merged
+        for workers in [None, 2]:
+            results = list(pr.bnp_pronouns_reader.iter_merged_shards(
+                iter(shards), workers))
+            self.assertEqual(
+                [doc_id for doc_id, doc, f in results], [1, 2, 3, 4, 5])
+
+            doc = results[0][1]
+            self.assertEqual(doc.tokens.text(), 'They ran .')
+            self.assertEqual(doc.tokens[0]['entity'], 0)
+            self.assertEqual(
+                doc.get_tokens(doc.annotations['propbank_verbs'][0]).text(),
+                'ran'
+            )
+
+            failures = [failure for doc_id, doc, failure in results]
+            self.assertEqual(failures[1], {
+                'doc_id': 2, 'stage': 'load', 'missing': ['entity'],
+                'error': None
+            })
+            self.assertEqual(failures[2]['stage'], 'merge')
+            self.assertEqual(failures[3], None)
+
+            # Shards that can't be sent to a worker fail in their own stage
+            expected_stage = 'merge' if workers is None else 'transport'
+            self.assertEqual(failures[4]['stage'], expected_stage)
+
+
+    def test_shard_read_errors(self):
+        def iter_failing_shards(num_shards):
+            for doc_id in range(num_shards):
+                yield self.make_shard(doc_id)
+            raise IOError('unreadable')
+
+        # Errors reading the shards are raised, even before the first shard
+        for workers in [None, 2]:
+            for num_shards in [0, 2]:
+                results = pr.bnp_pronouns_reader.iter_merged_shards(
+                    iter_failing_shards(num_shards), workers)
+                with self.assertRaises(IOError):
+                    list(results)
+
+
+
+def load_or_fail(doc_num, offset):
+    if doc_num == 1:
+        raise IOError('missing')
+    if doc_num == 2:
+        raise KeyError('bad')
+    if doc_num == 3:
+        return lambda: offset
+    return doc_num + offset
+
+
+class TestLoadedDocs(TestCase):
+
+    def test_iter_loaded_docs(self):
+        loaded_docs = pr.parc_dataset.iter_loaded_docs(
+            load_or_fail, [0, 1, 4], (10,))
+        self.assertEqual(list(loaded_docs), [(0, 10), (1, None), (4, 14)])
+
+        # Loading serially, errors other than missing or malformed files are
+        # raised
+        loaded_docs = pr.parc_dataset.iter_loaded_docs(
+            load_or_fail, range(4), (10,))
+        with self.assertRaises(KeyError):
+            list(loaded_docs)
+
+        # The same goes in a pool
+        loaded_docs = pr.parc_dataset.iter_loaded_docs(
+            load_or_fail, range(4), (10,), 2)
+        with self.assertRaises(KeyError):
+            list(loaded_docs)
+
+        # Documents that can't be sent back from a worker are reported, and
+        # the rest are still loaded
+        failures = []
+        loaded_docs = pr.parc_dataset.iter_loaded_docs(
+            load_or_fail, [0, 1, 3, 4], (10,), 2, failures)
+        self.assertEqual(
+            list(loaded_docs), [(0, 10), (1, None), (3, None), (4, 14)])
+        self.assertEqual(
+            [(f['doc_id'], f['stage']) for f in failures], [(3, 'transport')])
+
+
+
+class TestCorpusManifest(TestCase):
+
+    def test_manifest_notices_new_files(self):
+        settings = pr.parc_dataset.SETTINGS
+        dir_names = ['DATA_DIR'] + [
+            '%s_%s_DIR' % (kind, split)
+            for kind in ['PARC', 'CORENLP', 'RAW']
+            for split in ['TRAIN', 'TEST', 'DEV']
+        ]
+        old_dirs = dict((name, getattr(settings, name)) for name in dir_names)
+        temp_dir = tempfile.mkdtemp()
+        try:
+            for name in dir_names:
+                setattr(settings, name, os.path.join(temp_dir, name))
+                os.makedirs(getattr(settings, name))
+            os.makedirs(os.path.join(settings.PARC_TRAIN_DIR, '00'))
+            open(pr.parc_dataset.get_parc_path(5), 'w').write('<doc/>')
+            manifest = pr.parc_dataset.get_manifest(refresh=True)
+            self.assertEqual(manifest[5]['raw'], None)
+
+            # A manifest read from disk is rebuilt when its directories change
+            raw_path = pr.parc_dataset.get_raw_path(5)
+            open(raw_path, 'w').write('text')
+            later = time.time() + 10
+            os.utime(settings.RAW_TRAIN_DIR, (later, later))
+            pr.parc_dataset._manifest = None
+            manifest = pr.parc_dataset.get_manifest()
+            self.assertEqual(manifest[5]['raw']['path'], raw_path)
+            self.assertTrue(pr.parc_dataset.article_exists(5, ['parc', 'raw']))
+
+        finally:
+            for name, dirname in old_dirs.items():
+                setattr(settings, name, dirname)
+            pr.parc_dataset._manifest = None
+            shutil.rmtree(temp_dir)
+
+
+    def test_manifest_matches_files(self):
+        manifest = pr.parc_dataset.get_manifest(refresh=True)
+        path_getters = pr.parc_dataset.SOURCE_PATH_GETTERS
+        for doc_num in range(0, 2500, 7):
+            entry = manifest[doc_num]
+            self.assertEqual(
+                entry['split'], pr.parc_dataset.get_split(doc_num))
+            for kind, get_path in path_getters.items():
+                path = get_path(doc_num)
+                self.assertEqual(entry[kind] is not None, os.path.exists(path))
+                if entry[kind] is not None:
+                    self.assertEqual(entry[kind]['path'], path)
+                    self.assertEqual(
+                        entry[kind]['size'], os.path.getsize(path))
+
+
+    def test_iter_doc_num_require(self):
+        doc_nums = list(pr.parc_dataset.iter_doc_num(
+            'train', limit=300, require=['parc', 'raw']))
+        for doc_num in range(300):
+            exists = (
+                os.path.exists(pr.parc_dataset.get_parc_path(doc_num))
+                and os.path.exists(pr.parc_dataset.get_raw_path(doc_num))
+            )
+            self.assertEqual(doc_num in doc_nums, exists)
+
+
+
+class TestDocumentCache(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.source_path = os.path.join(self.cache_dir, 'source.txt')
+        open(self.source_path, 'w').write('one two three')
+        self.cache = pr.doc_cache.DocumentCache(
+            os.path.join(self.cache_dir, 'cache'))
+        self.num_builds = 0
+
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+    def build(self, path):
+        self.num_builds += 1
+        return open(path).read().split()
+
+
+    def load(self, key='doc'):
+        return self.cache.load(
+            key, [self.source_path], self.build, self.source_path)
+
+
+    def test_document_cache(self):
+
+        # The document is built once, and then read from its snapshot.
+        self.assertEqual(self.load(), ['one', 'two', 'three'])
+        self.assertEqual(self.load(), ['one', 'two', 'three'])
+        self.assertEqual(self.num_builds, 1)
+
+        # Changing the source makes the snapshot stale.
+        open(self.source_path, 'w').write('four five')
+        self.assertEqual(self.load(), ['four', 'five'])
+        self.assertEqual(self.num_builds, 2)
+
+
+    def test_document_cache_eviction(self):
+        self.load('doc-1')
+        snapshot_size = sum(
+            size for _, size, _ in self.cache.iter_snapshots())
+
+        # Only room for two snapshots.  Using the first one should keep it
+        # from being evicted when a third is added.
+        self.cache.max_bytes = 2 * snapshot_size
+        self.load('doc-2')
+        first_path = self.cache.get_snapshot_path('doc-1', [self.source_path])
+        os.utime(first_path, (time.time() + 10, time.time() + 10))
+        self.load('doc-3')
+
+        self.assertEqual(len(list(self.cache.iter_snapshots())), 2)
+        self.load('doc-1')
+        self.assertEqual(self.num_builds, 3)
+        self.load('doc-2')
+        self.assertEqual(self.num_builds, 4)
+
+
+    def test_document_cache_walks_only_when_full(self):
+        walks = []
+        iter_snapshots = self.cache.iter_snapshots
+        def counting_iter_snapshots():
+            walks.append(1)
+            return iter_snapshots()
+        self.cache.iter_snapshots = counting_iter_snapshots
+
+        # The directory is walked to find the size of the cache at first, and
+        # then only once the running total goes over the limit.
+        for key in range(5):
+            self.load(key)
+        self.assertEqual(len(walks), 1)
+        self.cache.max_bytes = self.cache.total_bytes
+        self.load('one-too-many')
+        self.assertEqual(len(walks), 2)
+        self.assertTrue(self.cache.total_bytes <= self.cache.max_bytes)
+
+
+    def test_document_cache_total(self):
+        def get_actual_total():
+            return sum(size for _, size, _ in self.cache.iter_snapshots())
+
+        # Stale and unreadable snapshots stop counting once replaced.
+        self.load('doc-1')
+        self.load('doc-2')
+        open(self.source_path, 'w').write('four five six seven')
+        self.load('doc-1')
+        self.assertEqual(self.cache.total_bytes, get_actual_total())
+        second_path = self.cache.get_snapshot_path('doc-2', [self.source_path])
+        garbage = 'x' * os.path.getsize(second_path)
+        open(second_path, 'wb').write(garbage)
+        self.load('doc-2')
+        self.assertEqual(self.cache.total_bytes, get_actual_total())
+
+
+    def test_document_cache_touched_source(self):
+        hashes = []
+        hash_file = pr.doc_cache.hash_file
+        def counting_hash_file(path):
+            hashes.append(path)
+            return hash_file(path)
+        pr.doc_cache.hash_file = counting_hash_file
+        self.addCleanup(setattr, pr.doc_cache, 'hash_file', hash_file)
+
+        # Touching the source only causes it to be hashed once, after which
+        # the snapshot records its new modification time.
+        self.load()
+        os.utime(self.source_path, (time.time() + 10, time.time() + 10))
+        self.load()
+        self.load()
+        self.assertEqual(self.num_builds, 1)
+        self.assertEqual(len(hashes), 2)
+
+        # No temporary files are left behind.
+        self.assertEqual(
+            [fname for fname in os.listdir(self.cache.cache_dir)
+                if not fname.endswith(pr.doc_cache.SNAPSHOT_EXTENSION)],
+            []
+        )
+
+
+    def test_document_cache_evicted_on_read(self):
+        self.load()
+        utime = os.utime
+        def evicting_utime(path, times):
+            os.remove(path)
+            utime(path, times)
+
+        # A snapshot evicted by another process just as it is read is
+        # rebuilt.
+        pr.doc_cache.os.utime = evicting_utime
+        try:
+            self.assertEqual(self.load(), ['one', 'two', 'three'])
+        finally:
+            pr.doc_cache.os.utime = utime
+        self.assertEqual(self.num_builds, 2)
 
 
 
@@ -222,6 +1005,51 @@ class TestTokenSpan(TestCase):
         self.assertEqual(t1, t2)
 
 
+    def test_add_token_range_keeps_consolidated(self):
+        span = pr.spans.TokenSpan([(1,0,2), (0,5,6)])
+        span.add_token_range((1,2,4))
+        span.add_token_range((0,0,1))
+        self.assertEqual(list(span), [(0,0,1), (0,5,6), (1,0,4)])
+        self.assertTrue(span.consolidated)
+
+        # A range that comes before the last one (by sentence) un-sorts a
+        # span that skips consolidation.
+        span = pr.spans.TokenSpan([(1,0,2)])
+        span.add_token_range((0,3,4), skip_consolidation=True)
+        self.assertFalse(span.consolidated)
+
+
+    def test_append_range(self):
+        ranges = []
+        for token_range in [(None,0,1), (None,1,2), (None,1,3), (None,4,5)]:
+            pr.spans.append_range(ranges, token_range)
+        self.assertEqual(ranges, [(None,0,3), (None,4,5)])
+
+        span = pr.spans.TokenSpan(absolute=True)
+        span.assign_consolidated(ranges)
+        self.assertEqual(span, pr.spans.TokenSpan([(0,3), (4,5)], absolute=True))
+        self.assertTrue(span.consolidated)
+
+
+    def test_set_operations(self):
+        span1 = pr.spans.TokenSpan([(0,0,4), (0,6,8), (1,0,3)])
+        span2 = pr.spans.TokenSpan([(0,2,7), (1,2,5)])
+        self.assertEqual(
+            list(span1.union(span2)), [(0,0,8), (1,0,5)])
+        self.assertEqual(
+            list(span1.intersection(span2)),
+            [(0,2,4), (0,6,7), (1,2,3)]
+        )
+        self.assertEqual(
+            list(span1.difference(span2)), [(0,0,2), (0,7,8), (1,0,2)])
+        self.assertEqual(span1.overlap_length(span2), 4)
+        self.assertEqual(span1.overlap_length([]), 0)
+
+        absolute_span = pr.spans.TokenSpan([(0,2)], absolute=True)
+        with self.assertRaises(ValueError):
+            span1.union(absolute_span)
+
+
     def test_good_span(self):
         pr.spans.TokenSpan(single_range=(0,0,1))
         pr.spans.TokenSpan(single_range=(0,1), absolute=True)
@@ -254,6 +1082,97 @@ class TestTokenSpan(TestCase):
         self.assertEqual(span, pr.spans.TokenSpan([(0,0,4), (1,4,9)]))
 
 
+class TestToken(TestCase):
+
+    def test_token(self):
+        token = pr.token_list.Token(
+            {'text': 'Pierre', 'word': '0', 'gorn': '0,0,0'}, entity=3)
+
+        # Numeric fields are parsed; other fields work as in a dict
+        self.assertEqual(token['word'], 0)
+        self.assertEqual(token['gorn'], '0,0,0')
+        self.assertEqual(token['entity'], 3)
+        token['is_propbank_verb'] = True
+        self.assertEqual(
+            dict(token), {
+                'text': 'Pierre', 'word': 0, 'gorn': '0,0,0', 'entity': 3,
+                'is_propbank_verb': True
+            }
+        )
+        self.assertRaises(KeyError, lambda: token['lemma'])
+        self.assertEqual(token.get('lemma'), None)
+        self.assertFalse('lemma' in token)
+
+        # Copies are independent
+        copy = token.copy()
+        copy['text'] = 'Vinken'
+        self.assertEqual(token['text'], 'Pierre')
+        self.assertEqual(t4k.select(copy, ['text', 'entity']),
+            {'text': 'Vinken', 'entity': 3})
+
+        self.assertEqual(pickle.loads(pickle.dumps(token, 2)), token)
+        self.assertEqual(pickle.loads(pickle.dumps(token)), token)
+
+
+    def test_string_table(self):
+        table = pr.string_table.StringTable(['NN', 'VBD'])
+        say = ''.join(['s', 'ay'])
+        self.assertIs(table.intern(say), table.intern('say'))
+        self.assertEqual(table.get_code('VBD'), 1)
+        self.assertEqual(table.get_string(2), 'say')
+
+        # Codes stay the same in a saved table
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'strings.json')
+            table.save(path)
+            loaded = pr.string_table.StringTable.load(path)
+        finally:
+            shutil.rmtree(temp_dir)
+        self.assertEqual(
+            [loaded.get_code(s) for s in ['say', 'NN', 'VBD', 'new']],
+            [2, 0, 1, 3]
+        )
+
+        # Interning doesn't change a string's type
+        self.assertTrue(isinstance(loaded.intern('NN'), str))
+        self.assertTrue(isinstance(loaded.intern(u'NN'), unicode))
+        self.assertEqual(loaded.get_code(u'NN'), 0)
+
+        # Labels are interned again when spans are unpickled
+        span = pr.spans.Span({
+            'constituent_type': ''.join(['n', 'p']),
+            'entity_type': ('ENAMEX', ''.join(['PER', 'SON'])),
+            'roles': [''.join(['cu', 'e'])]
+        })
+        span = pickle.loads(pickle.dumps(span, pickle.HIGHEST_PROTOCOL))
+        self.assertIs(
+            span['constituent_type'], pr.string_table.intern_string('np'))
+        self.assertIs(
+            span['entity_type'][1], pr.string_table.intern_string('PERSON'))
+        self.assertIs(span['roles'][0], pr.string_table.intern_string('cue'))
+
+
+    def test_parsed_tokens(self):
+        path = os.path.join(
+            os.path.dirname(pr.__file__), 'data', 'example-parc-1.xml')
+        doc = pr.new_parc_annotated_text.read_parc_file(open(path).read())
+        token = doc.tokens[1]
+        self.assertTrue(isinstance(token, pr.token_list.Token))
+        self.assertEqual(token['word'], 1)
+        self.assertEqual(token['sentenceword'], 1)
+        self.assertTrue(isinstance(token['bytecount'], str))
+
+        # Recurring strings are shared
+        tags = [t['pos'] for t in doc.tokens if t['pos'] == 'NN']
+        self.assertIs(tags[0], tags[1])
+        self.assertIs(
+            doc.sentences[0]['constituent_type'],
+            pr.string_table.intern_string(u's')
+        )
+
+
+
 class TestReadEntityTypes(TestCase):
 
     def setUp(self):
@@ -313,12 +1232,49 @@ class TestReadParcFile(TestCase):
         self.doc = self.get_test_doc()
 
 
-    def get_test_doc(self, include_nested=True):
+    def get_test_doc(self, include_nested=True, engine='soup'):
         first_interesting_article = 3
         path = pr.parc_dataset.get_parc_path(first_interesting_article)
         xml = open(path).read()
         return pr.new_parc_annotated_text.read_parc_file(
-            xml, include_nested=include_nested)
+            xml, include_nested=include_nested, engine=engine)
+
+
+    def test_iterparse_engine(self):
+        """
+        The streaming engine should build exactly the same document as the
+        soup engine.
+        """
+        for include_nested in [True, False]:
+            soup_doc = self.get_test_doc(include_nested)
+            stream_doc = self.get_test_doc(include_nested, engine='iterparse')
+            self.assertEqual(stream_doc.tokens, soup_doc.tokens)
+            self.assertEqual(stream_doc.sentences, soup_doc.sentences)
+            self.assertEqual(
+                stream_doc.annotations['attributions'],
+                soup_doc.annotations['attributions']
+            )
+
+        with self.assertRaises(ValueError):
+            self.get_test_doc(engine='not-an-engine')
+
+
+    def test_parallel_iteration(self):
+        """
+        Loading documents in a process pool should give the same documents,
+        in the same order, as loading them one at a time.
+        """
+        serial_docs = list(pr.parc_dataset.iter_parc_docs(limit=12))
+        parallel_docs = list(
+            pr.parc_dataset.iter_parc_docs(limit=12, workers=3))
+        self.assertEqual(
+            [doc_num for doc_num, doc in parallel_docs],
+            [doc_num for doc_num, doc in serial_docs]
+        )
+        for (_, serial_doc), (_, parallel_doc) in zip(
+            serial_docs, parallel_docs
+        ):
+            self.assertEqual(parallel_doc.tokens, serial_doc.tokens)
 
 
     def test_num_attributions(self):
@@ -546,6 +1502,56 @@ class TestReadParcFile(TestCase):
 
 
 
+class TestScanParcXml(TestCase):
+
+    PARC_XML = (
+        '<?xml version="1.0" ?><root>'
+        '<SENTENCE gorn="0"><S gorn="0">'
+        '<WORD ByteCount="0,2" text="He" word="0">'
+        '<attribution id="wsj_0001_set_0">'
+        '<attributionRole roleValue="source"/></attribution>'
+        '<attribution id="wsj_0001_Nested_set_1">'
+        '<attributionRole roleValue="content"/></attribution>'
+        '</WORD>'
+        "<WORD ByteCount='3,7' text='said' word='1'>"
+        '<attribution id="wsj_0001_set_0">'
+        '<attributionRole roleValue="cue"/></attribution>'
+        '</WORD>'
+        '</S></SENTENCE>'
+        '<SENTENCE gorn="1"><S gorn="1">'
+        '<WORD ByteCount="8,9" text=">" word="2"/>'
+        '<WORD ByteCount="10,14" text="&quot;ok" word="3">'
+        '<attribution id="wsj_0001_set_0">'
+        '<attributionRole roleValue="content"/></attribution>'
+        '</WORD>'
+        '</S></SENTENCE></root>'
+    )
+
+    def test_scan_parc_xml(self):
+        word_offsets, attributions = (
+            pr.new_parc_annotated_text.scan_parc_xml(self.PARC_XML))
+        self.assertEqual(word_offsets, [(0,2), (3,7), (8,9), (10,14)])
+        self.assertEqual(attributions.keys(), ['wsj_0001_set_0'])
+        attribution = attributions['wsj_0001_set_0']
+        self.assertEqual(attribution['source'], [(0,0)])
+        self.assertEqual(attribution['cue'], [(0,1)])
+        self.assertEqual(attribution['content'], [(1,1)])
+        self.assertEqual(attribution['sentences'], {0,1})
+
+        nested_attributions = pr.new_parc_annotated_text.get_attributions(
+            self.PARC_XML, include_nested=True)
+        self.assertEqual(
+            nested_attributions['wsj_0001_Nested_set_1']['content'], [(0,0)])
+
+
+    def test_scanned_attributes(self):
+        get_attribute = pr.new_parc_annotated_text.get_scanned_attribute
+        self.assertEqual(get_attribute(' data-id="x" id="y"', 'id'), 'y')
+        self.assertEqual(
+            get_attribute(' id="a&#39;b&#x27;c&amp;#39;"', 'id'), "a'b'c&#39;")
+
+
+
 def get_test_texts(article_num, include_parc=True):
     texts = []
     texts.append(open('data/example-corenlp-%d.xml' % article_num).read())
@@ -555,6 +1561,62 @@ def get_test_texts(article_num, include_parc=True):
     return texts
 
 
+def make_minidom_parc_xml(sentences, get_token_attributions):
+    """
+    Build the PARC xml DOM for `sentences` with minidom, as the readers'
+    `get_parc_xml` used to, to check the streamed xml against.
+    """
+    doc = minidom.Document()
+    root = doc.appendChild(doc.createElement('root'))
+    word = 0
+    for gorn, sentence in enumerate(sentences):
+        sentence_tag = root.appendChild(doc.createElement('SENTENCE'))
+        sentence_tag.setAttribute('gorn', str(gorn))
+        element, word, sentence_word = make_minidom_constituent(
+            doc, sentence['c_root']['c_children'][0], get_token_attributions,
+            word, 0, (gorn,)
+        )
+        sentence_tag.appendChild(element)
+    return doc
+
+
+def make_minidom_constituent(
+    doc, constituent, get_token_attributions, word, sentence_word, gorn
+):
+    gorn_str = ','.join([str(g) for g in gorn])
+    if len(constituent['c_children']) == 0:
+        element = doc.createElement('WORD')
+        element.setAttribute('ByteCount', '%s,%s' % (
+            constituent['character_offset_begin'],
+            constituent['character_offset_end']
+        ))
+        element.setAttribute('lemma', constituent['lemma'])
+        element.setAttribute('pos', constituent['pos'])
+        element.setAttribute('text', constituent['word'])
+        element.setAttribute('gorn', gorn_str)
+        element.setAttribute('word', str(word))
+        element.setAttribute('sentenceWord', str(sentence_word))
+        for attr_id, roles in get_token_attributions(constituent):
+            attribution = element.appendChild(
+                doc.createElement('attribution'))
+            attribution.setAttribute('id', attr_id)
+            for role in roles:
+                attribution_role = attribution.appendChild(
+                    doc.createElement('attributionRole'))
+                attribution_role.setAttribute('roleValue', role)
+        return element, word + 1, sentence_word + 1
+
+    element = doc.createElement(constituent['c_tag'])
+    element.setAttribute('gorn', gorn_str)
+    for child_gorn, child in enumerate(constituent['c_children']):
+        child_element, word, sentence_word = make_minidom_constituent(
+            doc, child, get_token_attributions, word, sentence_word,
+            gorn + (child_gorn,)
+        )
+        element.appendChild(child_element)
+    return element, word, sentence_word
+
+
 def get_test_article(article_num, include_parc=True):
     return ParcCorenlpReader(*get_test_texts(article_num, include_parc))
 
@@ -797,6 +1859,202 @@ class TestReader(TestCase):
         )
 
 
+    def test_offsets_and_attributions(self):
+        """
+        Reading offsets and attributions in one parse should agree with the
+        attributions read alone, and with the offsets adopted by the reader.
+        """
+        corenlp_xml, parc_xml, raw_txt = get_test_texts(1)
+        word_offsets, attributions = (
+            pr.new_parc_annotated_text.get_offsets_and_attributions(parc_xml))
+        self.assertEqual(
+            attributions, pr.new_parc_annotated_text.get_attributions(parc_xml))
+
+        article = ParcCorenlpReader(corenlp_xml, parc_xml, raw_txt)
+        self.assertEqual(
+            [
+                (t['character_offset_begin'], t['character_offset_end'])
+                for t in article.tokens
+            ],
+            word_offsets
+        )
+
+
+    def test_map_byte_range_to_tokens(self):
+        article = get_test_article(1)
+        tokens = sorted(
+            article.tokens, key=lambda t: t['character_offset_begin'])
+        byte_ranges = [(0, 1), (0, 60), (25, 200), (1000, 1400), (10, 10**6)]
+
+        # A token is found if it begins within the range
+        for start, end in byte_ranges:
+            expected_token_ids = [
+                (t['sentence_id'], t['id']) for t in tokens
+                if start <= t['character_offset_begin'] < end
+            ]
+            found_token_ids = article.map_byte_range_to_token_ids(start, end)
+            self.assertEqual(found_token_ids, expected_token_ids)
+
+        # The bulk version should give the same result for each range
+        self.assertEqual(
+            article.map_byte_ranges_to_token_ids(byte_ranges[::-1]),
+            [
+                article.map_byte_range_to_token_ids(start, end)
+                for start, end in byte_ranges[::-1]
+            ]
+        )
+
+
+    def test_attribution_heads(self):
+        article = get_test_article(1)
+        for attribution in article.attributions.values():
+            for role in ROLES:
+                tokens = attribution[role]
+                head = attribution.get_head(role)
+                if head is None:
+                    continue
+
+                # The head is in the span, but none of its parents are
+                self.assertTrue(any(head is t for t in tokens))
+                span_token_ids = {(t['sentence_id'], t['id']) for t in tokens}
+                if len(tokens) > 1:
+                    self.assertFalse(any(
+                        (parent['sentence_id'], parent['id']) in span_token_ids
+                        for relation, parent in head['parents']
+                    ))
+
+                # The head is remembered, until the span's tokens change,
+                # even in place
+                self.assertTrue(attribution.get_head(role) is head)
+                attribution[role] = tokens[:1]
+                self.assertTrue(attribution.get_head(role) is tokens[0])
+                substitute = tokens[0].copy()
+                attribution[role][0] = substitute
+                self.assertTrue(attribution.get_head(role) is substitute)
+
+
+    def test_paragraphs(self):
+        article = get_test_article(1)
+
+        # Sentences know their paragraph as soon as the reader is made
+        self.assertTrue(
+            all('paragraph_idx' in s for s in article.sentences))
+        self.assertEqual(
+            [len(p) for p in article.paragraphs],
+            [1, 2, 2, 1, 3, 2, 1, 4, 3, 2, 1, 4, 2, 3, 3, 2, 1]
+        )
+
+        # Every sentence belongs to exactly one paragraph, in order
+        self.assertEqual(
+            [s for p in article.paragraphs for s in p], article.sentences)
+        for paragraph_idx, paragraph in enumerate(article.paragraphs):
+            for sentence in paragraph:
+                self.assertEqual(sentence['paragraph_idx'], paragraph_idx)
+
+        # Ties go to fewer sentences, and a too-long paragraph lets the
+        # following short paragraphs be skipped
+        self.assertEqual(
+            pr.utils.align_paragraphs([3, 0, 4, 9, 2], [3, 10, 2, 1, 2]),
+            [(0, 1), (1, 4), (4, 5)]
+        )
+
+
+    def test_parc_xml_writer(self):
+        """
+        The xml written by parc_xml_writer should be the same as that made by
+        minidom, in both pretty and compact modes.
+        """
+        def make_token(text, attributions=()):
+            return {
+                'c_children': [], 'character_offset_begin': 0,
+                'character_offset_end': len(text), 'lemma': text.lower(),
+                'pos': 'NN', 'word': text, 'attributions': dict(attributions)
+            }
+        sentences = [
+            {'c_root': {'c_children': [{'c_tag': 'S', 'c_children': [
+                {'c_tag': 'NP', 'c_children': [
+                    make_token('Bob', [('wsj_0001_1', ['source'])])]},
+                {'c_tag': 'VP', 'c_children': [
+                    make_token('said', [('wsj_0001_1', ['cue'])]),
+                    make_token('"<AT&T>"', [
+                        ('wsj_0001_1', ['content']),
+                        ('wsj_0001_2', ['source', 'content'])
+                    ]),
+                ]},
+            ]}]}},
+            {'c_root': {'c_children': [make_token('.')]}},
+        ]
+        get_token_attributions = lambda token: sorted(
+            token['attributions'].items())
+        xml_dom = make_minidom_parc_xml(sentences, get_token_attributions)
+
+        out = StringIO()
+        pr.parc_xml_writer.write_parc_xml(
+            sentences, out, get_token_attributions)
+        self.assertEqual(out.getvalue(), xml_dom.toprettyxml(indent='  '))
+        out = StringIO()
+        pr.parc_xml_writer.write_parc_xml(
+            sentences, out, get_token_attributions, indent='', newl='')
+        self.assertEqual(out.getvalue(), xml_dom.toxml())
+
+
+    def test_streaming_parc_xml(self):
+        """
+        The streamed xml should be the same as that made by minidom, in both
+        pretty and compact modes.
+        """
+        for article_num in [1, 2]:
+            article = get_test_article(article_num)
+            xml_dom = make_minidom_parc_xml(
+                article.sentences, article.get_token_attributions)
+            self.assertEqual(
+                article.get_parc_xml(), xml_dom.toprettyxml(indent='  '))
+            self.assertEqual(
+                article.get_parc_xml(pretty=False), xml_dom.toxml())
+
+        # Deeply nested constituents don't exhaust the recursion limit
+        token = {
+            'c_children': [], 'character_offset_begin': 0,
+            'character_offset_end': 1, 'lemma': 'a', 'pos': 'DT',
+            'word': 'a', 'attributions': {}
+        }
+        constituent = token
+        for depth in range(5000):
+            constituent = {'c_tag': 'NP', 'c_children': [constituent]}
+        sentences = [{'c_root': {'c_children': [constituent]}}]
+        out = StringIO()
+        pr.parc_xml_writer.write_parc_xml(
+            sentences, out, lambda token: token['attributions'].iteritems())
+        self.assertEqual(out.getvalue().count('<NP '), 5000)
+
+
+    def test_attribution_html(self):
+        """
+        The streamed html should be the same as the html built using dom
+        elements.
+        """
+        serializer = pr.AttributionHtmlSerializer
+        article = get_test_article(1)
+        attributions = article.attributions.values()
+        for resolve_pronouns in [False, True]:
+            dom, body = serializer.prepare_dom()
+            for attribution in attributions:
+                body.appendChild(serializer.get_attribution_element(
+                    attribution, resolve_pronouns))
+            self.assertEqual(
+                article.get_all_attribution_html(resolve_pronouns),
+                dom.toprettyxml(indent='  ')
+            )
+            for attribution in attributions:
+                self.assertEqual(
+                    article.get_attribution_html(
+                        attribution, resolve_pronouns),
+                    serializer.get_attribution_element(
+                        attribution, resolve_pronouns
+                    ).toprettyxml(indent='', newl=' ')
+                )
+
+
     def test_writing_parc_xml(self):
         """
         Test that a write-read cycle preserves the attribution structure
@@ -0,0 +1,263 @@
+'''
+Aligns two tokenizations of the same text.  The texts of the tokens are
+normalized and compared character by character using a diff, and tokens
+sharing matched characters are grouped together.  This handles one token
+being split into several (1:n), several being merged into one (n:1), and
+tokens present on only one side.
+'''
+
+import parc_reader
+
+# Tokenizations of the same text differ by a handful of characters, so the
+# diff gives up, rather than running in quadratic time, past this many edits.
+MAX_EDITS = 1000
+
+
+def align_tokens(source_tokens, target_tokens, max_edits=MAX_EDITS):
+    '''
+    Align two lists of tokens (dicts having a 'text' key), returning a
+    TokenAlignment.
+
+    The diff runs in O((N + M) * D) time, where N and M are the lengths of the
+    normalized texts, and D is the number of characters by which they differ,
+    so it is close to linear for tokenizations of the same text.  D is limited
+    to `max_edits`, and a ValueError is raised if the texts differ by more
+    than that.  Pass None to lift the limit.
+    '''
+    source_chars, source_owners = get_normalized_chars(source_tokens)
+    target_chars, target_owners = get_normalized_chars(target_tokens)
+
+    # Link tokens whose characters were matched.  Links come out in order
+    # on both sides.
+    links = []
+    for i, j in diff(source_chars, target_chars, max_edits):
+        link = (source_owners[i], target_owners[j])
+        if len(links) == 0 or links[-1] != link:
+            links.append(link)
+
+    groups = group_links(links, len(source_tokens), len(target_tokens))
+    return TokenAlignment(groups)
+
+
+def normalize_text(text):
+    '''
+    Normalize a token's text for comparison against other tokenizations.
+    '''
+    text = parc_reader.annotated_document.translation(text)
+    return text.lower().replace('`', "'")
+
+
+def get_normalized_chars(tokens):
+    '''
+    Returns the concatenated normalized text of `tokens`, along with the
+    index of the token that each character came from.
+    '''
+    chars = []
+    owners = []
+    for token_index, token in enumerate(tokens):
+        text = normalize_text(token['text'])
+        chars.append(text)
+        owners.extend([token_index] * len(text))
+    return ''.join(chars), owners
+
+
+def diff(a, b, max_edits=None):
+    '''
+    Returns the `(i, j)` pairs of positions where `a[i]` is matched to `b[j]`
+    in a shortest edit script turning `a` into `b`, using Myers' algorithm.
+    '''
+    n, m = len(a), len(b)
+    max_d = n + m if max_edits is None else min(max_edits, n + m)
+
+    # Every character by which the lengths differ takes an edit, so texts
+    # that obviously differ too much are refused before any diagonals are
+    # explored.
+    if abs(n - m) > max_d:
+        raise_too_different(max_d)
+
+    # `furthest[offset + k]` is the furthest x reached along diagonal k
+    # (where k = x - y).  A copy of the diagonals in play is kept after each
+    # round so that the path can be traced back.
+    offset = max_d + 1
+    furthest = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        for k in range(-d, d + 1, 2):
+            if k == -d or (
+                k != d and furthest[offset+k-1] < furthest[offset+k+1]
+            ):
+                x = furthest[offset + k + 1]
+            else:
+                x = furthest[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            furthest[offset + k] = x
+
+            if x >= n and y >= m:
+                trace.append(furthest[offset - d : offset + d + 1])
+                return trace_matches(trace, n, m)
+
+        trace.append(furthest[offset - d : offset + d + 1])
+
+    raise_too_different(max_d)
+
+
+def raise_too_different(max_d):
+    raise ValueError(
+        'Texts differ by more than %d characters, so they were not aligned.'
+        % max_d
+    )
+
+
+def trace_matches(trace, n, m):
+    '''
+    Follow the path found by `diff` back from the end, collecting the
+    matched positions along the way.
+    '''
+    matches = []
+    x, y = n, m
+    for d in range(len(trace) - 1, 0, -1):
+        previous = trace[d - 1]
+        k = x - y
+
+        # Work out which diagonal the path came from (entries in `previous`
+        # are for diagonals -(d-1) through d-1).
+        if k == -d or (
+            k != d and previous[k - 1 + d - 1] < previous[k + 1 + d - 1]
+        ):
+            previous_k = k + 1
+            edit_end_x = previous[previous_k + d - 1]
+        else:
+            previous_k = k - 1
+            edit_end_x = previous[previous_k + d - 1] + 1
+
+        # Characters after the edit, up to (x, y), were matched
+        while x > edit_end_x:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+
+        x = previous[previous_k + d - 1]
+        y = x - previous_k
+
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((x, y))
+
+    matches.reverse()
+    return matches
+
+
+def group_links(links, num_source, num_target):
+    '''
+    Combine links between tokens into groups of contiguous source and target
+    tokens, given as `((source_start, source_end), (target_start,
+    target_end))`.  Tokens that weren't linked are grouped with those
+    occupying the same gap on the other side (or, failing that, given a
+    group of their own with an empty range on the other side), so that the
+    groups cover both token lists, in order.
+    '''
+    linked_groups = []
+    for source_index, target_index in links:
+        if len(linked_groups) > 0:
+            (source_start, source_end), (target_start, target_end) = (
+                linked_groups[-1])
+            if source_index < source_end or target_index < target_end:
+                linked_groups[-1] = (
+                    (source_start, max(source_end, source_index + 1)),
+                    (target_start, max(target_end, target_index + 1))
+                )
+                continue
+        linked_groups.append((
+            (source_index, source_index + 1),
+            (target_index, target_index + 1)
+        ))
+
+    groups = []
+    source_pointer, target_pointer = 0, 0
+    for source_range, target_range in linked_groups + [
+        ((num_source, num_source), (num_target, num_target))
+    ]:
+        if source_range[0] > source_pointer or target_range[0] > target_pointer:
+            groups.append((
+                (source_pointer, source_range[0]),
+                (target_pointer, target_range[0])
+            ))
+        if source_range[1] > source_range[0]:
+            groups.append((source_range, target_range))
+        source_pointer, target_pointer = source_range[1], target_range[1]
+
+    return groups
+
+
+
+class TokenAlignment(object):
+    '''
+    A mapping between two token lists.  `groups` holds
+    `((source_start, source_end), (target_start, target_end))` for each group
+    of aligned tokens; one of the ranges is empty if the tokens only appear
+    on one side.  The alignment can be used to project annotations from one
+    token list onto the other.
+    '''
+
+    def __init__(self, groups):
+        self.groups = groups
+
+        # Look up the group that each token belongs to
+        self.source_groups = []
+        self.target_groups = []
+        for group_index, (source_range, target_range) in enumerate(groups):
+            self.source_groups.extend(
+                [group_index] * (source_range[1] - source_range[0]))
+            self.target_groups.extend(
+                [group_index] * (target_range[1] - target_range[0]))
+
+
+    def invert(self):
+        '''
+        Returns the alignment going from the target to the source.
+        '''
+        return TokenAlignment([
+            (target_range, source_range)
+            for source_range, target_range in self.groups
+        ])
+
+
+    def get_target_range(self, source_index):
+        '''
+        Returns the range of target tokens aligned to the source token at
+        `source_index`.
+        '''
+        return self.groups[self.source_groups[source_index]][1]
+
+
+    def project_range(self, start, end):
+        '''
+        Returns the range of target tokens aligned to the source tokens in
+        `[start, end)`, or None if none are aligned to them.
+        '''
+        if start >= end:
+            return None
+        target_start = self.get_target_range(start)[0]
+        target_end = self.get_target_range(end - 1)[1]
+        if target_start >= target_end:
+            return None
+        return target_start, target_end
+
+
+    def project_span(self, token_span):
+        '''
+        Project an absolute TokenSpan (or list of absolute token ranges) from
+        the source tokens onto the target tokens.
+        '''
+        projected = parc_reader.spans.TokenSpan(absolute=True)
+        for sentence_id, start, end in token_span:
+            if sentence_id is not None:
+                raise ValueError('Only absolute token spans can be projected.')
+            target_range = self.project_range(start, end)
+            if target_range is not None:
+                projected.add_token_range((None,) + target_range)
+        return projected
@@ -1,3 +1,7 @@
+import bisect
+import parc_reader
+
+
 class TokenList(list):
 
     def __init__(self, tokens=None):
@@ -10,3 +14,270 @@ class TokenList(list):
     def text(self):
         return ' '.join([t['text'] for t in self])
 
+
+
+MISSING = object()
+class Token(object):
+    """
+    A compact token, which can be used like a dict (`token['text']`,
+    `token.get('lemma')`, `token.update(...)`, `dict(token)`, etc.).  Common
+    fields are held in slots, which take a fraction of the memory of a dict;
+    any other fields go into a dict that is only made when needed.
+
+    The fields of a parc <word> tag that hold numbers are parsed once, when
+    set: `word` and `sentenceword` become ints.  `gorn` and `bytecount` are
+    kept as byte strings (like '0,3,1'), which are smaller than tuples of
+    ints or unicode strings.  Lemmas and part-of-speech tags are interned in
+    the shared `string_table`.
+    """
+
+    FIELDS = (
+        'text', 'lemma', 'pos', 'gorn', 'bytecount', 'word', 'sentenceword',
+        'id', 'sentence_id', 'abs_id', 'attributions', 'is_token', 'entity'
+    )
+    __slots__ = FIELDS + ('_extra',)
+    __hash__ = None
+
+    def __init__(self, fields=None, **kwargs):
+        self._extra = None
+        if fields is not None:
+            self.update(fields)
+        self.update(kwargs)
+
+
+    def __getitem__(self, key):
+        if key in FIELD_SET:
+            value = getattr(self, key, MISSING)
+        elif self._extra is not None:
+            value = self._extra.get(key, MISSING)
+        else:
+            value = MISSING
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+
+    def __setitem__(self, key, value):
+        if key in FIELD_SET:
+            parse = FIELD_PARSERS.get(key)
+            if parse is not None and isinstance(value, basestring):
+                value = parse(value)
+            elif key in INTERNED_FIELDS:
+                value = parc_reader.string_table.intern_string(value)
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+
+    def __delitem__(self, key):
+        try:
+            if key in FIELD_SET:
+                delattr(self, key)
+            else:
+                del self._extra[key]
+        except (AttributeError, KeyError, TypeError):
+            raise KeyError(key)
+
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def keys(self):
+        keys = [key for key in self.FIELDS if hasattr(self, key)]
+        if self._extra is not None:
+            keys.extend(self._extra.keys())
+        return keys
+
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+    def __len__(self):
+        return len(self.keys())
+
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+
+    def iteritems(self):
+        return iter(self.items())
+
+
+    def update(self, fields=(), **kwargs):
+        if hasattr(fields, 'keys'):
+            fields = [(key, fields[key]) for key in fields.keys()]
+        for key, value in fields:
+            self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+
+    def copy(self):
+        return Token(self)
+
+
+    def __eq__(self, other):
+        if not hasattr(other, 'keys'):
+            return NotImplemented
+        return dict(self.items()) == dict(
+            [(key, other[key]) for key in other.keys()])
+
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+
+    def __repr__(self):
+        return 'Token(%r)' % dict(self.items())
+
+
+    def __getstate__(self):
+        return dict(self.items())
+
+
+    def __setstate__(self, state):
+        self._extra = None
+        self.update(state)
+
+
+
+def to_byte_string(value):
+    if isinstance(value, unicode):
+        return value.encode('ascii')
+    return value
+
+
+FIELD_SET = frozenset(Token.FIELDS)
+INTERNED_FIELDS = frozenset(['lemma', 'pos'])
+FIELD_PARSERS = {
+    'word': int,
+    'sentenceword': int,
+    'gorn': to_byte_string,
+    'bytecount': to_byte_string,
+}
+
+
+
+class TokenView(object):
+    """
+    A read-only view of a document's tokens, covering the absolute
+    `(start, end)` ranges in `ranges`, which doesn't copy the tokens.  Making
+    a view only costs as much as the number of ranges, however many tokens
+    they cover.  It can be iterated over, indexed, and sliced (giving another
+    view) like a TokenList.
+
+    A view sees the `tokens` list it was made from; after the document's
+    tokens are edited, fetch a new one.
+    """
+
+    def __init__(self, tokens, ranges):
+        self.tokens = tokens
+        self.ranges = []
+        self.range_ends = []
+        self.length = 0
+
+        # Clip ranges to the tokens that exist, as slicing would.
+        num_tokens = len(tokens)
+        for start, end in ranges:
+            start, end = max(start, 0), min(end, num_tokens)
+            if start >= end:
+                continue
+            self.ranges.append((start, end))
+            self.length += end - start
+            self.range_ends.append(self.length)
+
+
+    def __len__(self):
+        return self.length
+
+
+    def __iter__(self):
+        tokens = self.tokens
+        for start, end in self.ranges:
+            for abs_index in xrange(start, end):
+                yield tokens[abs_index]
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.get_slice(index)
+
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError('TokenView index out of range')
+
+        range_index = bisect.bisect_right(self.range_ends, index)
+        start, end = self.ranges[range_index]
+        return self.tokens[end - (self.range_ends[range_index] - index)]
+
+
+    def __getslice__(self, start, stop):
+
+        # Negative indices have already had the length added to them.
+        return self.get_slice(slice(max(start, 0), max(stop, 0)))
+
+
+    def get_slice(self, index_slice):
+        start, stop, step = index_slice.indices(self.length)
+        if step != 1:
+            return TokenList(list(self)[index_slice])
+
+        # Keep the parts of ranges that fall between `start` and `stop`.
+        ranges = []
+        range_start = 0
+        for (abs_start, abs_end), range_end in zip(
+            self.ranges, self.range_ends
+        ):
+            if range_end > start and range_start < stop:
+                ranges.append((
+                    abs_start + max(start - range_start, 0),
+                    abs_end - max(range_end - stop, 0)
+                ))
+            range_start = range_end
+        return TokenView(self.tokens, ranges)
+
+
+    def __eq__(self, other):
+        try:
+            return list(self) == list(other)
+        except TypeError:
+            return NotImplemented
+
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+
+    def __repr__(self):
+        return 'TokenView(%r)' % list(self)
+
+
+    def text(self):
+        return ' '.join([t['text'] for t in self])
@@ -3,6 +3,8 @@ This module contains a couple utility classes used by the ParcCorenlpReader,
 and ParcAnnotatedText.
 '''
 
+from bisect import bisect_left, bisect_right
+
 
 def rangify(iterable):
     '''
@@ -118,6 +120,84 @@ def get_spans(sentence, spans, elipsis=True):
     return tokens
 
 
+def align_paragraphs(sentence_lengths, paragraph_lengths):
+    '''
+    Decides how many consecutive sentences make up each paragraph, choosing
+    the number of sentences whose total length comes closest to that of the
+    paragraph (ties go to the fewest sentences).  Lengths should have
+    whitespace collapsed out.  Returns a list of `(start, stop)` sentence
+    ranges, one per paragraph made.  Sentences left over at the end are not
+    assigned.
+
+    The running total of sentence lengths is computed once, so the best
+    number of sentences for each paragraph is found by binary search.
+    '''
+    cumulative_lengths = [0]
+    for length in sentence_lengths:
+        cumulative_lengths.append(cumulative_lengths[-1] + length)
+    num_sentences = len(sentence_lengths)
+
+    paragraph_ranges = []
+    sentence_pointer = 0
+    last_excess = 0
+    for target_length in paragraph_lengths:
+
+        # Occasionally a paragraph break occurs within what was
+        # considered one sentence in PARC.  This can happen when a 
+        # heading is followed by a subheading.  If this paragraph
+        # helps to make up for the excess of length in the last 
+        # paragraph then that's probably what happened.  Skip it, and
+        # deduct its length from the excess length.
+        if last_excess - target_length >= 0:
+            last_excess -= target_length
+            continue
+
+        # But if we run out of sentences, then there's no more 
+        # paragraphs to make, so stop.
+        if sentence_pointer >= num_sentences:
+            break
+
+        # Find the last sentence boundary that keeps the paragraph within
+        # its target length, and the first one that exceeds it.
+        start_length = cumulative_lengths[sentence_pointer]
+        target_end = start_length + target_length
+        first_over = bisect_right(
+            cumulative_lengths, target_end, sentence_pointer + 1)
+
+        # The paragraph always gets at least one sentence
+        if first_over - 1 <= sentence_pointer:
+            stop = sentence_pointer + 1
+
+        # Otherwise prefer the fewest sentences that reach the longest
+        # length within the target, unless overshooting is strictly closer
+        else:
+            stop = bisect_left(
+                cumulative_lengths, cumulative_lengths[first_over - 1],
+                sentence_pointer + 1
+            )
+            under_distance = target_end - cumulative_lengths[stop]
+            if (
+                first_over <= num_sentences
+                and cumulative_lengths[first_over] - target_end
+                    < under_distance
+            ):
+                stop = first_over
+
+        paragraph_ranges.append((sentence_pointer, stop))
+
+        # If the paragraph we built was too big, it may be because
+        # PARC glues multiple paragraphs together (because the 
+        # "paragraphs" in the original are just sentence fragments and
+        # we won't split paragraphs within sentence fragments).
+        # Keep track of this so that we can skip these fragmentary 
+        # "paragraphs" as needed.
+        last_excess = cumulative_lengths[stop] - target_end
+        sentence_pointer = stop
+
+    return paragraph_ranges
+
+
+
 # CONSTITUENCY-RELATED FUNCTIONS
 def get_dfs_sequence(node, get_children, sequence=None, depth=0):
     if sequence is None: